@@ -0,0 +1,58 @@
+# Runs a batch of independent sessions of one team with Team.run_batch and reports
+# how throughput scales with the number of sessions allowed to run at once.
+#
+#   python benchmarks/batch.py --problems 64 --turns 10 --latency 0.05
+
+import argparse
+import asyncio
+import time
+
+from common import StubClient
+
+from mar_ps import Message, Model, Team, system
+
+
+def setup(mar):
+    for entity in mar.entities:
+        entity.message_stack.append(
+            Message(
+                system,
+                entity,
+                f"You are {entity.id}. Your team: "
+                + ", ".join(e.id for e in mar.entities if e != entity),
+            )
+        )
+
+
+async def main(args):
+    team = Team(Model("stub", StubClient(latency=args.latency, seed=1)), setup=setup)
+    for i in range(args.team_size):
+        team.Entity(f"Expert {i}", f"expert number {i}")
+    print(f"{'sessions':>9} {'elapsed':>9} {'problems/s':>11} {'turns/s':>9}")
+    for max_sessions in args.max_sessions:
+        start = time.perf_counter()
+        turns = 0
+        async for result in team.run_batch(
+            [f"Problem {i}" for i in range(args.problems)],
+            "Expert 0",
+            sender="Expert 1",
+            max_sessions=max_sessions,
+            max_turns=args.turns,
+        ):
+            assert result.error == None, result.error
+            turns += result.turns
+        elapsed = time.perf_counter() - start
+        print(
+            f"{max_sessions:>9} {elapsed:>8.2f}s {args.problems / elapsed:>11.1f}"
+            f" {turns / elapsed:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", type=int, default=64)
+    parser.add_argument("--team-size", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-sessions", type=int, nargs="+", default=[1, 8, 64])
+    asyncio.run(main(parser.parse_args()))
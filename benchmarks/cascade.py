@@ -0,0 +1,63 @@
+# Runs the same conversations with every entity on a slow "large" stub model, and
+# again with a cascade that tries a fast "small" stub first. The small model leaves
+# out the To: line in `--error-rate` of its replies, which sends those turns on to the
+# large model. Reports the mean turn latency and each entity's escalation rate.
+#
+#   python benchmarks/cascade.py --turns 100 --small 0.02 --large 0.2 --error-rate 0.2
+
+import argparse
+import asyncio
+import time
+
+from common import StubClient
+
+from mar_ps import MAR, Cascade, Message, Model, system
+
+
+async def run(args, cascade: bool) -> tuple[float, MAR]:
+    large = Model("large", StubClient(latency=args.large))
+    small = Model("small", StubClient(latency=args.small, error_rate=args.error_rate))
+    mar = MAR(event_sink=None)
+    for i in range(args.team_size):
+        mar.Entity(
+            f"Expert {i}",
+            f"expert number {i}",
+            model=large,
+            cascade=Cascade([small], samples=args.samples) if cascade else None,
+        )
+    for entity in mar.entities:
+        entity.message_stack.append(
+            Message(system, entity, f"You are {entity.id}.")
+        )
+    start = time.perf_counter()
+    turns = await mar.run(
+        Message(mar.entities[1], mar.entities[0], "Solve it."), max_turns=args.turns
+    )
+    return (time.perf_counter() - start) / turns, mar
+
+
+async def main(args):
+    plain, _ = await run(args, cascade=False)
+    cascaded, mar = await run(args, cascade=True)
+    print(f"large only:    {plain * 1000:.0f}ms per turn")
+    print(
+        f"with cascade:  {cascaded * 1000:.0f}ms per turn "
+        f"({cascaded / plain:.0%} of large only)"
+    )
+    for entity in mar.entities:
+        stats = entity.cascade_stats
+        print(
+            f"  {entity.id}: {entity.escalation_rate:.0%} escalated of "
+            f"{stats['generations']}, rejected {stats['rejected']}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--team-size", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--small", type=float, default=0.02)
+    parser.add_argument("--large", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    parser.add_argument("--samples", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
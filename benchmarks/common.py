@@ -0,0 +1,100 @@
+# Stub clients and team builders shared by the benchmarks. No model server needed.
+
+import asyncio
+import os
+import random
+import sys
+from typing import Optional
+
+# The benchmarks measure the mar_ps of this checkout, not an installed release, from
+# whichever directory they are run. Every benchmark imports this module first.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mar_ps import Client, MAR, Message, Model, system
+
+
+def last_sender(messages) -> Optional[str]:
+    # The last entity that messaged the prompt's owner. Corrective messages come
+    # "From: system", which can't be replied to.
+    for message in reversed(messages):
+        if message["role"] == "user" and message["content"].startswith("From: "):
+            sender = message["content"][6 : message["content"].find("\n")]
+            if sender != "system":
+                return sender
+    return None
+
+
+class StubClient(Client):
+    # Replies to whoever sent the last message, after `latency` (+/- `jitter`) seconds.
+    # With `error_rate`, that fraction of replies are missing their To: line.
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        self.calls += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return f"I forgot the header. ({model_id}, turn {self.calls})"
+        return f"To: {last_sender(messages)}\nReply {self.calls} from {model_id}."
+
+
+def build_team(
+    client: Client,
+    size: int = 2,
+    models: int = 1,
+    system_prompts: bool = True,
+    **mar_options,
+) -> MAR:
+    # Without `system_prompts`, e.g. for a MAR that resumes a stored conversation,
+    # the stacks are left as they are.
+    mar = MAR(**mar_options)
+    for i in range(size):
+        mar.Entity(
+            f"Expert {i}",
+            f"expert number {i}",
+            model=Model(f"stub-{i % models}", client),
+        )
+    if not system_prompts:
+        return mar
+    for entity in mar.entities:
+        entity.message_stack.append(
+            Message(
+                system,
+                entity,
+                f"You are {entity.id}. Your team: "
+                + ", ".join(e.id for e in mar.entities if e != entity),
+            )
+        )
+    return mar
+
+
+class FaultyClient(StubClient):
+    # Injects transport faults: `failure_rate` of requests raise ConnectionError and
+    # `hang_rate` of them never answer.
+    def __init__(self, failure_rate: float = 0.0, hang_rate: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        roll = self.random.random()
+        if roll < self.failure_rate:
+            await asyncio.sleep(self.latency)
+            raise ConnectionError(f"injected failure ({model_id})")
+        if roll < self.failure_rate + self.hang_rate:
+            await asyncio.Event().wait()
+        return await super().get_chat_completion(messages, model_id, options)
@@ -0,0 +1,52 @@
+# Compares the per-turn cost of formatting an entity's whole message stack from
+# scratch with Entity.formatted_stack, which only formats what changed.
+#
+#   python benchmarks/format_cache.py --lengths 10 100 1000 5000
+
+import argparse
+import time
+
+from common import StubClient, build_team
+
+from mar_ps import Message
+
+
+def per_turn(func, turns: int) -> float:
+    start = time.perf_counter()
+    for _ in range(turns):
+        func()
+    return (time.perf_counter() - start) / turns
+
+
+def main(lengths: list[int], turns: int):
+    print(f"{'stack':>8} {'full format':>14} {'cached':>14} {'speedup':>8}")
+    for length in lengths:
+        mar = build_team(StubClient(), size=2)
+        entity, other = mar.entities
+        for i in range(length):
+            sender, recipient = (other, entity) if i % 2 else (entity, other)
+            entity.message_stack.append(Message(sender, recipient, f"Message {i}. " * 20))
+        entity.formatted_stack()
+
+        def full():
+            entity.message_stack.append(Message(other, entity, "One more message."))
+            return [message.format(entity) for message in entity.message_stack]
+
+        def cached():
+            entity.message_stack.append(Message(other, entity, "One more message."))
+            return entity.formatted_stack()
+
+        full_time = per_turn(full, turns)
+        cached_time = per_turn(cached, turns)
+        print(
+            f"{length:>8} {full_time * 1e6:>12.1f}us {cached_time * 1e6:>12.1f}us"
+            f" {full_time / cached_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    main(args.lengths, args.turns)
@@ -0,0 +1,63 @@
+# Runs many short conversations in one process and prints the resident set size as
+# it goes. With no global message registry, RSS should stay flat once warmed up.
+# Live Python allocations are printed too, since RSS also moves with allocator noise.
+#
+#   python benchmarks/memory.py --conversations 10000 --turns 10
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import os
+import resource
+import sys
+
+from common import StubClient, build_team
+
+from mar_ps import EntityName, Message, MessageLog
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak RSS (kilobytes on Linux, bytes on macOS) where /proc is unavailable.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def main(conversations: int, turns: int, team_size: int, log_size: int):
+    client = StubClient()
+    user = EntityName("Instruction Giver", pin_to_all_models=True)
+    samples = []
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for i in range(conversations):
+            mar = build_team(
+                client, size=team_size, message_log=MessageLog(max_size=log_size)
+            )
+            await mar.run(
+                Message(user, mar.entities[0], f"Problem {i}"), max_turns=turns
+            )
+            if (i + 1) % max(conversations // 10, 1) == 0:
+                gc.collect()
+                samples.append((i + 1, rss_mb(), sys.getallocatedblocks()))
+    for done, rss, blocks in samples:
+        print(f"{done:>8} conversations  RSS {rss:8.1f} MB  live blocks {blocks:>9}")
+    middle = samples[len(samples) // 2]
+    print(
+        f"growth over the second half: {samples[-1][1] - middle[1]:+.1f} MB RSS, "
+        f"{samples[-1][2] - middle[2]:+} blocks"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=10_000)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--team-size", type=int, default=3)
+    parser.add_argument("--log-size", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.conversations, args.turns, args.team_size, args.log_size))
@@ -0,0 +1,59 @@
+# Counts how often consecutive generations use a different model (each switch is a
+# model unload/load on a single Ollama host) with FIFO and model-affinity scheduling.
+# A coordinator regularly broadcasts to a team whose experts are spread over several
+# models, so several entities are often runnable at once.
+#
+#   python benchmarks/model_switches.py --team-size 6 --models 3 --turns 300
+
+import argparse
+import asyncio
+import contextlib
+import os
+
+from common import StubClient, build_team
+
+from mar_ps import EntityName, Message
+
+
+class BroadcastingClient(StubClient):
+    # Expert 0 coordinates: every `every`-th reply it sends is addressed to the team.
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.coordinator_replies = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        reply = await super().get_chat_completion(messages, model_id, options)
+        if messages[0]["content"].startswith("You are Expert 0."):
+            self.coordinator_replies += 1
+            if self.coordinator_replies % self.every == 1:
+                return f"To: all\nEveryone, look at part {self.coordinator_replies}."
+        return reply
+
+
+async def conversation(scheduling: str, args) -> tuple[int, int]:
+    client = BroadcastingClient(args.team_size - 1)
+    mar = build_team(
+        client, size=args.team_size, models=args.models, scheduling=scheduling
+    )
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        turns = await mar.run(
+            Message(EntityName("Instruction Giver"), mar.entities[0], "Solve it."),
+            max_turns=args.turns,
+        )
+    return turns, mar.model_switches
+
+
+async def main(args):
+    print(f"{'scheduling':>15} {'turns':>6} {'switches':>9} {'per 100 turns':>14}")
+    for scheduling in ["fifo", "model-affinity"]:
+        turns, switches = await conversation(scheduling, args)
+        print(f"{scheduling:>15} {turns:>6} {switches:>9} {switches * 100 / turns:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--team-size", type=int, default=6)
+    parser.add_argument("--models", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=300)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,88 @@
+# Runs N concurrent completions through OpenAIClient against a local fake
+# OpenAI-compatible server. Every request takes `--latency` seconds on the server,
+# so with a non-blocking client all N should finish in about the time of one.
+#
+#   python benchmarks/openai_concurrency.py --requests 16 --latency 0.5
+
+import argparse
+import asyncio
+import json
+import time
+
+import common  # noqa: F401 (puts this checkout's mar_ps first on sys.path)
+
+from mar_ps import OpenAIClient
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, latency):
+    # Minimal HTTP/1.1 with keep-alive, just enough for /v1/chat/completions.
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            for line in head.decode().split("\r\n")[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            request = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+            await asyncio.sleep(latency)
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": "To: Math Expert\nok"},
+                        }
+                    ],
+                }
+            ).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def main(requests: int, latency: float, max_connections: int):
+    server = await asyncio.start_server(lambda r, w: handle(r, w, latency), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = OpenAIClient(
+        f"http://127.0.0.1:{port}/v1/", api_key="fake", max_connections=max_connections
+    )
+    messages = [{"role": "user", "content": "From: Team Leader\nhello"}]
+
+    start = time.perf_counter()
+    await client.get_chat_completion(messages, "fake-model")
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[client.get_chat_completion(messages, "fake-model") for _ in range(requests)]
+    )
+    concurrent = time.perf_counter() - start
+
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    print(f"1 completion:             {single:.3f}s")
+    print(f"{requests} concurrent completions: {concurrent:.3f}s ({concurrent / single:.2f}x a single one)")
+    print(f"serial estimate:          {single * requests:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--max-connections", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.latency, args.max_connections))
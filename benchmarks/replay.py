@@ -0,0 +1,57 @@
+# Records a conversation against a slow stub backend, replays it from the recording
+# and checks that the replayed message stacks are identical, then reports how much
+# faster the replay ran.
+#
+#   python benchmarks/replay.py --team-size 4 --turns 200 --latency 0.02
+
+import argparse
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+
+from common import StubClient, build_team
+
+from mar_ps import EntityName, Message, RecordingClient, ReplayClient
+
+
+async def conversation(client, args):
+    mar = build_team(client, size=args.team_size)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        turns = await mar.run(
+            Message(EntityName("Instruction Giver"), mar.entities[0], "Solve it."),
+            max_turns=args.turns,
+        )
+    elapsed = time.perf_counter() - start
+    stacks = [
+        [(m.sender.id, m.recipient.id, m.content) for m in entity.message_stack]
+        for entity in mar.entities
+    ]
+    return turns, elapsed, stacks
+
+
+async def main(args):
+    path = os.path.join(tempfile.mkdtemp(), "recording.jsonl.gz")
+    recorder = RecordingClient(
+        StubClient(latency=args.latency, error_rate=args.error_rate, seed=1), path
+    )
+    turns, recorded_time, recorded = await conversation(recorder, args)
+    recorder.close()
+
+    replay = ReplayClient(path)
+    _, replayed_time, replayed = await conversation(replay, args)
+    assert replayed == recorded, "replayed conversation differs from the recording"
+    print(f"turns:     {turns} ({recorder.recorded} requests, {os.path.getsize(path)} bytes)")
+    print(f"recorded:  {recorded_time:.2f}s")
+    print(f"replayed:  {replayed_time:.3f}s ({turns / replayed_time:.0f} turns/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--team-size", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,88 @@
+# Sends requests to a fault-injecting stub backend, directly and through
+# ResilientClient (timeouts, retries, hedging and failover to a healthy fallback),
+# and reports how many succeed and how long they take.
+#
+#   python benchmarks/resilience.py --requests 200 --failure-rate 0.2 --hang-rate 0.05
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from common import FaultyClient, StubClient
+
+from mar_ps import CircuitBreaker, Model, ResilientClient
+
+
+async def measure(client, requests: int, timeout: float):
+    messages = [{"role": "user", "content": "From: Math Expert\nhello"}]
+    latencies = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            # The outer timeout only keeps hung requests from stalling the benchmark.
+            await asyncio.wait_for(
+                client.get_chat_completion(
+                    messages + [{"role": "user", "content": str(i)}], "primary"
+                ),
+                timeout,
+            )
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            failures += 1
+
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return latencies, failures
+
+
+def report(name, latencies, failures, requests):
+    ok = len(latencies)
+    p50 = statistics.median(latencies) if latencies else float("nan")
+    p99 = sorted(latencies)[int(ok * 0.99) - 1] if latencies else float("nan")
+    print(
+        f"{name:>10}: {ok}/{requests} ok, {failures} failed, "
+        f"p50 {p50 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms"
+    )
+
+
+async def main(args):
+    def faulty():
+        return FaultyClient(
+            failure_rate=args.failure_rate,
+            hang_rate=args.hang_rate,
+            latency=args.latency,
+            jitter=args.latency / 2,
+            seed=1,
+        )
+
+    latencies, failures = await measure(faulty(), args.requests, args.give_up)
+    report("direct", latencies, failures, args.requests)
+
+    resilient = ResilientClient(
+        faulty(),
+        fallback=Model("fallback", StubClient(latency=args.latency)),
+        timeout=args.latency * 4,
+        retries=2,
+        backoff=args.latency / 2,
+        hedge_after=args.latency * 2,
+        breaker=CircuitBreaker(failure_threshold=args.requests),
+    )
+    latencies, failures = await measure(resilient, args.requests, args.give_up)
+    report("resilient", latencies, failures, args.requests)
+    print(
+        f"retried {resilient.retried}, hedged {resilient.hedged}, "
+        f"failed over {resilient.failed_over}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--failure-rate", type=float, default=0.2)
+    parser.add_argument("--hang-rate", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--give-up", type=float, default=2.0)
+    asyncio.run(main(parser.parse_args()))
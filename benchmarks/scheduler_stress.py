@@ -0,0 +1,63 @@
+# Runs a very long two-entity conversation through MAR.run with a stub client and
+# checks that the Python stack depth stays constant while it runs.
+#
+#   python benchmarks/scheduler_stress.py --turns 100000
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+from common import StubClient, build_team
+
+from mar_ps import EntityName, Message
+
+
+class DepthRecordingClient(StubClient):
+    def __init__(self):
+        super().__init__()
+        self.min_depth = sys.maxsize
+        self.max_depth = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        depth = 0
+        frame = sys._getframe()
+        while frame is not None:
+            depth += 1
+            frame = frame.f_back
+        self.min_depth = min(self.min_depth, depth)
+        self.max_depth = max(self.max_depth, depth)
+        return await super().get_chat_completion(messages, model_id, options)
+
+
+async def main(turns: int):
+    client = DepthRecordingClient()
+    mar = build_team(client, size=2)
+    first = mar.entities[0]
+    start = time.perf_counter()
+
+    def trim_history(message):
+        # Keep stacks short so this measures the scheduler, not prompt growth.
+        del message.recipient.message_stack[1:-8]
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ran = await mar.run(
+            Message(EntityName("Expert 1"), first, "Start counting."),
+            max_turns=turns,
+            message_handler=trim_history,
+        )
+    elapsed = time.perf_counter() - start
+    print(f"turns:       {ran}")
+    print(f"elapsed:     {elapsed:.2f}s ({ran / elapsed:.0f} turns/s)")
+    print(f"stack depth: min {client.min_depth}, max {client.max_depth}")
+    assert ran == turns, "conversation ended early"
+    assert client.min_depth == client.max_depth, "stack depth grew during the run"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.turns))
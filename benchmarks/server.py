@@ -0,0 +1,90 @@
+# Starts the HTTP server with a stub team, opens many sessions at once over HTTP and
+# follows each one's event stream. Some extra sessions wait for a human reply the
+# whole time, to show that waiting sessions don't hold up the others. Reports the
+# wall time against the time one session takes on its own.
+#
+#   python benchmarks/server.py --sessions 200 --turns 20 --latency 0.01 --waiting 20
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from common import StubClient
+
+from mar_ps import Model, Team
+from mar_ps.server import Server
+
+
+async def follow(client: httpx.AsyncClient, session: str) -> list[dict]:
+    events = []
+    async with client.stream("GET", f"/sessions/{session}/events") as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                events.append(json.loads(line[6:]))
+    return events
+
+
+async def main(args):
+    team = Team()
+    for i in range(2):
+        team.Entity(
+            f"Expert {i}",
+            f"expert number {i}",
+            model=Model("stub", StubClient(latency=args.latency)),
+        )
+    team.Entity("Human", "the user", is_user=True)
+    server = Server({"stub": team}, port=0)
+    await server.start()
+    limits = httpx.Limits(max_connections=None)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{server.port}", timeout=60, limits=limits
+    ) as client:
+        # Sessions the human never answers.
+        for _ in range(args.waiting):
+            await client.post(
+                "/teams/stub/sessions",
+                json={"problem": "Ask me.", "to": "Expert 0", "until_answer": False},
+            )
+
+        async def session() -> tuple[float, list[dict]]:
+            start = time.perf_counter()
+            response = await client.post(
+                "/teams/stub/sessions",
+                json={
+                    "problem": "Solve it.",
+                    "to": "Expert 0",
+                    "sender": "Expert 1",
+                    "max_turns": args.turns,
+                },
+            )
+            events = await follow(client, response.json()["id"])
+            return time.perf_counter() - start, events
+
+        single, _ = await session()
+        start = time.perf_counter()
+        results = await asyncio.gather(*[session() for _ in range(args.sessions)])
+        elapsed = time.perf_counter() - start
+        waiting = sum(
+            len(s["waiting_for_input"]) for s in (await client.get("/sessions")).json()
+        )
+    await server.close()
+    events = sum(len(events) for _, events in results)
+    finished = sum(events[-1]["status"] == "finished" for _, events in results)
+    print(f"one session:   {single:.2f}s for {args.turns} turns")
+    print(
+        f"{args.sessions} sessions: {elapsed:.2f}s, {finished} finished, "
+        f"{events / elapsed:.0f} events/s, slowest {max(t for t, _ in results):.2f}s"
+    )
+    print(f"waiting for a human reply meanwhile: {waiting}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--waiting", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,83 @@
+# Runs a batch of sessions through ShardedRunner with 1, 2 and 4 worker processes.
+# The stub client spends CPU time on every request (like tokenizing and JSON handling
+# a large prompt would), so one process is CPU-bound and more workers help as long
+# as there are CPU cores for them.
+#
+#   python benchmarks/sharding.py --problems 64 --cpu-ms 5 --workers 1 2 4
+
+import argparse
+import collections
+import hashlib
+import os
+import time
+
+from common import StubClient
+
+from mar_ps import Message, Model, ShardedRunner, Team, system
+
+
+class CPUStubClient(StubClient):
+    def __init__(self, host: str, cpu_ms: float, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.cpu_ms = cpu_ms
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        end = time.perf_counter() + self.cpu_ms / 1000
+        digest = b""
+        while time.perf_counter() < end:
+            digest = hashlib.sha256(digest).digest()
+        return await super().get_chat_completion(messages, model_id, options)
+
+
+def setup(mar):
+    for entity in mar.entities:
+        entity.message_stack.append(
+            Message(system, entity, f"You are {entity.id}. Your team: Expert 0, Expert 1.")
+        )
+
+
+def make_team(host: str) -> Team:
+    # Called in each worker with that worker's host. A real team would create an
+    # OllamaClient(host) here.
+    client = CPUStubClient(
+        host, float(os.environ.get("CPU_MS", "5")), latency=0.01, seed=1
+    )
+    team = Team(Model("stub", client), setup=setup)
+    team.Entity("Expert 0", "an expert")
+    team.Entity("Expert 1", "another expert")
+    return team
+
+
+def main(args):
+    os.environ["CPU_MS"] = str(args.cpu_ms)
+    problems = [f"Problem {i}" for i in range(args.problems)]
+    print(f"{'workers':>8} {'assignment':>11} {'elapsed':>9} {'problems/s':>11}  per worker")
+    for workers in args.workers:
+        for assignment in ["hash", "load"]:
+            hosts = [f"http://host-{i}:11434" for i in range(workers)]
+            runner = ShardedRunner(
+                make_team, hosts, assignment=assignment, max_sessions=args.max_sessions
+            )
+            with runner:
+                start = time.perf_counter()
+                results = runner.start_batch(
+                    problems, "Expert 0", sender="Expert 1", max_turns=args.turns
+                )
+                elapsed = time.perf_counter() - start
+            assert all(result.error == None for result in results), results
+            counts = collections.Counter(result.worker for result in results)
+            print(
+                f"{workers:>8} {assignment:>11} {elapsed:>8.2f}s {len(results) / elapsed:>11.1f}"
+                f"  {[counts[worker] for worker in range(workers)]}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--cpu-ms", type=float, default=5)
+    parser.add_argument("--max-sessions", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    main(parser.parse_args())
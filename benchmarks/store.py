@@ -0,0 +1,88 @@
+# Runs a conversation with and without a ConversationStore to measure the cost of
+# saving every round, then stops a stored conversation halfway, reopens the log in
+# a new MAR and resumes it. Checks that the resumed stacks match an uninterrupted
+# run and that no model call was repeated, and reports how long opening the log and
+# loading the stacks took.
+#
+#   python benchmarks/store.py --team-size 4 --turns 2000
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import StubClient, build_team
+
+from mar_ps import ConversationStore, Message
+
+
+def stacks(mar):
+    return [
+        [(m.sender.id, m.recipient.id, m.content) for m in entity.message_stack]
+        for entity in mar.entities
+    ]
+
+
+async def conversation(turns: int, args, store=None):
+    client = StubClient()
+    mar = build_team(client, size=args.team_size, store=store, event_sink=None)
+    start = time.perf_counter()
+    await mar.run(
+        Message(mar.entities[1], mar.entities[0], "Solve it."), max_turns=turns
+    )
+    return mar, client, time.perf_counter() - start
+
+
+async def main(args):
+    directory = tempfile.mkdtemp()
+    reference, _, plain_time = await conversation(args.turns, args)
+    path = os.path.join(directory, "full.jsonl")
+    _, _, stored_time = await conversation(args.turns, args, ConversationStore(path))
+    print(f"without store: {args.turns / plain_time:.0f} turns/s")
+    print(
+        f"with store:    {args.turns / stored_time:.0f} turns/s, "
+        f"{os.path.getsize(path)} bytes of log, "
+        f"{os.path.getsize(path + '.idx')} bytes of index"
+    )
+
+    path = os.path.join(directory, "resumed.jsonl")
+    mar, first_client, _ = await conversation(
+        args.turns // 2, args, ConversationStore(path)
+    )
+    mar.store.close()
+
+    start = time.perf_counter()
+    store = ConversationStore(path)
+    opened = time.perf_counter() - start
+    client = StubClient()
+    # The stub numbers its replies, so it continues from the first run's count.
+    client.calls = first_client.calls
+    mar = build_team(
+        client, size=args.team_size, system_prompts=False, store=store, event_sink=None
+    )
+    start = time.perf_counter()
+    mar.entities[0].message_stack
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for entity in mar.entities:
+        entity.message_stack
+    rest = time.perf_counter() - start
+    print(
+        f"reopen:        {opened * 1000:.1f}ms to open, {first * 1000:.1f}ms for the "
+        f"first stack, {rest * 1000:.1f}ms for the others"
+    )
+
+    turns = await mar.resume(max_turns=args.turns - store.turn)
+    assert stacks(mar) == stacks(reference), "resumed conversation differs"
+    print(
+        f"resumed:       {turns} turns after {store.turn - turns}, "
+        f"{client.calls - first_client.calls} model calls"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--team-size", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
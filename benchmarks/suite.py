@@ -0,0 +1,250 @@
+# Runs MAR conversations with stub clients over a matrix of client behaviours, team
+# sizes, conversation lengths and pinned-message counts, and reports for each:
+#
+#   turns/s        conversation turns per second of wall time
+#   p50/p99 us     per-turn orchestration overhead: the time a turn took minus the
+#                  latency the stub client injected during it
+#   peak KB        peak traced Python memory (measured in a second, traced run)
+#   block ms       the longest the event loop went without running a ready callback
+#
+# Each timed metric is the best of --repeat runs, since interference from the rest
+# of the machine only ever makes a run slower. Results can be saved as a
+# baseline and later runs compared against it. Comparing exits with status 1 if any
+# metric got worse by more than its noise margin (see METRICS), or by more than
+# --tolerance if that is given. The suite also exits with status 1 if the
+# p50 overhead of the longest conversations is more than --max-growth above that of
+# the shortest, since per-turn work should not grow with the history.
+#
+#   python benchmarks/suite.py --save-baseline benchmarks/baseline.json
+#   python benchmarks/suite.py --baseline benchmarks/baseline.json
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+from common import StubClient, build_team
+
+from mar_ps import EntityName, Message, SpanExporter, Tracer
+
+CLIENTS = {
+    "fixed": {"latency": 0.0},
+    "jittered": {"latency": 0.002, "jitter": 0.002},
+    "errors": {"latency": 0.0, "error_rate": 0.2},
+}
+
+# Metric name, whether a larger value is better, the smallest absolute change that
+# counts as a regression and the smallest relative one. A change has to exceed both.
+# Each pair is just above the largest difference seen between five runs of the whole
+# suite on a single-CPU machine: turns/s fell by up to 40%, p50 overhead rose by up to
+# 75% (220 us), p99 overhead by up to 230% (2.7 ms, with jittered latency), peak
+# memory by under 3 KB, and the longest block by up to 8 ms (with jittered latency).
+METRICS = [
+    ("turns_per_s", True, 0.0, 0.45),
+    ("p50_overhead_us", False, 100.0, 0.8),
+    ("p99_overhead_us", False, 500.0, 2.5),
+    ("peak_kb", False, 16.0, 0.05),
+    ("max_block_ms", False, 10.0, 1.0),
+]
+# The smallest p50 overhead increase from the shortest to the longest conversations
+# that counts as growth. Between the same runs, it was up to 230 us, or 64%.
+GROWTH_NOISE_US = 250.0
+
+
+class TimedStubClient(StubClient):
+    # Adds up the latency injected for each entity, so it can be subtracted from the
+    # entity's turn. An entity never has two turns running at once.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.injected: dict[str, float] = {}
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        start = time.perf_counter()
+        response = await super().get_chat_completion(messages, model_id, options)
+        entity = messages[0]["content"][8 : messages[0]["content"].find(".")]
+        self.injected[entity] = (
+            self.injected.get(entity, 0.0) + time.perf_counter() - start
+        )
+        return response
+
+
+class OverheadExporter(SpanExporter):
+    def __init__(self, client: TimedStubClient):
+        self.client = client
+        self.overheads = []
+
+    def on_start(self, span):
+        if span.name == "turn":
+            self.client.injected[span.attributes["entity"]] = 0.0
+
+    def on_end(self, span):
+        if span.name == "turn":
+            injected = self.client.injected.get(span.attributes["entity"], 0.0)
+            self.overheads.append(span.duration - injected)
+
+
+async def watch_loop(interval: float, lags: list):
+    # Measures how late each short sleep wakes up. The lateness is time the loop spent
+    # running other callbacks without yielding.
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def conversation(client_name: str, team_size: int, turns: int, pinned: int):
+    client = TimedStubClient(**CLIENTS[client_name], seed=1)
+    exporter = OverheadExporter(client)
+    mar = build_team(client, size=team_size, tracer=Tracer([exporter]))
+    pinner = EntityName("Instruction Giver", pin_to_all_models=True)
+    for i in range(pinned):
+        message = Message(pinner, mar.entities[0], f"Fact {i}: " + "background " * 30)
+        message.pinned_to_all = True
+        for entity in mar.entities:
+            entity.message_stack.append(message)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ran = await mar.run(
+            Message(EntityName("Instruction Giver"), mar.entities[0], "Solve it."),
+            max_turns=turns,
+        )
+    return ran, exporter.overheads
+
+
+async def measure(
+    client_name: str, team_size: int, turns: int, pinned: int, repeat: int
+) -> dict:
+    runs = []
+    for _ in range(repeat):
+        lags = []
+        watcher = asyncio.ensure_future(watch_loop(0.001, lags))
+        start = time.perf_counter()
+        ran, overheads = await conversation(client_name, team_size, turns, pinned)
+        elapsed = time.perf_counter() - start
+        watcher.cancel()
+        overheads.sort()
+        runs.append(
+            {
+                "turns_per_s": ran / elapsed,
+                "p50_overhead_us": statistics.median(overheads) * 1e6,
+                "p99_overhead_us": overheads[max(int(len(overheads) * 0.99) - 1, 0)]
+                * 1e6,
+                "max_block_ms": max(lags, default=0.0) * 1000,
+            }
+        )
+
+    tracemalloc.start()
+    await conversation(client_name, team_size, turns, pinned)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        metric: (max if higher_is_better else min)(run[metric] for run in runs)
+        for metric, higher_is_better, _, _ in METRICS
+        if metric in runs[0]
+    }
+    result["peak_kb"] = peak / 1024
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: Optional[float]) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric, higher_is_better, noise, metric_tolerance in METRICS:
+            old, new = baseline[key][metric], result[metric]
+            if abs(new - old) <= noise:
+                continue
+            change = (new - old) / old if old else 0.0
+            limit = metric_tolerance if tolerance == None else tolerance
+            if (-change if higher_is_better else change) > limit:
+                regressions.append(
+                    f"{key} {metric}: {old:.1f} -> {new:.1f} ({change:+.0%})"
+                )
+    return regressions
+
+
+def growth(by_turns: dict, max_growth: float) -> list[str]:
+    # Compares the p50 overhead of the longest and the shortest conversations of each
+    # configuration.
+    problems = []
+    for config, results in by_turns.items():
+        if len(results) < 2:
+            continue
+        short, long = min(results), max(results)
+        old = results[short]["p50_overhead_us"]
+        new = results[long]["p50_overhead_us"]
+        if new - old > GROWTH_NOISE_US and new > old * (1 + max_growth):
+            problems.append(
+                f"{config} p50_overhead_us: {old:.1f} at {short} turns -> "
+                f"{new:.1f} at {long} turns"
+            )
+    return problems
+
+
+async def main(args):
+    results = {}
+    by_turns = {}
+    print(
+        f"{'config':>36} {'turns/s':>9} {'p50 us':>8} {'p99 us':>8} "
+        f"{'peak KB':>9} {'block ms':>9}"
+    )
+    for client_name, team_size, turns, pinned in itertools.product(
+        args.clients, args.team_sizes, args.turns, args.pinned
+    ):
+        key = f"{client_name}/team={team_size}/turns={turns}/pinned={pinned}"
+        result = await measure(client_name, team_size, turns, pinned, args.repeat)
+        results[key] = result
+        config = f"{client_name}/team={team_size}/pinned={pinned}"
+        by_turns.setdefault(config, {})[turns] = result
+        print(
+            f"{key:>36} {result['turns_per_s']:>9.0f} {result['p50_overhead_us']:>8.0f} "
+            f"{result['p99_overhead_us']:>8.0f} {result['peak_kb']:>9.0f} "
+            f"{result['max_block_ms']:>9.1f}"
+        )
+
+    failed = False
+    problems = growth(by_turns, args.max_growth)
+    for problem in problems:
+        print(f"GROWTH {problem}")
+    if problems:
+        failed = True
+    if args.save_baseline and not problems:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.save_baseline}.")
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            failed = True
+        else:
+            print(f"No regressions against {args.baseline}.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", nargs="+", choices=CLIENTS, default=list(CLIENTS))
+    parser.add_argument("--team-sizes", type=int, nargs="+", default=[2, 8])
+    parser.add_argument("--turns", type=int, nargs="+", default=[50, 300])
+    parser.add_argument("--pinned", type=int, nargs="+", default=[0, 20])
+    parser.add_argument("--baseline", help="compare against this baseline file")
+    parser.add_argument("--save-baseline", help="save the results to this file")
+    parser.add_argument(
+        "--tolerance", type=float, help="use this relative tolerance for every metric"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-growth", type=float, default=0.75)
+    asyncio.run(main(parser.parse_args()))
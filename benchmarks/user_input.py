@@ -0,0 +1,80 @@
+# Runs machine-only sessions next to one session whose human takes `--think` seconds
+# to answer each message, with a synchronous input handler. The handler runs once in
+# its own thread (the default) and once directly on the event loop (wrapped in an
+# async function), as it did before. Reports the machine sessions' turns per second and
+# the longest event loop stall.
+#
+#   python benchmarks/user_input.py --sessions 20 --turns 50 --think 0.2
+
+import argparse
+import asyncio
+import time
+
+from common import StubClient, build_team
+
+from mar_ps import Message
+
+
+async def watch_loop(stalls: list[float], interval: float = 0.005):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stalls.append(time.perf_counter() - start - interval)
+
+
+async def run(args, on_loop: bool) -> tuple[float, float]:
+    client = StubClient(latency=args.latency)
+
+    def think() -> str:
+        time.sleep(args.think)
+        return "Keep going."
+
+    async def think_on_loop() -> str:
+        return think()
+
+    human = build_team(client, size=1, event_sink=None)
+    user = human.Entity("Human", "the user", is_user=True)
+    human_run = asyncio.ensure_future(
+        human.entities[0].send(
+            "Ask me anything.",
+            user,
+            max_turns=args.turns,
+            user_input_handler=think_on_loop if on_loop else think,
+        )
+    )
+    teams = [
+        build_team(client, size=2, event_sink=None) for _ in range(args.sessions)
+    ]
+    stalls = []
+    watcher = asyncio.ensure_future(watch_loop(stalls))
+    start = time.perf_counter()
+    turns = await asyncio.gather(
+        *[
+            mar.run(
+                Message(mar.entities[1], mar.entities[0], "Solve it."),
+                max_turns=args.turns,
+            )
+            for mar in teams
+        ]
+    )
+    elapsed = time.perf_counter() - start
+    watcher.cancel()
+    human_run.cancel()
+    await asyncio.gather(human_run, return_exceptions=True)
+    return sum(turns) / elapsed, max(stalls)
+
+
+async def main(args):
+    print(f"{'handler':>10} {'turns/s':>8} {'max stall':>10}")
+    for name, on_loop in [("on loop", True), ("thread", False)]:
+        throughput, stall = await run(args, on_loop)
+        print(f"{name:>10} {throughput:>8.0f} {stall * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--think", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
@@ -5,12 +5,16 @@ from mar_ps import (
     OpenAIClient,
     Model,
     MAR,
+    FinalAnswer,
+    PingPong,
 )
 
 
 ollama_client = OllamaClient()
 lm_studio_client = OpenAIClient("http://localhost:1234/v1/")  # For LM Studio
-mar = MAR()
+# Stop when the team messages the competition manager, or when two experts just keep
+# repeating themselves.
+mar = MAR(stop_policies=[FinalAnswer(), PingPong()])
 
 
 def init_entities(pinned_messages: list[Message] = [], include_user: bool = False):
@@ -95,7 +99,9 @@ mar.start(
         user,
         # print_all_messages=True,
     )
-)  # Once you send a message, it starts a chain that keeps going indefinitely.
+)  # Once you send a message, it starts a chain that keeps going until a stop policy fires.
+# The reply that stopped the run isn't delivered, so the answer is shown from the result.
+print(f"{mar.result.reason} after {mar.result.turns} turns: {mar.result.answer}")
 # If you want it to act like o1, tell it that it is on a team of experts and they must work together to solve the problem
 # How many of the letter r is in the word "revolutionary"? How many is in the word "strawberry"? Carefully lay out each individual letter and count. Reflect on your counting and try again.
 # You have to make sure the team doesn't refine forever. They have to finish the competition in a reasonable amount of time.
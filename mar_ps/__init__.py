@@ -1,8 +1,34 @@
 #### Multi-Agent Reasoning Problem Solver
 
 
-from typing import Union, Literal, Optional, TypedDict, Any, Callable
+from typing import Union, Literal, Optional, TypedDict, Any, Callable, AsyncIterator
+from collections import deque, OrderedDict
 import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import difflib
+import gzip
+import hashlib
+import inspect
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import weakref
+import httpx
 import openai
 import ollama
 
@@ -11,25 +37,178 @@ import ollama
 # openai = None
 
 
-Messages = []
-
-
 class MessageDict(TypedDict):
     role: Literal["user", "assistant", "system", "tool"]
     content: str
 
 
+class AdmissionController:
+    # Limits how many requests a backend serves at once (in total and per model) and,
+    # for hosted APIs, how fast they are sent (a token bucket of `rate` requests per
+    # second, allowing bursts of `burst`). Waiting requests are admitted round-robin
+    # across requesters (entities), so one busy entity can't starve the others.
+
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        max_in_flight_per_model: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: int = 1,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_model = max_in_flight_per_model
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.in_flight_by_model: dict[str, int] = {}
+        self.waiting: dict[str, "deque[tuple[str, asyncio.Future, float]]"] = {}
+        self.turns: "deque[str]" = deque()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate != None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.refilled_at) * self.rate
+            )
+        self.refilled_at = now
+
+    def _can_admit(self, model_id: str) -> bool:
+        if self.max_in_flight != None and self.in_flight >= self.max_in_flight:
+            return False
+        if (
+            self.max_in_flight_per_model != None
+            and self.in_flight_by_model.get(model_id, 0)
+            >= self.max_in_flight_per_model
+        ):
+            return False
+        return self.rate == None or self.tokens >= 1
+
+    def _admit(self, model_id: str, waited: float):
+        self.in_flight += 1
+        self.in_flight_by_model[model_id] = self.in_flight_by_model.get(model_id, 0) + 1
+        if self.rate != None:
+            self.tokens -= 1
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def _dispatch(self):
+        self._refill()
+        # Give each requester with waiting requests a turn, in round-robin order.
+        checked = 0
+        while self.turns and checked < len(self.turns):
+            requester = self.turns[0]
+            model_id, future, enqueued = self.waiting[requester][0]
+            if not self._can_admit(model_id):
+                self.turns.rotate(-1)
+                checked += 1
+                continue
+            self.waiting[requester].popleft()
+            self.queue_depth -= 1
+            self.turns.popleft()
+            if self.waiting[requester]:
+                self.turns.append(requester)
+            else:
+                del self.waiting[requester]
+            self._admit(model_id, time.monotonic() - enqueued)
+            future.set_result(None)
+            checked = 0
+        if self.turns and self.rate != None and self.tokens < 1 and self.timer == None:
+            # Wake up when the bucket has a token again.
+            self.timer = asyncio.get_running_loop().call_later(
+                (1 - self.tokens) / self.rate, self._on_timer
+            )
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    async def acquire(self, model_id: str, requester: str = ""):
+        self._refill()
+        if not self.turns and self._can_admit(model_id):
+            self._admit(model_id, 0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (model_id, future, time.monotonic())
+        if requester not in self.waiting:
+            self.waiting[requester] = deque()
+            self.turns.append(requester)
+        self.waiting[requester].append(entry)
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as it was cancelled, give the slot back.
+                self.release(model_id)
+            elif entry in self.waiting.get(requester, ()):
+                self.waiting[requester].remove(entry)
+                self.queue_depth -= 1
+                if not self.waiting[requester]:
+                    del self.waiting[requester]
+                    self.turns.remove(requester)
+            raise
+
+    def release(self, model_id: str):
+        self.in_flight -= 1
+        self.in_flight_by_model[model_id] -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model_id: str, requester: str = ""):
+        await self.acquire(model_id, requester)
+        try:
+            yield
+        finally:
+            self.release(model_id)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "average_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
 class Client:
+    # If set, every request made through a Model on this client waits for admission.
+    admission: Optional[AdmissionController] = None
 
     async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
         return "none"
 
+    async def stream_chat_completion(
+        self, messages, model_id: str, options={}
+    ) -> AsyncIterator[str]:
+        # Clients without streaming support yield the whole completion at once.
+        yield await self.get_chat_completion(messages, model_id, options)
+
+    async def warmup(self, model_id: str):
+        # Loads `model_id` ahead of the first request, where the backend supports it.
+        pass
+
 
 class OpenAIClient(Client):
     def __init__(
         self,
         base_url: Optional[str] = None,
         api_key: Optional[str] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: float = 30.0,
         **kwargs,
     ):
         # global openai
@@ -41,12 +220,26 @@ class OpenAIClient(Client):
         #             "OpenAI API client not found. You may be able to fix this by running `pip install openai`"
         #         )
 
-        self.openai = openai.OpenAI(api_key=api_key, base_url=base_url, **kwargs)
+        # One pooled HTTP client per OpenAIClient, shared by every model and entity using it.
+        # Each OpenAIClient talks to a single base_url, so this bounds connections per host.
+        if kwargs.get("http_client") == None:
+            kwargs["http_client"] = openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=(
+                        max_keepalive_connections
+                        if max_keepalive_connections != None
+                        else max_connections
+                    ),
+                    keepalive_expiry=keepalive_expiry,
+                )
+            )
+        self.openai = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, **kwargs)
 
     async def get_chat_completion(
         self, messages, model_id: str = "gpt-4o-mini", options={}
     ):
-        chat_completion = self.openai.chat.completions.create(
+        chat_completion = await self.openai.chat.completions.create(
             model=model_id,
             messages=messages,
             stop=["From:", "\nTo:"],
@@ -54,10 +247,40 @@ class OpenAIClient(Client):
         )
         return chat_completion.choices[0].message.content or ""
 
+    async def stream_chat_completion(
+        self, messages, model_id: str = "gpt-4o-mini", options={}
+    ) -> AsyncIterator[str]:
+        stream = await self.openai.chat.completions.create(
+            model=model_id,
+            messages=messages,
+            stop=["From:", "\nTo:"],
+            stream=True,
+            **options,
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+    async def close(self):
+        await self.openai.close()
+
 
 class OllamaClient(Client):
-    def __init__(self, host: Optional[str] = None, **kwargs):
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        use_mmap: bool = False,
+        logits_all: bool = True,
+        keep_alive: Union[float, str, None] = None,
+        **kwargs,
+    ):
         self.ollama = ollama.AsyncClient(host, **kwargs)
+        self.use_mmap = use_mmap
+        self.logits_all = logits_all
+        self.keep_alive = keep_alive
         # global ollama
         # if ollama == None:
         #     try:
@@ -73,79 +296,1914 @@ class OllamaClient(Client):
         response = await self.ollama.chat(
             model_id,
             messages,
-            options={
-                "temperature": options.get("temperature", 0.8),
-                "stop": ["From:", "\nTo:"],
-                "use_mmap": False,
-                "logits_all": True,
-            },
+            options=self._options(options),
             stream=False,
+            keep_alive=self.keep_alive,
         )
         return response["message"]["content"]
 
+    async def stream_chat_completion(
+        self, messages, model_id: str = "gpt-4o-mini", options={}
+    ) -> AsyncIterator[str]:
+        stream = await self.ollama.chat(
+            model_id,
+            messages,
+            options=self._options(options),
+            stream=True,
+            keep_alive=self.keep_alive,
+        )
+        try:
+            async for part in stream:
+                if part["message"]["content"]:
+                    yield part["message"]["content"]
+        finally:
+            await stream.aclose()
+
+    async def warmup(self, model_id: str):
+        # A request without a prompt just loads the model.
+        await self.ollama.generate(model=model_id, keep_alive=self.keep_alive)
+
+    def _options(self, options: dict) -> dict:
+        return {
+            "temperature": options.get("temperature", 0.8),
+            "stop": ["From:", "\nTo:"],
+            "use_mmap": options.get("use_mmap", self.use_mmap),
+            "logits_all": options.get("logits_all", self.logits_all),
+        }
+
+
+def request_key(model_id: str, messages: list[MessageDict], options={}) -> str:
+    # A deterministic key for a chat completion request. Only the role and content of
+    # each message are used, with line endings and trailing whitespace normalized.
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "model": model_id,
+                "messages": [
+                    {
+                        "role": message["role"],
+                        "content": message["content"].replace("\r\n", "\n").rstrip(),
+                    }
+                    for message in messages
+                ],
+                "options": options,
+            },
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+
+class ResponseCache:
+    # Stores completions by request key: an in-memory LRU tier and, if `path` is
+    # given, an SQLite tier on disk that survives between runs. Both tiers are bounded
+    # by entry count and `ttl` (seconds). From async code, use `lookup` and `store`,
+    # which run the SQLite work in the cache's own thread instead of on the event
+    # loop. Disk writes are committed in batches, at least every `commit_interval`
+    # seconds, and when the cache is closed.
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        path: Optional[str] = None,
+        max_disk_entries: Optional[int] = 100000,
+        ttl: Optional[float] = None,
+        commit_interval: float = 1.0,
+    ):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.commit_interval = commit_interval
+        self.memory: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.db = None
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # The SQLite connection is used by the executor's thread and by direct calls
+        # to `get` and `put`, one at a time.
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+        if path != None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used ON responses (used)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created ON responses (created)"
+            )
+            self.db.commit()
+            self.disk_entries = self.db.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        response = self._get_memory(key)
+        if response == None and self.db != None:
+            response = self._from_disk(key, self._get_disk(key))
+        return self._counted(response)
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        self._remember(key, now, response)
+        if self.db != None:
+            self._put_disk(key, response, now)
+
+    async def lookup(self, key: str) -> Optional[str]:
+        # Like `get`, but a disk lookup doesn't block the event loop.
+        response = self._get_memory(key)
+        if response == None and self.db != None:
+            response = self._from_disk(key, await self._in_thread(self._get_disk, key))
+        return self._counted(response)
+
+    async def store(self, key: str, response: str):
+        # Like `put`, but the disk write doesn't block the event loop.
+        now = time.time()
+        self._remember(key, now, response)
+        if self.db != None:
+            await self._in_thread(self._put_disk, key, response, now)
+
+    async def _in_thread(self, func, *args):
+        if self.executor == None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="mar_ps-cache"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self.memory.get(key)
+        if entry != None and (self.ttl == None or time.time() - entry[0] <= self.ttl):
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry != None:
+            del self.memory[key]
+        return None
+
+    def _counted(self, response: Optional[str]) -> Optional[str]:
+        if response == None:
+            self.misses += 1
+        return response
+
+    def _from_disk(
+        self, key: str, row: Optional[tuple[str, float]]
+    ) -> Optional[str]:
+        if row == None:
+            return None
+        self._remember(key, row[1], row[0])
+        self.hits += 1
+        self.disk_hits += 1
+        return row[0]
+
+    def _get_disk(self, key: str) -> Optional[tuple[str, float]]:
+        # Runs in the cache's thread when called from `lookup`, so it only touches
+        # the database.
+        now = time.time()
+        with self.lock:
+            if self.db == None:
+                return None
+            row = self.db.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row == None or (self.ttl != None and now - row[1] > self.ttl):
+                return None
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            self._written()
+        return row
+
+    def _put_disk(self, key: str, response: str, now: float):
+        with self.lock:
+            db = self.db
+            if db == None:
+                return  # Closed while the write was queued.
+            if db.execute(
+                "UPDATE responses SET response = ?, created = ?, used = ? WHERE key = ?",
+                (response, now, now, key),
+            ).rowcount == 0:
+                db.execute(
+                    "INSERT INTO responses VALUES (?, ?, ?, ?)",
+                    (key, response, now, now),
+                )
+                self.disk_entries += 1
+            if self.ttl != None:
+                self.disk_entries -= db.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                ).rowcount
+            if (
+                self.max_disk_entries != None
+                and self.disk_entries > self.max_disk_entries
+            ):
+                # Evict a tenth of the limit at once, so this doesn't run every put.
+                evict = self.disk_entries - self.max_disk_entries * 9 // 10
+                self.disk_entries -= db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used LIMIT ?)",
+                    (evict,),
+                ).rowcount
+            self._written()
+
+    def _written(self):
+        self.uncommitted += 1
+        if time.monotonic() - self.committed_at >= self.commit_interval:
+            self._commit()
+
+    def _commit(self):
+        if self.uncommitted:
+            self.db.commit()
+            self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def _remember(self, key: str, created: float, response: str):
+        self.memory[key] = (created, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def flush(self):
+        # Commits the disk writes that are still pending.
+        if self.db != None:
+            with self.lock:
+                self._commit()
+
+    def clear(self):
+        self.memory.clear()
+        if self.db != None:
+            with self.lock:
+                self.db.execute("DELETE FROM responses")
+                self.disk_entries = 0
+                self.uncommitted += 1
+                self._commit()
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.db != None:
+            with self.lock:
+                self._commit()
+                self.db.close()
+                self.db = None
+
+
+class CachingClient(Client):
+    # Wraps another client and serves repeated requests from a ResponseCache. Requests
+    # with a temperature above zero (or none given, since backends default to sampling)
+    # are not cached unless `force` is set.
+
+    def __init__(self, client: Client, cache: ResponseCache, force: bool = False):
+        self.client = client
+        self.cache = cache
+        self.force = force
+
+    @property
+    def admission(self) -> Optional[AdmissionController]:
+        # The wrapped client's, so limits set on it apply through this one too.
+        return self.client.admission
+
+    @admission.setter
+    def admission(self, admission: Optional[AdmissionController]):
+        self.client.admission = admission
+
+    def cacheable(self, options: dict) -> bool:
+        return self.force or options.get("temperature", 1) <= 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        if not self.cacheable(options):
+            self.cache.bypassed += 1
+            return await self.client.get_chat_completion(messages, model_id, options)
+        key = request_key(model_id, messages, options)
+        response = await self.cache.lookup(key)
+        if response == None:
+            response = await self.client.get_chat_completion(
+                messages, model_id, options
+            )
+            await self.cache.store(key, response)
+        return response
+
+    async def stream_chat_completion(
+        self, messages, model_id: str, options={}
+    ) -> AsyncIterator[str]:
+        key = None
+        if not self.cacheable(options):
+            self.cache.bypassed += 1
+        else:
+            key = request_key(model_id, messages, options)
+            response = await self.cache.lookup(key)
+            if response != None:
+                yield response
+                return
+        deltas = []
+        stream = self.client.stream_chat_completion(messages, model_id, options)
+        try:
+            async for delta in stream:
+                deltas.append(delta)
+                yield delta
+        finally:
+            await stream.aclose()
+        # Only reached if the stream was read to the end, so aborted responses are not stored.
+        if key != None:
+            await self.cache.store(key, "".join(deltas))
+
+    async def warmup(self, model_id: str):
+        await self.client.warmup(model_id)
+
+
+def _open_recording(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class RecordingClient(Client):
+    # Wraps another client and appends every request and its response to a JSON Lines
+    # file (gzip-compressed if the path ends in ".gz"), to be served back by a
+    # ReplayClient. Requests are stored as their `request_key`, and only with their
+    # messages if `include_messages` is set.
+
+    def __init__(self, client: Client, path: str, include_messages: bool = False):
+        self.client = client
+        self.path = path
+        self.include_messages = include_messages
+        self.file = _open_recording(path, "a")
+        self.recorded = 0
+
+    @property
+    def admission(self) -> Optional[AdmissionController]:
+        # The wrapped client's, so limits set on it apply through this one too.
+        return self.client.admission
+
+    @admission.setter
+    def admission(self, admission: Optional[AdmissionController]):
+        self.client.admission = admission
+
+    def record(
+        self,
+        messages,
+        model_id: str,
+        options: dict,
+        response: str,
+        deltas: Optional[list[str]] = None,
+    ):
+        entry = {
+            "key": request_key(model_id, messages, options),
+            "model": model_id,
+            "response": response,
+        }
+        if deltas != None and len(deltas) > 1:
+            entry["deltas"] = deltas
+        if self.include_messages:
+            entry["messages"] = messages
+            entry["options"] = options
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.recorded += 1
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        response = await self.client.get_chat_completion(messages, model_id, options)
+        self.record(messages, model_id, options, response)
+        return response
+
+    async def stream_chat_completion(
+        self, messages, model_id: str, options={}
+    ) -> AsyncIterator[str]:
+        # The deltas are recorded as they arrived, because where a stream is split
+        # decides where an entity aborts an invalid response. Streams that are closed
+        # early are recorded as far as they got.
+        deltas = []
+        stream = self.client.stream_chat_completion(messages, model_id, options)
+        try:
+            async for delta in stream:
+                deltas.append(delta)
+                yield delta
+        finally:
+            await stream.aclose()
+            self.record(messages, model_id, options, "".join(deltas), deltas)
+
+    async def warmup(self, model_id: str):
+        await self.client.warmup(model_id)
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayClient(Client):
+    # Serves the responses recorded by a RecordingClient without calling any model.
+    # Requests are matched by `request_key`, so concurrent turns may be replayed in any
+    # order. A request recorded several times gets its responses in recorded order,
+    # then the last one again. Unrecorded requests go to `fallback`, or raise LookupError.
+    # Streams are replayed in their recorded deltas. Responses recorded without deltas
+    # are streamed in pieces of `chunk_size` characters, or whole.
+
+    def __init__(
+        self,
+        path: str,
+        fallback: Optional[Client] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        self.fallback = fallback
+        self.chunk_size = chunk_size
+        self.responses: dict[str, deque[list[str]]] = {}
+        with _open_recording(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses.setdefault(entry["key"], deque()).append(
+                        entry.get("deltas") or [entry["response"]]
+                    )
+        self.replayed = 0
+        self.missed = 0
+
+    def lookup(self, messages, model_id: str, options: dict) -> Optional[list[str]]:
+        responses = self.responses.get(request_key(model_id, messages, options))
+        if not responses:
+            self.missed += 1
+            if self.fallback == None:
+                raise LookupError(
+                    f"No recorded response for this request to {model_id} ({len(messages)} messages)."
+                )
+            return None
+        self.replayed += 1
+        return responses.popleft() if len(responses) > 1 else responses[0]
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        deltas = self.lookup(messages, model_id, options)
+        if deltas == None:
+            return await self.fallback.get_chat_completion(messages, model_id, options)
+        return "".join(deltas)
+
+    async def stream_chat_completion(
+        self, messages, model_id: str, options={}
+    ) -> AsyncIterator[str]:
+        deltas = self.lookup(messages, model_id, options)
+        if deltas == None:
+            stream = self.fallback.stream_chat_completion(messages, model_id, options)
+            try:
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+            return
+        if len(deltas) > 1 or not self.chunk_size:
+            for delta in deltas:
+                yield delta
+            return
+        for i in range(0, len(deltas[0]), self.chunk_size):
+            yield deltas[0][i : i + self.chunk_size]
+
+
+class CircuitBreaker:
+    # Stops sending requests to a backend after `failure_threshold` failures in a row.
+    # After `reset_after` seconds one trial request is let through. If it succeeds the
+    # circuit closes again, otherwise it stays open for another `reset_after` seconds.
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.state: Literal["closed", "open", "half-open"] = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_after:
+            self.state = "half-open"
+            return True
+        return False
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class ResilientClient(Client):
+    # Wraps another client with per-request timeouts, retries with exponential backoff
+    # and jitter, optional hedging to a `fallback` model, and a circuit breaker that
+    # sends requests straight to the fallback while the primary backend is failing.
+
+    def __init__(
+        self,
+        client: Client,
+        fallback: Optional["Model"] = None,
+        timeout: Optional[float] = 300.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        jitter: float = 0.5,
+        hedge_after: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        retry_on: tuple[type[BaseException], ...] = (Exception,),
+    ):
+        self.client = client
+        self.fallback = fallback
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.hedge_after = hedge_after
+        self.breaker = breaker if breaker != None else CircuitBreaker()
+        self.retry_on = retry_on
+        self.retried = 0
+        self.hedged = 0
+        self.failed_over = 0
+
+    @property
+    def admission(self) -> Optional[AdmissionController]:
+        # The wrapped client's, so limits set on it apply through this one too.
+        return self.client.admission
+
+    @admission.setter
+    def admission(self, admission: Optional[AdmissionController]):
+        self.client.admission = admission
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        error: Optional[BaseException] = None
+        if self.breaker.allow():
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    self.retried += 1
+                    await asyncio.sleep(self.delay(attempt - 1))
+                try:
+                    response = await self._attempt(messages, model_id, options)
+                except self.retry_on as e:
+                    error = e
+                    self.breaker.failure()
+                    if not self.breaker.allow():
+                        break
+                else:
+                    self.breaker.success()
+                    return response
+        if self.fallback == None:
+            raise error or RuntimeError(f"Circuit open for model {model_id}")
+        self.failed_over += 1
+        return await self.fallback.generate(messages, options)
+
+    async def _attempt(self, messages, model_id: str, options: dict) -> str:
+        primary = asyncio.ensure_future(
+            asyncio.wait_for(
+                self.client.get_chat_completion(messages, model_id, options),
+                self.timeout,
+            )
+        )
+        if self.hedge_after == None or self.fallback == None:
+            return await primary
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=self.hedge_after)
+            if done:
+                return primary.result()
+            # The primary is slow: race it against the fallback, first success wins.
+            self.hedged += 1
+            pending.add(asyncio.ensure_future(self.fallback.generate(messages, options)))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() == None:
+                        return task.result()
+            return await primary  # Both failed, raise the primary's error.
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream_chat_completion(
+        self, messages, model_id: str, options={}
+    ) -> AsyncIterator[str]:
+        # Streams are retried and failed over only until their first piece arrives.
+        # After that the stream is passed through as is. Streams are not hedged.
+        error: Optional[BaseException] = None
+        if self.breaker.allow():
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    self.retried += 1
+                    await asyncio.sleep(self.delay(attempt - 1))
+                stream = self.client.stream_chat_completion(messages, model_id, options)
+                try:
+                    first = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    self.breaker.success()
+                    return
+                except self.retry_on as e:
+                    error = e
+                    await stream.aclose()
+                    self.breaker.failure()
+                    if not self.breaker.allow():
+                        break
+                    continue
+                self.breaker.success()
+                try:
+                    yield first
+                    async for delta in stream:
+                        yield delta
+                finally:
+                    await stream.aclose()
+                return
+        if self.fallback == None:
+            raise error or RuntimeError(f"Circuit open for model {model_id}")
+        self.failed_over += 1
+        async for delta in await self.fallback.generate(messages, options, stream=True):
+            yield delta
+
+    async def warmup(self, model_id: str):
+        await self.client.warmup(model_id)
+
 
 class Model:
     id: str
     client: Client
+    # Requests currently running, per client, by request key. Shared by every Model so
+    # that models with the same ID on the same client coalesce too.
+    in_flight: "weakref.WeakKeyDictionary[Client, dict[str, asyncio.Future]]" = (
+        weakref.WeakKeyDictionary()
+    )
+    # How many callers are waiting for each of those requests.
+    waiters: dict[asyncio.Future, int] = {}
+
+    def __init__(self, id: str, client: Client, coalesce: bool = True):
+
+        self.id = id
+        self.client = client
+        self.coalesce = coalesce
+        self.coalesced = 0
+
+    async def generate(
+        self,
+        messages: list["Message"],
+        options={},
+        stream: bool = False,
+        requester: str = "",
+        prompt_key: Optional[str] = None,
+    ) -> Union[str, AsyncIterator[str]]:
+        # With `stream=True`, returns an async iterator over the response deltas.
+        # `requester` identifies who is asking (the entity), for fair admission.
+        # `prompt_key` is a hash of `messages` the caller already has (an entity's
+        # prefix fingerprint), so coalescing doesn't hash the whole prompt again.
+        if stream:
+            return self._stream(messages, options, requester)
+        if not self.coalesce:
+            return await self._complete(messages, options, requester)
+        # Identical requests made while one is already running wait for its response
+        # instead of going to the backend again.
+        in_flight = Model.in_flight.setdefault(self.client, {})
+        if prompt_key != None:
+            key = f"{self.id}\0{prompt_key}\0{json.dumps(options, sort_keys=True, default=str)}"
+        else:
+            key = request_key(self.id, messages, options)
+        request = in_flight.get(key)
+        if request == None:
+            request = asyncio.ensure_future(
+                self._complete(messages, options, requester)
+            )
+            in_flight[key] = request
+            request.add_done_callback(
+                lambda _: in_flight.pop(key) if in_flight.get(key) is request else None
+            )
+        else:
+            self.coalesced += 1
+        waiters = Model.waiters
+        waiters[request] = waiters.get(request, 0) + 1
+        try:
+            # Shielded, so a cancelled caller doesn't cancel the request for the others.
+            return await asyncio.shield(request)
+        finally:
+            waiters[request] -= 1
+            if not waiters[request]:
+                del waiters[request]
+                if not request.done():
+                    # The last caller was cancelled, nobody needs the response.
+                    if in_flight.get(key) is request:
+                        del in_flight[key]
+                    request.cancel()
+
+    async def _complete(self, messages, options: dict, requester: str) -> str:
+        if self.client.admission == None:
+            return await self.client.get_chat_completion(messages, self.id, options)
+        async with self.client.admission.slot(self.id, requester):
+            return await self.client.get_chat_completion(messages, self.id, options)
+
+    async def _stream(self, messages, options: dict, requester: str) -> AsyncIterator[str]:
+        admission = self.client.admission
+        if admission != None:
+            await admission.acquire(self.id, requester)
+        try:
+            stream = self.client.stream_chat_completion(messages, self.id, options)
+            try:
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+        finally:
+            if admission != None:
+                admission.release(self.id)
+
+
+async def _single_delta(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+class Cascade:
+    # Cheaper models an entity tries, in order, before its own model. A reply from a
+    # cheap model is kept if it passes the checks: a `To:` line naming someone the
+    # entity can message, a body of `min_chars` to `max_chars` characters, and every
+    # `validators(entity, response)` returning None (they return a reason to reject
+    # otherwise). With `samples` > 1, that many replies are generated at once and kept
+    # only if they agree: same recipients, bodies at least `agreement` alike. Rejected
+    # replies are dropped and the next model gets the same prompt.
+
+    def __init__(
+        self,
+        models: list[Model],
+        min_chars: int = 1,
+        max_chars: Optional[int] = None,
+        samples: int = 1,
+        agreement: float = 0.8,
+        validators: list[Callable[["Entity", str], Optional[str]]] = [],
+    ):
+        self.models = list(models)
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.samples = samples
+        self.agreement = agreement
+        self.validators = list(validators)
+
+    def check(self, entity: "Entity", response: str) -> Optional[str]:
+        # Returns why `response` can't be used, or None if it can.
+        name, content = extract_name_and_content(response.strip(" \t\n"))
+        if name == None or "\n" not in response:
+            return "missing_recipient"
+        recipients, missing = entity._resolve_recipients(name)
+        if missing or not recipients:
+            return "unknown_recipient"
+        if len(content) < self.min_chars:
+            return "too_short"
+        if self.max_chars != None and len(content) > self.max_chars:
+            return "too_long"
+        for validator in self.validators:
+            reason = validator(entity, response)
+            if reason != None:
+                return reason
+        return None
+
+    def agree(self, responses: list[str]) -> bool:
+        first_name, first = extract_name_and_content(responses[0].strip(" \t\n"))
+        for response in responses[1:]:
+            name, content = extract_name_and_content(response.strip(" \t\n"))
+            if normalize_name(name or "") != normalize_name(first_name or ""):
+                return False
+            if (
+                content != first
+                and difflib.SequenceMatcher(None, first, content).ratio()
+                < self.agreement
+            ):
+                return False
+        return True
+
+    async def generate(
+        self, entity: "Entity", messages: list[MessageDict], options: dict, stream: bool
+    ) -> Union[str, AsyncIterator[str]]:
+        stats = entity.cascade_stats
+        stats["generations"] += 1
+        for model in self.models:
+            entity.mar._use_model(model)
+            if self.samples > 1:
+                # The extra samples differ by seed, so they aren't coalesced into one
+                # request.
+                responses = await asyncio.gather(
+                    *[
+                        model.generate(
+                            messages,
+                            {**options, "seed": i} if i else options,
+                            False,
+                            entity.id,
+                            entity.prefix_fingerprint,
+                        )
+                        for i in range(self.samples)
+                    ]
+                )
+                response = responses[0]
+                reason = self.check(entity, response)
+                if reason == None and not self.agree(responses):
+                    reason = "disagreement"
+            else:
+                response = await model.generate(
+                    messages, options, False, entity.id, entity.prefix_fingerprint
+                )
+                reason = self.check(entity, response)
+            if reason == None:
+                stats["accepted"][model.id] = stats["accepted"].get(model.id, 0) + 1
+                entity.answered_by = model
+                return _single_delta(response) if stream else response
+            stats["rejected"][reason] = stats["rejected"].get(reason, 0) + 1
+            entity.mar.emit(
+                "escalated",
+                entity=entity,
+                model=model,
+                reason=reason,
+                raw_response=response,
+            )
+        stats["escalations"] += 1
+        stats["accepted"][entity.model.id] = (
+            stats["accepted"].get(entity.model.id, 0) + 1
+        )
+        entity.mar._use_model(entity.model)
+        entity.answered_by = entity.model
+        return await entity.model.generate(
+            messages, options, stream, entity.id, entity.prefix_fingerprint
+        )
+
+
+def extract_name_and_content(message: str):
+    # Find the start index of the name, which is after 'To: '
+    start_index = message.find("To: ") + 4
+    if start_index == 3:  # 'To: ' not found
+        return None, None
+
+    # Find the index of the newline after the name
+    end_index = message.find("\n", start_index)
+    if end_index == -1:  # Only the name, e.g. a stream cut short after the To: line
+        end_index = len(message)
+
+    # Extract the name
+    name = message[start_index:end_index]
+
+    # Extract the message content (everything after the newline)
+    content = message[end_index + 1 :]  # Skip the newline character
+
+    return name.strip(), content.strip("\n\t ")
+
+
+class ResponseStream:
+    # Accumulates a streamed response and parses the To: header as soon as its line is
+    # complete, so the recipient is known before generation finishes. The header is
+    # found the way `extract_name_and_content` finds it: the first "To: " anywhere.
+
+    def __init__(self):
+        self.text = ""
+        self.recipient_name: Optional[str] = None
+        self.header_complete = False
+        self._header_start = -1
+        self._searched = 0
+        self._body_start = 0
+        self._body_sent = 0
+
+    @property
+    def missing_header(self) -> bool:
+        # True while the text so far has no "To: ". It may still come later.
+        return self._header_start == -1
+
+    def feed(self, delta: str) -> str:
+        # Adds `delta` and returns the part of the message body that is new.
+        self.text += delta
+        if not self.header_complete:
+            if self._header_start == -1:
+                self._header_start = self.text.find("To: ", self._searched)
+                if self._header_start == -1:
+                    # "To: " may be split across deltas.
+                    self._searched = max(0, len(self.text) - 3)
+                    return ""
+            end_index = self.text.find("\n", self._header_start + 4)
+            if end_index == -1:
+                return ""
+            self.recipient_name = self.text[self._header_start + 4 : end_index].strip()
+            self.header_complete = True
+            self._body_start = self._body_sent = end_index + 1
+        if self._body_sent == self._body_start:
+            # Skip the whitespace between the header and the body.
+            body = self.text[self._body_start :]
+            if not body.strip("\n\t "):
+                return ""
+            self._body_sent = self._body_start = self._body_start + (
+                len(body) - len(body.lstrip("\n\t "))
+            )
+        new_text = self.text[self._body_sent :]
+        self._body_sent = len(self.text)
+        return new_text
+
+
+def get_element(lst: list, index: int, default: Any = None):
+    try:
+        return lst[index]
+    except IndexError:
+        return default
+
+
+def normalize_name(name: str) -> str:
+    # The form entity names are compared in: lowercase, with spaces, underscores and
+    # hyphens all the same, and without the quotes, markdown and punctuation models
+    # tend to put around names.
+    return re.sub(r"[\s_-]+", "-", name.strip(" \t\n\"'`*@.:;!?()[]<>").lower())
+
+
+def default_user_input_handler() -> str:
+    return input("\x1b[31mYou: \x1b[0m").replace("\\n", "\n")
+
+
+def run_in_thread(func: Callable[[], Any]) -> asyncio.Future:
+    # Runs `func` in a daemon thread and returns a future for its result. Unlike an
+    # executor's threads, a daemon thread blocked in input() doesn't keep the process
+    # from exiting.
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def run():
+        try:
+            result = func()
+        except Exception as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(settle, *outcome)
+        except RuntimeError:
+            pass  # The loop is already closed.
+
+    threading.Thread(target=run, name="mar_ps-user-input", daemon=True).start()
+    return future
+
+
+class InputRequest:
+    # An is_user entity waiting for a reply from a `UserInput`.
+
+    def __init__(
+        self,
+        entity: "Entity",
+        sender: Optional["EntityName"],
+        message: Optional["Message"],
+        future: asyncio.Future,
+    ):
+        self.entity = entity
+        self.sender = sender
+        self.message = message
+        self.future = future
+
+    def reply(self, text: str):
+        # Can be called from any thread.
+        loop = self.future.get_loop()
+        loop.call_soon_threadsafe(
+            lambda: self.future.done() or self.future.set_result(text)
+        )
+
+
+class UserInput:
+    # A user_input_handler fed from outside the conversation, e.g. by a web handler,
+    # a GUI or another task. When an is_user entity needs a reply, an InputRequest is
+    # added to `pending` and passed to `on_prompt`, if given. The entity waits until the
+    # request is answered, without blocking the event loop. Replies given while nobody
+    # is waiting are queued for the next request.
+
+    def __init__(self, on_prompt: Optional[Callable[[InputRequest], Any]] = None):
+        self.on_prompt = on_prompt
+        self.pending: "deque[InputRequest]" = deque()
+        self.queued: "deque[str]" = deque()
+
+    async def request(
+        self,
+        entity: "Entity",
+        sender: Optional["EntityName"] = None,
+        message: Optional["Message"] = None,
+    ) -> str:
+        if self.queued:
+            return self.queued.popleft()
+        request = InputRequest(
+            entity, sender, message, asyncio.get_running_loop().create_future()
+        )
+        self.pending.append(request)
+        try:
+            if self.on_prompt != None:
+                result = self.on_prompt(request)
+                if inspect.isawaitable(result):
+                    await result
+            return await request.future
+        finally:
+            self.pending.remove(request)
+
+    def reply(self, text: str, entity: Optional[str] = None) -> bool:
+        # Answers the request that has been waiting longest, or the longest-waiting one
+        # of the entity with id `entity`. Without a matching request the reply is queued
+        # (unless `entity` is given, then nothing happens) and False is returned. Must be
+        # called on the event loop's thread; `InputRequest.reply` can be called from any.
+        for request in self.pending:
+            if not request.future.done() and (
+                entity == None or request.entity.id == entity
+            ):
+                request.future.set_result(text)
+                return True
+        if entity == None:
+            self.queued.append(text)
+        return False
+
+
+class EntityName:
+
+    def __init__(self, id: str, pin_to_all_models: bool = False):
+        self.id = id
+        self.pin_to_all_models = pin_to_all_models
+
+
+class System(EntityName):
+    id = "system"
+
+    def __init__(self):
+        super().__init__(self.id)
+
+
+system = System()
+
+
+class EntityGroup(EntityName):
+    # The recipient of a message addressed to several entities at once.
+
+    def __init__(self, members: list["Entity"]):
+        super().__init__(", ".join(member.id for member in members))
+        self.members = members
+
+    def __str__(self):
+        return f"<EntityGroup: {self.id}>"
+
+    __repr__ = __str__
+
+
+def estimate_tokens(text: str) -> int:
+    # A rough token count for when no tokenizer is available: about 4 characters per
+    # token for English text.
+    return len(text) // 4 + 1
+
+
+class ContextPolicy:
+    # Keeps the prompt an entity sends under a token budget. System prompts and pinned
+    # messages are always kept, followed by as much recent history as fits. When the
+    # history outgrows the budget, the oldest part is evicted in one chunk (down to
+    # `evict_to` of the budget) so the kept prefix stays put for several turns. If a
+    # `summarizer` model is given, evicted messages are folded into a rolling summary
+    # that is kept in the prompt in their place.
+
+    def __init__(
+        self,
+        max_tokens: int,
+        tokenizer: Callable[[str], int] = estimate_tokens,
+        evict_to: float = 0.75,
+        min_recent: int = 1,
+        summarizer: Optional[Model] = None,
+        summary_prompt: str = "You keep the running notes of a team conversation. Rewrite the notes so they include the new messages. Keep every fact, result, decision and open question, and drop small talk. Write plain prose, without From: or To: lines.",
+        summary_options: dict = {},
+    ):
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer
+        self.evict_to = evict_to
+        self.min_recent = min_recent
+        self.summarizer = summarizer
+        self.summary_prompt = summary_prompt
+        self.summary_options = summary_options
+
+    def is_pinned(self, message: "Message") -> bool:
+        return message.sender == system or message.pinned_to_all
+
+    def count(self, formatted: MessageDict) -> int:
+        return self.tokenizer(formatted["content"]) + 4
+
+    def summary_message(self, summary: str) -> MessageDict:
+        return {
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{summary}",
+        }
+
+    def summary_tokens(self, summary: str) -> int:
+        return self.count(self.summary_message(summary)) if summary else 0
+
+    async def select(self, entity: "Entity") -> list[MessageDict]:
+        formatted = entity.formatted_stack()
+        pinned = []
+        history = []
+        for index, message in enumerate(entity.message_stack):
+            (pinned if self.is_pinned(message) else history).append(index)
+        start = min(entity.context_start, max(len(history) - self.min_recent, 0))
+        pinned_tokens = sum(self.count(formatted[index]) for index in pinned)
+        summary_tokens = self.summary_tokens(entity.context_summary)
+        window = [self.count(formatted[index]) for index in history[start:]]
+        total = sum(window)
+        while (
+            pinned_tokens + summary_tokens + total > self.max_tokens
+            and len(window) > self.min_recent
+        ):
+            target = self.max_tokens * self.evict_to - pinned_tokens - summary_tokens
+            evicted = 0
+            while total > target and len(window) - evicted > self.min_recent:
+                total -= window[evicted]
+                evicted += 1
+            if self.summarizer != None:
+                entity.context_summary = await self.summarize(
+                    entity,
+                    [
+                        entity.message_stack[index]
+                        for index in history[start : start + evicted]
+                    ],
+                )
+                # The new summary can be longer than the old one. If it no longer
+                # fits, evict (and summarize) again.
+                summary_tokens = self.summary_tokens(entity.context_summary)
+            start += evicted
+            del window[:evicted]
+        entity.context_start = start
+        # Everything from the first kept message on is either kept history or pinned.
+        first_kept = history[start] if start < len(history) else len(formatted)
+        before = [formatted[index] for index in pinned if index < first_kept]
+        if entity.context_summary:
+            before.append(self.summary_message(entity.context_summary))
+        return before + formatted[first_kept:]
+
+    async def summarize(self, entity: "Entity", messages: list["Message"]) -> str:
+        transcript = "\n\n".join(
+            f"{message.sender.id} to {message.recipient.id}: {message.content}"
+            for message in messages
+        )
+        notes = entity.context_summary or "(none yet)"
+        return (
+            await self.summarizer.generate(
+                [
+                    {"role": "system", "content": self.summary_prompt},
+                    {
+                        "role": "user",
+                        "content": f"Notes so far:\n{notes}\n\nNew messages:\n{transcript}",
+                    },
+                ],
+                {"temperature": 0, **self.summary_options},
+            )
+        ).strip()
+
+
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar(
+    "mar_ps_current_span", default=None
+)
+
+
+class Span:
+    # One timed operation (a conversation, a turn, a generation) and its attributes.
+
+    def __init__(self, tracer: "Tracer", name: str, **attributes):
+        parent = _current_span.get()
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(tracer.ids)
+        self.parent_id = parent.span_id if parent != None else None
+        self.trace_id = parent.trace_id if parent != None else self.span_id
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+        self.duration: Optional[float] = None
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self)
+        for exporter in tracer.exporters:
+            exporter.on_start(self)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        self.attributes.update(attributes)
+        self.duration = time.perf_counter() - self._started
+        self.end_time = self.start_time + self.duration
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Ended in a different context than it was started in.
+            pass
+        for exporter in self.tracer.exporters:
+            exporter.on_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter:
+    # Base class for span exporters. Override `on_start` and/or `on_end`.
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        pass
+
+
+class JSONLExporter(SpanExporter):
+    # Writes every finished span to a file as one JSON object per line.
+
+    def __init__(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def on_end(self, span: Span):
+        self.file.write(json.dumps(span.to_dict(), default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class OpenTelemetryExporter(SpanExporter):
+    # Mirrors spans into OpenTelemetry, to be sent on by whatever exporter the
+    # OpenTelemetry SDK is configured with.
+
+    def __init__(self, tracer: Any = None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError(
+                "OpenTelemetry API not found. You may be able to fix this by running `pip install opentelemetry-api opentelemetry-sdk`"
+            )
+        self.trace = trace
+        self.tracer = tracer if tracer != None else trace.get_tracer("mar_ps")
+        self.spans: dict[int, Any] = {}
+
+    def on_start(self, span: Span):
+        parent = self.spans.get(span.parent_id)
+        self.spans[span.span_id] = self.tracer.start_span(
+            span.name,
+            context=self.trace.set_span_in_context(parent) if parent != None else None,
+            start_time=int(span.start_time * 1e9),
+        )
+
+    def on_end(self, span: Span):
+        otel_span = self.spans.pop(span.span_id, None)
+        if otel_span == None:
+            return
+        for key, value in span.attributes.items():
+            if value != None:
+                otel_span.set_attribute(
+                    key,
+                    value
+                    if isinstance(value, (str, bool, int, float))
+                    else json.dumps(value, default=str),
+                )
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+
+class Tracer:
+    # Records spans for conversations ("conversation"), turns ("turn") and model calls
+    # ("generate") and hands them to the exporters. A MAR without a tracer records
+    # nothing.
+
+    def __init__(self, exporters: list[SpanExporter] = []):
+        self.exporters = list(exporters)
+        self.ids = itertools.count(1)
+
+    def start(self, name: str, **attributes) -> Span:
+        return Span(self, name, **attributes)
+
+
+def console_event_sink(event: str, data: dict):
+    # The default event sink: prints to the terminal, in color.
+    verbose = data.get("verbose", False)
+    if event == "message_sent":
+        if verbose:
+            print(
+                f"\x1b[32mMessage sent from {data['sender'].id} to {data['recipient'].id}:\x1b[0m\n{data['message'].content}\n"
+            )
+        else:
+            print(
+                f"\x1b[32mMessage sent from {data['sender'].id} to {data['recipient'].id}.\x1b[0m"
+            )
+    elif event == "user_prompt":
+        print(f"\x1b[31mAI ({data['sender'].id}): \x1b[0m{data['message'].content}")
+    elif event == "invalid_response" and verbose:
+        print(data["raw_response"])
+        print(f"\x1b[31m{data['error']}\x1b[0m")
+    elif event == "too_many_errors" and verbose:
+        print(
+            f"\x1b[31mError: too many errors. Handling according to rule {data['mode']}.\x1b[0m"
+        )
+
+
+logger = logging.getLogger("mar_ps")
+
+
+def logging_event_sink(event: str, data: dict):
+    # An event sink that writes to the "mar_ps" logger instead of printing.
+    if event == "message_sent":
+        logger.info(
+            "Message sent from %s to %s: %s",
+            data["sender"].id,
+            data["recipient"].id,
+            data["message"].content,
+        )
+    elif event == "user_prompt":
+        logger.info("Waiting for user input (%s)", data["recipient"].id)
+    elif event == "invalid_response":
+        logger.warning("%s: %s", data["entity"].id, data["error"])
+    elif event == "too_many_errors":
+        logger.warning(
+            "%s: too many errors, handling according to rule %s",
+            data["entity"].id,
+            data["mode"],
+        )
+    elif event == "escalated":
+        logger.debug(
+            "%s: reply from %s rejected (%s), trying the next model",
+            data["entity"].id,
+            data["model"].id,
+            data["reason"],
+        )
+
+
+class MessageLog:
+    # An opt-in record of the messages created in a MAR, bounded by count and age.
+    # With `weak=True` it only holds weak references, so it never keeps a message alive
+    # on its own.
+
+    def __init__(
+        self,
+        max_size: Optional[int] = 10000,
+        max_age: Optional[float] = None,
+        weak: bool = False,
+    ):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.weak = weak
+        self.entries: "deque[tuple[float, Any]]" = deque()
+
+    def append(self, message: "Message"):
+        self.entries.append(
+            (time.monotonic(), weakref.ref(message) if self.weak else message)
+        )
+        self.prune()
+
+    def prune(self):
+        if self.max_size != None:
+            while len(self.entries) > self.max_size:
+                self.entries.popleft()
+        if self.max_age != None:
+            oldest = time.monotonic() - self.max_age
+            while self.entries and self.entries[0][0] < oldest:
+                self.entries.popleft()
+
+    def messages(self) -> list["Message"]:
+        self.prune()
+        if not self.weak:
+            return [message for _, message in self.entries]
+        return [message for _, ref in self.entries if (message := ref()) != None]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __iter__(self):
+        return iter(self.messages())
+
+    def __len__(self):
+        return len(self.messages())
+
+
+class ConversationStore:
+    # An append-only on-disk log of a MAR's conversation. The log at `path` has one JSON
+    # record per line: entities ("e"), message versions ("m"), message stack changes
+    # ("s"), context policy state ("x") and the pending deliveries after each round
+    # ("q"). `path + ".idx"` has a fixed-size binary entry per record (offset, length,
+    # turn, kind and entity number or message id), so opening a store reads only the
+    # index, and loading a stack parses only that entity's records from the mapped log.
+    # A crash can leave a partial record at the end, which is dropped on open.
+
+    INDEX = struct.Struct("<QIIBi")
+
+    def __init__(self, path: str, sync: bool = False):
+        self.path = path
+        self.sync = sync
+        self.turn = 0
+        self.entity_ids: list[str] = []
+        self.numbers: dict[str, int] = {}
+        self.next_id = 0
+        # Index entries (turn, offset, length) by message id and by entity number.
+        self.messages: dict[int, list[tuple[int, int, int]]] = {}
+        self.stacks: dict[int, list[tuple[int, int, int]]] = {}
+        self.states: dict[int, list[tuple[int, int, int]]] = {}
+        self.queues: list[tuple[int, int, int]] = []
+        # Live messages: their id and the revision that was last written.
+        self.written: "weakref.WeakKeyDictionary[Message, tuple[int, int]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.loaded: "weakref.WeakValueDictionary[int, Message]" = (
+            weakref.WeakValueDictionary()
+        )
+        self.synced: dict[int, list["Message"]] = {}
+        self.synced_states: dict[int, tuple[str, int]] = {}
+        self.revisions = -1
+        self._map: Optional[mmap.mmap] = None
+        self.log = open(path, "a+b")
+        self.index = open(path + ".idx", "a+b")
+        self._recover()
+
+    def _recover(self):
+        log_size = os.path.getsize(self.path)
+        self.index.seek(0)
+        data = self.index.read()
+        entries = len(data) // self.INDEX.size
+        end = 0
+        for i, (offset, length, turn, kind, key) in enumerate(
+            self.INDEX.iter_unpack(data[: entries * self.INDEX.size])
+        ):
+            if offset + length > log_size:
+                entries = i
+                break
+            self._add_entry(chr(kind), key, turn, offset, length)
+            end = offset + length
+        self.index.truncate(entries * self.INDEX.size)
+        self.log_size = end
+        if end < log_size:
+            # Records the index is missing (the process died between the two writes).
+            self.log.seek(end)
+            for line in self.log.read().split(b"\n")[:-1]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._write_entry(record, self.log_size, len(line) + 1)
+                self.log_size += len(line) + 1
+        self.log.truncate(self.log_size)
+        self.flush()
+
+    def _key(self, record: dict) -> int:
+        return record.get("id", 0) if record["k"] == "m" else record.get("n", 0)
+
+    def _add_entry(
+        self,
+        kind: str,
+        key: int,
+        turn: int,
+        offset: int,
+        length: int,
+        record: Optional[dict] = None,
+    ):
+        entry = (turn, offset, length)
+        if kind == "m":
+            self.messages.setdefault(key, []).append(entry)
+            self.next_id = max(self.next_id, key + 1)
+        elif kind == "s":
+            self.stacks.setdefault(key, []).append(entry)
+        elif kind == "x":
+            self.states.setdefault(key, []).append(entry)
+        elif kind == "q":
+            self.queues.append(entry)
+        elif kind == "e":
+            record = record or self._read(offset, length)
+            self.entity_ids.append(record["id"])
+            self.numbers[self.entity_ids[-1]] = key
+        self.turn = max(self.turn, turn)
+
+    def _write_entry(self, record: dict, offset: int, length: int):
+        key = self._key(record)
+        self.index.write(
+            self.INDEX.pack(offset, length, record["t"], ord(record["k"]), key)
+        )
+        self._add_entry(record["k"], key, record["t"], offset, length, record)
+
+    def _append(self, record: dict):
+        record["t"] = self.turn
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        self.log.write(line)
+        offset = self.log_size
+        self.log_size += len(line)
+        self._write_entry(record, offset, len(line))
+
+    def _read(self, offset: int, length: int) -> dict:
+        if self._map == None or offset + length > len(self._map):
+            self.log.flush()
+            if self._map != None:
+                self._map.close()
+            self._map = mmap.mmap(self.log.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(self._map[offset : offset + length])
+
+    def _latest(self, entries: list[tuple[int, int, int]], turn: Optional[int]):
+        # The index entries up to `turn`, which are in the order they were written.
+        if turn == None:
+            return entries
+        return [entry for entry in entries if entry[0] <= turn]
+
+    def _number(self, entity_id: str) -> int:
+        number = self.numbers.get(entity_id)
+        if number == None:
+            number = len(self.entity_ids)
+            self._append({"k": "e", "n": number, "id": entity_id})
+        return number
+
+    def _name(self, name: Optional[EntityName]):
+        if name == system:
+            return None
+        if isinstance(name, EntityGroup):
+            return [member.id for member in name.members]
+        return name.id
+
+    def _entity(self, name, entities: dict[str, "Entity"]) -> EntityName:
+        if name == None:
+            return system
+        if isinstance(name, list):
+            return EntityGroup([self._entity(member, entities) for member in name])
+        return entities.get(name) or EntityName(name)
+
+    def _write_message(self, message: "Message", id: Optional[int] = None) -> int:
+        if id == None:
+            id = self.next_id
+            self.next_id += 1
+        record = {
+            "k": "m",
+            "id": id,
+            "s": self._name(message.sender),
+            "r": self._name(message.recipient),
+            "c": message.content,
+        }
+        if message.raw != None:
+            record["raw"] = message.raw
+        if message.pinned_to_all:
+            record["p"] = True
+        self._append(record)
+        self.written[message] = (id, message.revision)
+        return id
+
+    def _message_id(self, message: "Message") -> int:
+        written = self.written.get(message)
+        return written[0] if written != None else self._write_message(message)
+
+    def _load_message(
+        self,
+        id: int,
+        entities: dict[str, "Entity"],
+        turn: Optional[int] = None,
+        live: bool = False,
+    ) -> "Message":
+        if live:
+            message = self.loaded.get(id)
+            if message != None:
+                return message
+        record = self._read(*self._latest(self.messages[id], turn)[-1][1:])
+        message = Message(
+            self._entity(record["s"], entities),
+            self._entity(record["r"], entities),
+            record["c"],
+        )
+        message.pinned_to_all = record.get("p", False)
+        message.raw = record.get("raw")
+        if live:
+            self.loaded[id] = message
+            self.written[message] = (id, message.revision)
+        return message
+
+    def load(
+        self,
+        entity: Union[str, "Entity"],
+        turn: Optional[int] = None,
+        mar: Optional["MAR"] = None,
+    ) -> list["Message"]:
+        # Returns an entity's message stack as it was after `turn` turns (by default,
+        # the latest). With `mar`, senders and recipients are that MAR's entities, and
+        # the latest messages are shared with its stacks, so they are written again only
+        # if they change.
+        entity_id = entity if isinstance(entity, str) else entity.id
+        number = self.numbers.get(entity_id)
+        if number == None:
+            return []
+        entities = {e.id: e for e in mar.entities} if mar != None else {}
+        ids: list[int] = []
+        for _, offset, length in self._latest(self.stacks.get(number, []), turn):
+            record = self._read(offset, length)
+            ids[record["i"] :] = record["m"]
+        live = mar != None and turn == None
+        stack = [self._load_message(id, entities, turn, live) for id in ids]
+        if live:
+            self.synced[number] = list(stack)
+            self.synced_states[number] = self.state(entity_id)
+        return stack
+
+    def state(self, entity: Union[str, "Entity"], turn: Optional[int] = None):
+        # The entity's context policy summary and start, as of `turn`.
+        number = self.numbers.get(entity if isinstance(entity, str) else entity.id)
+        states = self._latest(self.states.get(number, []), turn)
+        if not states:
+            return "", 0
+        record = self._read(*states[-1][1:])
+        return record["summary"], record["start"]
+
+    def pending(self, mar: "MAR", turn: Optional[int] = None):
+        # The deliveries that were still waiting when the conversation was last saved.
+        queues = self._latest(self.queues, turn)
+        if not queues:
+            return []
+        entities = {e.id: e for e in mar.entities}
+        deliveries = []
+        for number, id in self._read(*queues[-1][1:])["q"]:
+            recipient = entities.get(self.entity_ids[number])
+            if recipient == None:
+                raise ValueError(
+                    f"{self.entity_ids[number]} has pending messages but is not in this MAR"
+                )
+            deliveries.append(
+                (recipient, self._load_message(id, entities, turn, turn == None))
+            )
+        return deliveries
+
+    def checkpoint(self, mar: "MAR", deliveries, turns: int = 0):
+        # Saves what changed since the last checkpoint: changed messages, new stack
+        # entries, context policy state, and the deliveries still to be made.
+        self.turn += turns
+        if Message.revisions != self.revisions:
+            for message, (id, revision) in list(self.written.items()):
+                if message.revision != revision:
+                    self._write_message(message, id)
+            self.revisions = Message.revisions
+        for entity in mar.entities:
+            stack = entity._message_stack
+            if stack == None:
+                continue  # Never loaded, so unchanged.
+            number = self._number(entity.id)
+            synced = self.synced.setdefault(number, [])
+            if stack[: len(synced)] == synced:
+                start = len(synced)
+            else:
+                start = 0
+                for message, saved in zip(stack, synced):
+                    if message is not saved:
+                        break
+                    start += 1
+            if start < len(stack) or len(stack) < len(synced):
+                self._append(
+                    {
+                        "k": "s",
+                        "n": number,
+                        "i": start,
+                        "m": [self._message_id(message) for message in stack[start:]],
+                    }
+                )
+                del synced[start:]
+                synced.extend(stack[start:])
+            state = (entity.context_summary, entity.context_start)
+            if state != self.synced_states.get(number, ("", 0)):
+                self._append(
+                    {"k": "x", "n": number, "summary": state[0], "start": state[1]}
+                )
+                self.synced_states[number] = state
+        self._append(
+            {
+                "k": "q",
+                "q": [
+                    [self._number(recipient.id), self._message_id(message)]
+                    for recipient, message in deliveries
+                ],
+            }
+        )
+        self.flush()
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+            os.fsync(self.index.fileno())
+
+    def close(self):
+        if self._map != None:
+            self._map.close()
+            self._map = None
+        self.log.close()
+        self.index.close()
+
+
+class RunResult:
+    # How the last `MAR.run` or `Entity.send` ended.
+
+    def __init__(self, policies: list["StopPolicy"] = []):
+        self.turns = 0
+        self.reason: Optional[str] = None
+        self.final_message: Optional["Message"] = None
+        self.last_message: Optional["Message"] = None
+        self.answer: Optional[str] = None
+        self.elapsed = 0.0
+        self.policies = policies
+
+    def __str__(self):
+        return f"<RunResult after {self.turns} turns ({self.reason}): {self.answer}>"
+
+    __repr__ = __str__
+
+
+class StopPolicy:
+    # Decides when a conversation should end. A MAR copies its policies at the start of
+    # every run and calls `start` on the copies, so state kept on `self` is per run.
+    # `check` is called with every reply and returns the reason to stop, or None.
+    # Policies with `final = True` stop on the answer itself.
+    final = False
+
+    def start(self, mar: "MAR"):
+        pass
+
+    def on_generation(self, entity: "Entity", prompt: list[MessageDict], response: str):
+        pass
+
+    def check(self, message: "Message") -> Optional[str]:
+        return None
+
+    def time_left(self) -> Optional[float]:
+        return None
+
+
+class MaxTurns(StopPolicy):
+    def __init__(self, turns: int):
+        self.turns = turns
+
+    def start(self, mar: "MAR"):
+        self.count = 0
+
+    def check(self, message: "Message") -> Optional[str]:
+        self.count += 1
+        return "max_turns" if self.count >= self.turns else None
+
+
+class TokenBudget(StopPolicy):
+    # Stops once the prompts sent and the responses generated (retries included) add
+    # up to `max_tokens`. The round that crosses the budget still finishes.
+
+    def __init__(
+        self,
+        max_tokens: int,
+        tokenizer: Callable[[str], int] = estimate_tokens,
+        count_prompts: bool = True,
+    ):
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer
+        self.count_prompts = count_prompts
+
+    def start(self, mar: "MAR"):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
 
-    def __init__(self, id: str, client: Client):
+    @property
+    def used(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
 
-        self.id = id
-        self.client = client
+    def on_generation(self, entity: "Entity", prompt: list[MessageDict], response: str):
+        if self.count_prompts:
+            self.prompt_tokens += sum(
+                self.tokenizer(message["content"]) for message in prompt
+            )
+        self.completion_tokens += self.tokenizer(response)
 
-    async def generate(self, messages: list["Message"], options={}) -> str:
-        return await self.client.get_chat_completion(messages, self.id, options)
+    def check(self, message: "Message") -> Optional[str]:
+        return "token_budget" if self.used >= self.max_tokens else None
 
 
-def extract_name_and_content(message: str):
-    # Find the start index of the name, which is after 'To: '
-    start_index = message.find("To: ") + 4
-    if start_index == 3:  # 'To: ' not found
-        return None, None
+class Deadline(StopPolicy):
+    # Stops `seconds` after the run started. Generations still running at the deadline
+    # are cancelled.
 
-    # Find the index of the newline after the name
-    end_index = message.find("\n", start_index)
+    def __init__(self, seconds: float):
+        self.seconds = seconds
 
-    # Extract the name
-    name = message[start_index:end_index]
+    def start(self, mar: "MAR"):
+        self.deadline = time.perf_counter() + self.seconds
 
-    # Extract the message content (everything after the newline)
-    content = message[end_index + 1 :]  # Skip the newline character
+    def time_left(self) -> Optional[float]:
+        return self.deadline - time.perf_counter()
 
-    return name.strip(), content.strip("\n\t ")
+    def check(self, message: "Message") -> Optional[str]:
+        return "deadline" if self.time_left() <= 0 else None
 
 
-def get_element(lst: list, index: int, default: Any = None):
-    try:
-        return lst[index]
-    except IndexError:
-        return default
+class PingPong(StopPolicy):
+    # Stops when two entities keep sending each other near-identical messages: after
+    # `repeats` messages in a row between the same pair that are at least `similarity`
+    # alike (difflib ratio) to the previous message in the same direction.
 
+    def __init__(self, repeats: int = 3, similarity: float = 0.9, max_chars: int = 2000):
+        self.repeats = repeats
+        self.similarity = similarity
+        self.max_chars = max_chars
 
-class EntityName:
+    def start(self, mar: "MAR"):
+        self.last: dict[tuple[str, str], str] = {}
+        self.streaks: dict[frozenset, int] = {}
 
-    def __init__(self, id: str, pin_to_all_models: bool = False):
-        self.id = id
-        self.pin_to_all_models = pin_to_all_models
+    def similar(self, a: str, b: str) -> bool:
+        if a == b:
+            return True
+        matcher = difflib.SequenceMatcher(None, a, b)
+        return (
+            matcher.real_quick_ratio() >= self.similarity
+            and matcher.quick_ratio() >= self.similarity
+            and matcher.ratio() >= self.similarity
+        )
 
+    def check(self, message: "Message") -> Optional[str]:
+        direction = (message.sender.id, message.recipient.id)
+        pair = frozenset(direction)
+        text = " ".join(message.content.lower().split())[: self.max_chars]
+        previous = self.last.get(direction)
+        self.last[direction] = text
+        if previous != None and self.similar(previous, text):
+            self.streaks[pair] = self.streaks.get(pair, 0) + 1
+        else:
+            self.streaks[pair] = 0
+        return "ping_pong" if self.streaks[pair] >= self.repeats else None
 
-class System(EntityName):
-    id = "system"
 
-    def __init__(self):
-        super().__init__(self.id)
+class FinalAnswer(StopPolicy):
+    # Stops on a reply that gives the final answer: one addressed to an `is_user`
+    # entity (if `to_user`), or one that matches `pattern`.
+    final = True
 
+    def __init__(
+        self, pattern: Optional[str] = r"(?i)\bfinal answer\b", to_user: bool = True
+    ):
+        self.pattern = re.compile(pattern) if pattern != None else None
+        self.to_user = to_user
 
-system = System()
+    def check(self, message: "Message") -> Optional[str]:
+        if (self.to_user and addressed_to_user(message)) or (
+            self.pattern != None and self.pattern.search(message.content)
+        ):
+            return "final_answer"
+        return None
 
 
 class MAR:
     entities: list["Entity"]
     global_default_model: Optional[Model]
 
-    def __init__(self, global_default_model: Optional[Model] = None):
+    def __init__(
+        self,
+        global_default_model: Optional[Model] = None,
+        max_concurrency: Optional[int] = None,
+        message_log: Optional[MessageLog] = None,
+        scheduling: Literal["fifo", "model-affinity"] = "fifo",
+        max_affinity_rounds: int = 4,
+        tracer: Optional[Tracer] = None,
+        event_sink: Optional[Callable[[str, dict], Any]] = console_event_sink,
+        recipient_matching: Literal["exact", "fuzzy"] = "fuzzy",
+        stop_policies: list[StopPolicy] = [],
+        prompt_layout: Literal["default", "prefix-stable"] = "default",
+        store: Optional[ConversationStore] = None,
+    ):
         self.global_default_model = global_default_model
+        self.max_concurrency = max_concurrency
+        self.message_log = message_log
+        self.scheduling = scheduling
+        self.max_affinity_rounds = max_affinity_rounds
+        self.tracer = tracer
+        self.event_sink = event_sink
+        self.affinity_rounds = 0
+        self.model_switches = 0
+        self.last_model: Optional[tuple[Client, str]] = None
+        self.recipient_matching = recipient_matching
+        self.fuzzy_matches = 0
+        self.stop_policies = list(stop_policies)
+        self.prompt_layout = prompt_layout
+        self.store = store
+        # Created on first use, since before Python 3.10 a lock belongs to the event
+        # loop that is current when it is created.
+        self._user_input_lock: Optional[asyncio.Lock] = None
+        self.final_message: Optional["Message"] = None
+        self.result: Optional[RunResult] = None
+        self._policies: list[StopPolicy] = []
+        self._started = 0.0
         self.entities = []
+        # Normalized names and aliases, and the entities whose name has each word.
+        self.names: dict[str, "Entity"] = {}
+        self.aliases: dict[str, "Entity"] = {}
+        self.words: dict[str, list["Entity"]] = {}
 
     def Entity(
         self,
@@ -157,6 +2215,9 @@ class MAR:
         options: dict = {},
         is_user: bool = False,
         pin_to_all_models: bool = False,
+        context_policy: Optional[ContextPolicy] = None,
+        aliases: list[str] = [],
+        cascade: Optional[Cascade] = None,
     ):
         return Entity(
             self,
@@ -168,10 +2229,337 @@ class MAR:
             options,
             is_user,
             pin_to_all_models,
+            context_policy,
+            aliases,
+            cascade,
+        )
+
+    def add(self, entity: "Entity"):
+        self.entities.append(entity)
+        self._index(entity)
+
+    def remove(self, entity: "Entity"):
+        self.entities.remove(entity)
+        self.reindex()
+
+    def add_alias(self, alias: str, entity: "Entity"):
+        self.aliases.setdefault(normalize_name(alias), entity)
+
+    def reindex(self):
+        # Rebuilds the name index, e.g. after an entity's id was changed.
+        aliases = [(alias, entity) for alias, entity in self.aliases.items()]
+        self.names = {}
+        self.words = {}
+        self.aliases = {}
+        for entity in self.entities:
+            self._index(entity)
+        for alias, entity in aliases:
+            if entity in self.entities:
+                self.aliases.setdefault(alias, entity)
+
+    def _index(self, entity: "Entity"):
+        name = normalize_name(entity.id)
+        # With duplicate names, the entity created first wins.
+        self.names.setdefault(name, entity)
+        for word in set(name.split("-")):
+            self.words.setdefault(word, []).append(entity)
+
+    def find(
+        self, name: str, asking: Optional["Entity"] = None
+    ) -> Optional["Entity"]:
+        # Finds the entity a model meant by `name`. Exact names and aliases are
+        # dictionary lookups. With fuzzy matching, a name whose words all belong to
+        # exactly one other entity's name ("math" for "Math Expert"), or that is a
+        # close misspelling of one name, matches that entity.
+        name = normalize_name(name)
+        entity = self.names.get(name) or self.aliases.get(name)
+        if entity != None or self.recipient_matching != "fuzzy" or not name:
+            return entity
+        words = name.split("-")
+        candidates = [
+            candidate
+            for candidate in self.words.get(words[0], [])
+            if candidate != asking
+            and all(
+                candidate in self.words.get(word, []) for word in words[1:]
+            )
+        ]
+        if len(candidates) != 1:
+            close = [
+                self.names.get(match) or self.aliases[match]
+                for match in difflib.get_close_matches(
+                    name, [*self.names, *self.aliases], n=2, cutoff=0.8
+                )
+            ]
+            candidates = [
+                candidate for candidate in dict.fromkeys(close) if candidate != asking
+            ]
+        if len(candidates) == 1:
+            self.fuzzy_matches += 1
+            return candidates[0]
+        return None
+
+    def start(self, func, warmup: bool = False):
+        async def main():
+            if warmup:
+                await self.warmup()
+            return await func
+
+        asyncio.run(main())
+
+    async def warmup(self):
+        # Loads every model used by this MAR's entities, one at a time.
+        seen = set()
+        for entity in self.entities:
+            if self._model_key(entity) == None:
+                continue
+            cascade = entity.cascade.models if entity.cascade != None else []
+            for model in [*cascade, entity.model]:
+                key = (model.client, model.id)
+                if key not in seen:
+                    seen.add(key)
+                    await model.client.warmup(model.id)
+
+    def emit(self, event: str, **data):
+        if self.event_sink != None:
+            self.event_sink(event, data)
+
+    def _model_key(self, entity: "Entity") -> Optional[tuple[Client, str]]:
+        if entity.is_user or entity.model == None:
+            return None
+        return (entity.model.client, entity.model.id)
+
+    def _use_model(self, model: Model):
+        key = (model.client, model.id)
+        if self.last_model != None and key != self.last_model:
+            self.model_switches += 1
+        self.last_model = key
+
+    def _next_model(self, deliveries) -> Optional[tuple[Client, str]]:
+        # The model to run next: the one that ran last if it has pending work (so it
+        # doesn't have to be loaded again), otherwise the oldest pending delivery's.
+        # After `max_affinity_rounds` rounds in a row, the oldest delivery goes first so
+        # other models aren't starved.
+        oldest = self._model_key(deliveries[0][0])
+        keys = set(self._model_key(recipient) for recipient, _ in deliveries)
+        if self.last_model in keys and (
+            self.affinity_rounds < self.max_affinity_rounds
+            or oldest == self.last_model
+        ):
+            model = self.last_model
+        else:
+            model = oldest
+        self.affinity_rounds = (
+            self.affinity_rounds + 1 if model == self.last_model else 1
+        )
+        return model
+
+    async def run(
+        self,
+        initial_message: "Message",
+        max_turns: Optional[int] = None,
+        stop_when: Optional[Callable[["Message"], bool]] = None,
+        **options,
+    ) -> int:
+        # Delivers `initial_message` to its recipient and keeps routing replies until
+        # `max_turns` replies have been generated, or until a reply for which
+        # `stop_when` returns true (kept as `final_message`). Each reply is queued
+        # instead of being awaited inside the previous entity's turn, so the stack
+        # depth stays constant. `options` are the keyword arguments of `Entity.send`.
+        if not isinstance(initial_message.recipient, (Entity, EntityGroup)):
+            raise ValueError("The initial message must be addressed to an Entity")
+        self._begin()
+        turns = await self._run_queue(
+            self._deliveries(initial_message), max_turns, options, stop_when
+        )
+        self._finish(turns, max_turns)
+        return turns
+
+    async def resume(
+        self,
+        max_turns: Optional[int] = None,
+        stop_when: Optional[Callable[["Message"], bool]] = None,
+        **options,
+    ) -> int:
+        # Continues the conversation saved in `store` from its last checkpoint. The
+        # entities must have been created again with the same ids. Their stacks are
+        # loaded from the store when first used, so no model calls are repeated.
+        if self.store == None:
+            raise ValueError("Only a MAR with a store can resume")
+        deliveries = self.store.pending(self)
+        self._begin()
+        turns = await self._run_queue(deliveries, max_turns, options, stop_when)
+        self._finish(turns, max_turns)
+        return turns
+
+    def _checkpoint(self, deliveries, turns: int):
+        if self.store != None:
+            self.store.checkpoint(self, deliveries, turns)
+
+    def _begin(self):
+        self.final_message = None
+        self._policies = [copy.copy(policy) for policy in self.stop_policies]
+        for policy in self._policies:
+            policy.start(self)
+        self.result = RunResult(self._policies)
+        self._started = time.perf_counter()
+
+    def _generated(self, entity: "Entity", response: str):
+        for policy in self._policies:
+            policy.on_generation(entity, entity.last_prompt, response)
+
+    def _time_left(self) -> Optional[float]:
+        times = [policy.time_left() for policy in self._policies]
+        times = [left for left in times if left != None]
+        return min(times) if times else None
+
+    def _should_stop(
+        self, reply: "Message", stop_when: Optional[Callable[["Message"], bool]]
+    ) -> bool:
+        self.result.last_message = reply
+        if stop_when != None and stop_when(reply):
+            self.result.reason = "stop_when"
+            self.final_message = reply
+            return True
+        for policy in self._policies:
+            reason = policy.check(reply)
+            if reason != None:
+                self.result.reason = reason
+                if policy.final:
+                    self.final_message = reply
+                return True
+        return False
+
+    def _finish(self, turns: int, max_turns: Optional[int]):
+        # The answer is the final message if there is one, otherwise the best there is
+        # so far: the last reply.
+        result = self.result
+        result.turns = turns
+        result.elapsed = time.perf_counter() - self._started
+        if result.reason == None and max_turns != None and turns >= max_turns:
+            result.reason = "max_turns"
+        result.final_message = self.final_message
+        answer = self.final_message or result.last_message
+        result.answer = answer.content if answer != None else None
+
+    async def _before_deadline(self, awaitable, time_left: Optional[float]):
+        # Awaits `awaitable`, or cancels it once `time_left` has run out and returns
+        # None, with "deadline" as the reason the run stopped.
+        if time_left == None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, max(time_left, 0))
+        except asyncio.TimeoutError:
+            if self._time_left() > 0:
+                raise  # Not the deadline, a timeout inside a turn.
+            self.result.reason = "deadline"
+            return None
+
+    def _deliveries(self, message: "Message") -> list[tuple["Entity", "Message"]]:
+        if isinstance(message.recipient, EntityGroup):
+            return [(member, message) for member in message.recipient.members]
+        return [(message.recipient, message)]
+
+    async def _run_queue(
+        self,
+        deliveries: list[tuple["Entity", "Message"]],
+        max_turns: Optional[int],
+        options: dict,
+        stop_when: Optional[Callable[["Message"], bool]] = None,
+        done: int = 0,
+    ) -> int:
+        # Runs the conversation in rounds. Each round delivers the pending messages in
+        # queue order, all of them for every entity in the round, then lets each
+        # recipient generate once, concurrently (at most `max_concurrency` at a time).
+        # Replies are queued in the same order, so the message stacks do not depend on
+        # which backend finished first.
+        # `done` is the number of turns already run, e.g. by `Entity.send`.
+        deliveries = deque(deliveries)
+        self._checkpoint(deliveries, done)
+        semaphore = (
+            asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
         )
 
-    def start(self, func):
-        asyncio.run(func)
+        async def respond(recipient: "Entity", message, sender):
+            queued_at = time.perf_counter()
+            if semaphore == None:
+                return await recipient._respond(message, sender, queued_at, **options)
+            async with semaphore:
+                return await recipient._respond(message, sender, queued_at, **options)
+
+        span = self.tracer.start("conversation") if self.tracer != None else None
+        try:
+            turns = await self._run_rounds(
+                deliveries, max_turns, options, respond, stop_when
+            )
+        except BaseException as e:
+            if span != None:
+                span.end(error=type(e).__name__)
+            raise
+        if span != None:
+            span.end(turns=turns)
+        return turns
+
+    async def _run_rounds(
+        self, deliveries, max_turns, options, respond, stop_when
+    ) -> int:
+        turns = 0
+        while deliveries and (max_turns == None or turns < max_turns):
+            current_round = []
+            busy = set()
+            later = deque()
+            # In model-affinity mode, a round only runs entities that use the same
+            # model, so the backend doesn't swap models back and forth.
+            model = (
+                self._next_model(deliveries)
+                if self.scheduling == "model-affinity"
+                else None
+            )
+            for recipient, message in deliveries:
+                # Every pending message of an entity in the round is delivered before
+                # it generates, so it answers them all at once.
+                if recipient in busy:
+                    current_round.append((recipient, message))
+                elif (max_turns != None and turns + len(busy) >= max_turns) or (
+                    self.scheduling == "model-affinity"
+                    and self._model_key(recipient) != model
+                ):
+                    later.append((recipient, message))
+                else:
+                    busy.add(recipient)
+                    current_round.append((recipient, message))
+            deliveries = later
+            time_left = self._time_left()
+            if time_left != None and time_left <= 0:
+                self.result.reason = "deadline"
+                return turns
+            # Each recipient replies to the last message it got, in the order the
+            # recipients first appear in the queue.
+            received = {}
+            for recipient, message in current_round:
+                received[recipient] = recipient._receive(
+                    message, message.sender, **options
+                )
+            responding = asyncio.gather(
+                *[
+                    respond(recipient, message, sender)
+                    for recipient, (message, sender) in received.items()
+                ]
+            )
+            replies = await self._before_deadline(responding, time_left)
+            if replies == None:
+                return turns
+            turns += len(replies)
+            stopped = False
+            for reply in replies:
+                if self._should_stop(reply, stop_when):
+                    stopped = True
+                    break
+                deliveries.extend(self._deliveries(reply))
+            self._checkpoint(deliveries, len(replies))
+            if stopped:
+                return turns
+        return turns
 
 
 class Entity(EntityName):
@@ -188,6 +2576,9 @@ class Entity(EntityName):
         options: dict = {},
         is_user: bool = False,
         pin_to_all_models: bool = False,
+        context_policy: Optional[ContextPolicy] = None,
+        aliases: list[str] = [],
+        cascade: Optional[Cascade] = None,
     ):
         self.mar = mar
         model = model if model != None else mar.global_default_model
@@ -201,34 +2592,285 @@ class Entity(EntityName):
         self.temperature = temperature
         self.options = options
         self.is_user = is_user
-        self.message_stack = []
+        self._message_stack: Optional[list["Message"]] = None
         self.pin_to_all_models = pin_to_all_models
-        mar.entities.append(self)
+        self.aborted_generations = 0
+        self.context_policy = context_policy
+        self.context_summary = ""
+        self.context_start = 0
+        self._formatted_messages: list["Message"] = []
+        self._formatted_revisions: list[int] = []
+        # Where each formatted message first appears in `_formatted_messages`.
+        self._formatted_index: dict["Message", int] = {}
+        self._formatted: list[MessageDict] = []
+        self._formatted_at = -1
+        self.last_prompt: list[MessageDict] = []
+        # Running hashes and character counts of the last prompt's prefixes.
+        self._prefix_hashes: list[bytes] = []
+        self._prefix_chars: list[int] = []
+        self.prefix_fingerprint = ""
+        self.prefix_stats = {"prompts": 0, "prompt_chars": 0, "reused_chars": 0}
+        self.cascade = cascade
+        # The model that gave the last reply, and how the cascade's replies went.
+        self.answered_by = self.model
+        self.cascade_stats = {
+            "generations": 0,
+            "escalations": 0,
+            "accepted": {},
+            "rejected": {},
+        }
+        mar.add(self)
+        for alias in aliases:
+            mar.add_alias(alias, self)
 
-    async def generate(self, stream: bool = False):
-        if stream:
-            raise NotImplementedError("Response streaming is not yet supported")
+    @property
+    def message_stack(self) -> list["Message"]:
+        # With a conversation store, the stack is loaded from it when first used.
+        if self._message_stack == None:
+            if self.mar.store != None and self.id in self.mar.store.numbers:
+                self._message_stack = self.mar.store.load(self, mar=self.mar)
+                self.context_summary, self.context_start = self.mar.store.state(self)
+            else:
+                self._message_stack = []
+        return self._message_stack
+
+    @message_stack.setter
+    def message_stack(self, stack: list["Message"]):
+        self._message_stack = stack
+
+    def formatted_stack(self) -> list[MessageDict]:
+        # Returns the message stack formatted for this entity. Formatted entries are
+        # kept between turns and only messages that are new, or were changed since they
+        # were formatted, get formatted again.
+        messages = self._formatted_messages
+        if Message.revisions != self._formatted_at:
+            # Some message somewhere has changed. If the recent changes reach back
+            # far enough, only the changed messages are looked up, otherwise every
+            # cached one is checked.
+            changes = Message.changes
+            valid = len(messages)
+            if changes and changes[0][0] <= self._formatted_at + 1:
+                for revisions, ref in reversed(changes):
+                    if revisions <= self._formatted_at:
+                        break
+                    index = self._formatted_index.get(ref())
+                    if index != None and index < valid:
+                        valid = index
+            else:
+                valid = 0
+                for message, revision in zip(messages, self._formatted_revisions):
+                    if message.revision != revision:
+                        break
+                    valid += 1
+            self._truncate_formatted(valid)
+        stack = self.message_stack
+        if stack[: len(messages)] != messages:
+            # The stack was edited directly, keep the common prefix.
+            valid = 0
+            for message, cached in zip(stack, messages):
+                if message is not cached:
+                    break
+                valid += 1
+            self._truncate_formatted(valid)
+        for message in stack[len(messages) :]:
+            self._formatted_index.setdefault(message, len(messages))
+            messages.append(message)
+            self._formatted_revisions.append(message.revision)
+            self._formatted.append(message.format(self))
+        self._formatted_at = Message.revisions
+        return list(self._formatted)
+
+    def _truncate_formatted(self, length: int):
+        index = self._formatted_index
+        for message in self._formatted_messages[length:]:
+            if index.get(message, length) >= length:
+                index.pop(message, None)
+        del self._formatted_messages[length:]
+        del self._formatted_revisions[length:]
+        del self._formatted[length:]
+
+    async def generate(self, stream: bool = False) -> Union[str, AsyncIterator[str]]:
         if self.model == None:
             raise ValueError("Entity model cannot be None")
+        if self.mar.tracer != None:
+            return await self._generate_traced(stream)
+        if self.context_policy != None:
+            messages = await self.context_policy.select(self)
+        else:
+            messages = self.formatted_stack()
+        self._track_prefix(messages)
+        return await self._call_model(messages, stream)
+
+    async def _call_model(
+        self, messages: list[MessageDict], stream: bool
+    ) -> Union[str, AsyncIterator[str]]:
+        options = {"temperature": self.temperature, **self.options}
+        if self.cascade != None:
+            return await self.cascade.generate(self, messages, options, stream)
+        self.mar._use_model(self.model)
         return await self.model.generate(
-            [message.format(self) for message in self.message_stack],
-            {"temperature": self.temperature, **self.options},
+            messages, options, stream, self.id, self.prefix_fingerprint
         )
 
-    async def send(
+    @property
+    def escalation_rate(self) -> float:
+        # The share of this entity's cascaded generations that needed its own model.
+        generations = self.cascade_stats["generations"]
+        return self.cascade_stats["escalations"] / generations if generations else 0.0
+
+    def _track_prefix(self, messages: list[MessageDict]) -> int:
+        # Compares the prompt with the previous one and returns how many characters at
+        # the start are unchanged, which a backend with prompt caching can reuse.
+        # Unchanged messages are usually the same dicts from `formatted_stack`, so only
+        # new messages get hashed.
+        previous = self.last_prompt
+        if messages[: len(previous)] == previous:
+            # The usual case: the new prompt extends the last one.
+            common = len(previous)
+        else:
+            # Search for the longest common prefix by comparing slices, which runs in C
+            # and is much faster than comparing the messages one by one in Python.
+            # Usually only the last few messages differ, so the search starts near the
+            # end and steps back further each time.
+            low = 0
+            high = min(len(previous) - 1, len(messages))
+            step = 1
+            while low < high:
+                middle = max(high - step + 1, (low + high + 1) // 2)
+                if messages[:middle] == previous[:middle]:
+                    low = middle
+                else:
+                    high = middle - 1
+                    step *= 2
+            common = low
+        hashes = self._prefix_hashes
+        chars = self._prefix_chars
+        del hashes[common:]
+        del chars[common:]
+        digest = hashes[-1] if hashes else b""
+        total = chars[-1] if chars else 0
+        for message in messages[common:]:
+            digest = hashlib.sha256(
+                digest + f"{message['role']}\0{message['content']}".encode()
+            ).digest()
+            total += len(message["content"])
+            hashes.append(digest)
+            chars.append(total)
+        reused = chars[common - 1] if common else 0
+        self.last_prompt = messages
+        self.prefix_fingerprint = digest.hex()
+        self.prefix_stats["prompts"] += 1
+        self.prefix_stats["prompt_chars"] += total
+        self.prefix_stats["reused_chars"] += reused
+        return reused
+
+    @property
+    def prefix_reuse(self) -> float:
+        # The share of all prompt characters sent so far that repeated the previous
+        # prompt's prefix.
+        total = self.prefix_stats["prompt_chars"]
+        return self.prefix_stats["reused_chars"] / total if total else 0.0
+
+    async def _generate_traced(self, stream: bool) -> Union[str, AsyncIterator[str]]:
+        span = self.mar.tracer.start(
+            "generate", entity=self.id, model=self.model.id, stream=stream
+        )
+        try:
+            if self.context_policy != None:
+                messages = await self.context_policy.select(self)
+            else:
+                messages = self.formatted_stack()
+            format_time = time.perf_counter() - span._started
+            reused_chars = self._track_prefix(messages)
+            prompt_chars = self._prefix_chars[-1] if self._prefix_chars else 0
+            span.set(
+                prefix_fingerprint=self.prefix_fingerprint,
+                prefix_reused_chars=reused_chars,
+                prompt_messages=len(messages),
+                prompt_chars=prompt_chars,
+                prompt_tokens=sum(
+                    self.context_policy.count(message) for message in messages
+                )
+                if self.context_policy != None
+                else prompt_chars // 4 + len(messages),
+                format_time=format_time,
+            )
+            response = await self._call_model(messages, stream)
+            if self.cascade != None:
+                span.set(model=self.answered_by.id)
+        except BaseException as e:
+            span.end(error=type(e).__name__)
+            raise
+        if not stream:
+            span.end(response_chars=len(response))
+            return response
+        return self._trace_stream(span, response)
+
+    async def _trace_stream(self, span: Span, deltas: AsyncIterator[str]):
+        # The span of a streamed generation ends when the stream is finished or closed.
+        chars = 0
+        try:
+            async for delta in deltas:
+                if not chars:
+                    span.set(time_to_first_token=time.perf_counter() - span._started)
+                chars += len(delta)
+                yield delta
+        except GeneratorExit:
+            # Closed early by the consumer, not an error.
+            raise
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            if hasattr(deltas, "aclose"):
+                await deltas.aclose()
+            span.end(response_chars=chars)
+
+    async def _generate_streamed(
+        self,
+        stream_handler: Optional[Callable[["Entity", EntityName, str], Any]] = None,
+    ) -> str:
+        # Stops generating as soon as the response is known to be invalid: its To:
+        # line names an unknown recipient. The partial text is returned and fails
+        # validation in `_respond` like a complete response would, so the corrective
+        # system message is added and the entity retries right away. A response
+        # without a To: line can't be known to be invalid before it ends, because
+        # the line may come after some other text.
+        response = ResponseStream()
+        recipient = None
+        deltas = await self.generate(stream=True)
+        try:
+            async for delta in deltas:
+                body = response.feed(delta)
+                if response.header_complete and recipient == None:
+                    recipients, missing = self._resolve_recipients(
+                        response.recipient_name
+                    )
+                    if missing or not recipients:
+                        self.aborted_generations += 1
+                        break
+                    recipient = (
+                        recipients[0]
+                        if len(recipients) == 1
+                        else EntityGroup(recipients)
+                    )
+                if body and recipient and stream_handler:
+                    stream_handler(self, recipient, body)
+        finally:
+            if hasattr(deltas, "aclose"):
+                # Closing the client's generator closes the HTTP stream, which makes
+                # the backend stop generating.
+                await deltas.aclose()
+        return response.text
+
+    def _receive(
         self,
         message: Union["Message", str, None] = None,
         sender: Optional[EntityName] = None,
         print_all_messages: bool = False,
-        max_errors_before_handling: int = 3,
-        error_handling_mode: Literal[
-            "resend", "resend-empty-message", "quit"
-        ] = "resend",
         message_handler: Optional[Callable[["Message"], Any]] = None,
         message_processor: Optional[Callable[["Message"], "Message"]] = None,
-        user_input_handler: Callable[[], str] = lambda: input(
-            "\x1b[31mYou: \x1b[0m"
-        ).replace("\\n", "\n"),
+        **_,
     ):
         if message != None:
             if sender == None and type(message) == Message and message.sender != None:
@@ -238,33 +2880,113 @@ class Entity(EntityName):
                     sender = EntityName("anonymous")
                 message = Message(sender, self, message)
             if type(message.sender) != System and message.sender.pin_to_all_models:
-                for entity in self.mar.entities:
-                    m = message.clone(recipient=entity)
-                    entity.message_stack.append(m)
+                # The same message object is shared by every stack. A message to
+                # several recipients is only pinned once.
+                if not message.pinned_to_all:
+                    message.pinned_to_all = True
+                    for entity in self.mar.entities:
+                        entity.message_stack.append(message)
             else:
                 self.message_stack.append(message)
             if sender:
-                if print_all_messages:
-                    print(
-                        f"\x1b[32mMessage sent from {sender.id} to {self.id}:\x1b[0m\n{message.content}\n"
-                    )
-                else:
-                    print(f"\x1b[32mMessage sent from {sender.id} to {self.id}.\x1b[0m")
+                self.mar.emit(
+                    "message_sent",
+                    sender=sender,
+                    recipient=self,
+                    message=message,
+                    verbose=print_all_messages,
+                )
         if message and message_handler:
             message_handler(message)
         if message and message_processor:
             message = message_processor(message)
+        return message, sender
+
+    def _resolve_recipients(self, recipient_name: str) -> tuple[list["Entity"], list[str]]:
+        # Returns the entities named in a To: header and the names that matched nobody.
+        # "all" and "team" address every other non-user entity. Several names may be
+        # separated by commas or "&".
+        if recipient_name.lower() in ["all", "team", "everyone"]:
+            return [
+                entity
+                for entity in self.mar.entities
+                if entity != self and not entity.is_user
+            ], []
+        recipients = []
+        missing = []
+        for name in recipient_name.replace("&", ",").split(","):
+            name = name.strip()
+            if not name:
+                continue
+            recipient = self.mar.find(name, self)
+            if recipient is None:
+                missing.append(name)
+            elif recipient not in recipients:
+                recipients.append(recipient)
+        return recipients, missing
+
+    async def _respond(
+        self,
+        message: Optional["Message"] = None,
+        sender: Optional[EntityName] = None,
+        queued_at: Optional[float] = None,
+        **options,
+    ) -> "Message":
+        if self.mar.tracer == None:
+            return await self._respond_until_valid(message, sender, None, **options)
+        span = self.mar.tracer.start(
+            "turn",
+            entity=self.id,
+            model="user" if self.is_user else (self.model.id if self.model else None),
+            sender=sender.id if sender else None,
+            queue_wait=time.perf_counter() - queued_at if queued_at != None else None,
+            retries=0,
+            errors=[],
+        )
+        try:
+            response_message = await self._respond_until_valid(
+                message, sender, span, **options
+            )
+        except BaseException as e:
+            span.end(error=type(e).__name__)
+            raise
+        span.end(
+            recipient=response_message.recipient.id,
+            response_chars=len(response_message.content),
+        )
+        return response_message
+
+    async def _respond_until_valid(
+        self,
+        message: Optional["Message"],
+        sender: Optional[EntityName],
+        span: Optional[Span],
+        print_all_messages: bool = False,
+        max_errors_before_handling: int = 3,
+        error_handling_mode: Literal[
+            "resend", "resend-empty-message", "quit"
+        ] = "resend",
+        user_input_handler: Union[
+            Callable[[], str], UserInput, asyncio.Queue
+        ] = default_user_input_handler,
+        stream: bool = False,
+        stream_handler: Optional[Callable[["Entity", EntityName, str], Any]] = None,
+        **_,
+    ) -> "Message":
         response = ""
+        raw = None
         last_error_count = 0
         while True:
             if (
                 last_error_count >= max_errors_before_handling
                 or max_errors_before_handling <= 0
             ):
-                if print_all_messages:
-                    print(
-                        f"\x1b[31mError: too many errors. Handling according to rule {error_handling_mode}.\x1b[0m"
-                    )
+                self.mar.emit(
+                    "too_many_errors",
+                    entity=self,
+                    mode=error_handling_mode,
+                    verbose=print_all_messages,
+                )
                 if error_handling_mode == "raise":
                     raise RuntimeError(
                         f"Entity {self.id}, model {(self.model or self.mar.global_default_model or EntityName('unknown')).id}: too many errors. Quitting."
@@ -289,76 +3011,164 @@ class Entity(EntityName):
                         response = ""
                     break
             if self.is_user:
-                if sender and message:
-                    print(f"\x1b[31mAI ({sender.id}): \x1b[0m{message.content}")
-                raw_response = user_input_handler()
+                raw_response = await self._user_input(
+                    user_input_handler, sender, message
+                )
                 if not raw_response.startswith("To:") and sender:
                     raw_response = f"To: {sender.id}\n" + raw_response
+            elif stream or stream_handler:
+                raw_response = (await self._generate_streamed(stream_handler)).strip(
+                    " \t\n"
+                )
             else:
                 raw_response = (await self.generate()).strip(" \t\n")
+            if self.mar._policies and not self.is_user:
+                self.mar._generated(self, raw_response)
             recipient_name, response = extract_name_and_content(raw_response)
             if recipient_name is None or response is None:
                 error = "Error: no recipient name found. Remember to begin your messages with To:"
-                if print_all_messages:
-                    print(raw_response)
-                    print(f"\x1b[31m{error}\x1b[0m")
-                if last_error_count > 0:
-                    self.message_stack[-1].content = error
-                else:
-                    self.message_stack.append(
-                        Message(EntityName("system"), self, error)
-                    )
+                self.mar.emit(
+                    "invalid_response",
+                    entity=self,
+                    raw_response=raw_response,
+                    error=error,
+                    error_type="missing_recipient",
+                    verbose=print_all_messages,
+                )
+                if span != None:
+                    span.attributes["errors"].append("missing_recipient")
+                    span.attributes["retries"] += 1
+                self._correct(error, last_error_count > 0)
                 last_error_count += 1
             else:
-                recipient = get_element(
-                    [
-                        entity
-                        for entity in self.mar.entities
-                        if entity.id.lower().replace(" ", "-").replace("_", "-")
-                        == recipient_name.lower().replace(" ", "-").replace("_", "-")
-                    ],
-                    0,
-                    None,
-                )
-                if recipient is None:
-                    error = f'Error: recipient not found: "{recipient_name}". Remember, you may only message members of your team.'
-                    if (
-                        "," in recipient_name
-                        or "&" in recipient_name
-                        or recipient_name in ["all", "team"]
-                    ):
-                        error += (
-                            " Currently, only one recipient per message is supported."
-                        )
-                    if print_all_messages:
-                        print(raw_response)
-                        print(f"\x1b[31m{error}\x1b[0m")
-                    if last_error_count > 0:
-                        self.message_stack[-1].content = error
-                    else:
-                        self.message_stack.append(
-                            Message(EntityName("system"), self, error)
-                        )
+                recipients, missing = self._resolve_recipients(recipient_name)
+                if missing or not recipients:
+                    error = f'Error: recipient not found: "{", ".join(missing) or recipient_name}". Remember, you may only message members of your team.'
+                    self.mar.emit(
+                        "invalid_response",
+                        entity=self,
+                        raw_response=raw_response,
+                        error=error,
+                        error_type="unknown_recipient",
+                        verbose=print_all_messages,
+                    )
+                    if span != None:
+                        span.attributes["errors"].append("unknown_recipient")
+                        span.attributes["retries"] += 1
+                    self._correct(error, last_error_count > 0)
                     last_error_count += 1
-
                 else:
+                    recipient = (
+                        recipients[0]
+                        if len(recipients) == 1
+                        else EntityGroup(recipients)
+                    )
+                    raw = raw_response
                     break
         response_message = Message(self, recipient, response)
+        if self.mar.prompt_layout == "prefix-stable" and not self.is_user:
+            # The entity sees its reply exactly as it generated it.
+            response_message.raw = raw
         self.message_stack.append(response_message)
-        task = asyncio.create_task(
-            recipient.send(
-                response_message,
-                self,
-                print_all_messages,
-                max_errors_before_handling,
-                error_handling_mode,
-                message_handler,
-                message_processor,
-            )
-        )
-        await task
+        return response_message
+
+    async def _user_input(
+        self,
+        handler: Union[Callable[[], str], UserInput, asyncio.Queue],
+        sender: Optional[EntityName],
+        message: Optional["Message"],
+    ) -> str:
+        # Gets a reply from the human without blocking the event loop. Synchronous
+        # handlers (like the default, `input()`) run in their own thread, one at a time
+        # per MAR, each right after its prompt is shown.
+        def prompt():
+            if sender and message:
+                self.mar.emit(
+                    "user_prompt", sender=sender, recipient=self, message=message
+                )
+
+        if isinstance(handler, (UserInput, asyncio.Queue)) or (
+            inspect.iscoroutinefunction(handler)
+        ):
+            prompt()
+            if isinstance(handler, UserInput):
+                response = await handler.request(self, sender, message)
+            elif isinstance(handler, asyncio.Queue):
+                response = await handler.get()
+            else:
+                response = await handler()
+        else:
+            if self.mar._user_input_lock == None:
+                self.mar._user_input_lock = asyncio.Lock()
+            async with self.mar._user_input_lock:
+                prompt()
+                response = await run_in_thread(handler)
+        if inspect.isawaitable(response):
+            # A plain function or callable object that returned an awaitable.
+            response = await response
         return response
 
+    def _correct(self, error: str, retry: bool):
+        # Tells the entity what was wrong with its response. By default a retry
+        # replaces the previous correction, which keeps the stack short. With the
+        # prefix-stable layout every correction is a new message, so earlier prompts
+        # stay a prefix of the next one.
+        if retry and self.mar.prompt_layout != "prefix-stable":
+            self.message_stack[-1].content = error
+        else:
+            self.message_stack.append(Message(EntityName("system"), self, error))
+
+    async def send(
+        self,
+        message: Union["Message", str, None] = None,
+        sender: Optional[EntityName] = None,
+        print_all_messages: bool = False,
+        max_errors_before_handling: int = 3,
+        error_handling_mode: Literal[
+            "resend", "resend-empty-message", "quit"
+        ] = "resend",
+        message_handler: Optional[Callable[["Message"], Any]] = None,
+        message_processor: Optional[Callable[["Message"], "Message"]] = None,
+        user_input_handler: Union[
+            Callable[[], str], UserInput, asyncio.Queue
+        ] = default_user_input_handler,
+        max_turns: Optional[int] = None,
+        stream: bool = False,
+        stream_handler: Optional[Callable[["Entity", EntityName, str], Any]] = None,
+        stop_when: Optional[Callable[["Message"], bool]] = None,
+    ):
+        options = {
+            "print_all_messages": print_all_messages,
+            "max_errors_before_handling": max_errors_before_handling,
+            "error_handling_mode": error_handling_mode,
+            "message_handler": message_handler,
+            "message_processor": message_processor,
+            "user_input_handler": user_input_handler,
+            "stream": stream,
+            "stream_handler": stream_handler,
+        }
+        self.mar._begin()
+        message, sender = self._receive(message, sender, **options)
+        response_message = await self.mar._before_deadline(
+            self._respond(message, sender, **options), self.mar._time_left()
+        )
+        if response_message == None:
+            self.mar._finish(0, max_turns)
+            return None
+        if self.mar._should_stop(response_message, stop_when):
+            self.mar._checkpoint([], 1)
+            self.mar._finish(1, max_turns)
+            return response_message.content
+        turns = 1 + await self.mar._run_queue(
+            self.mar._deliveries(response_message),
+            max_turns - 1 if max_turns != None else None,
+            options,
+            stop_when,
+            1,
+        )
+        self.mar._finish(turns, max_turns)
+        return response_message.content
+
     def __str__(self):
         return f"<Entity: {self.id}>"
 
@@ -366,6 +3176,12 @@ class Entity(EntityName):
 
 
 class Message:
+    # Incremented whenever any message's sender, recipient, content or pinning changes,
+    # so entities know when their formatted stacks need to be checked.
+    revisions = 0
+    # The most recent changes, as (revisions after the change, weak reference to the
+    # message), so an entity only has to check the messages that changed.
+    changes: "deque[tuple[int, weakref.ref]]" = deque(maxlen=1024)
 
     def __init__(
         self,
@@ -376,7 +3192,26 @@ class Message:
         self.sender = sender
         self.recipient = recipient
         self.content = content
-        Messages.append(self)
+        self.pinned_to_all = False
+        # The text as the sender generated it, shown to the sender instead of the
+        # re-rendered header and content. Cleared when the message is changed.
+        self.raw: Optional[str] = None
+        self.revision = 0
+        mar = getattr(sender, "mar", None) or getattr(recipient, "mar", None)
+        if mar != None and mar.message_log != None:
+            mar.message_log.append(self)
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if (
+            name in ["sender", "recipient", "content", "pinned_to_all"]
+            and "revision" in self.__dict__
+        ):
+            if name != "pinned_to_all":
+                super().__setattr__("raw", None)
+            super().__setattr__("revision", self.revision + 1)
+            Message.revisions += 1
+            Message.changes.append((Message.revisions, weakref.ref(self)))
 
     def __str__(self):
         return f"<Message from {self.sender} to {self.recipient}: {self.content}>"
@@ -389,9 +3224,18 @@ class Message:
         elif format_for == self.sender:
             return {
                 "role": "assistant",
-                "content": f"To: {self.recipient.id}\n{self.content}",
+                "content": self.raw
+                if self.raw != None
+                else f"To: {self.recipient.id}\n{self.content}",
             }
-        elif format_for == self.recipient:
+        elif (
+            format_for == self.recipient
+            or self.pinned_to_all
+            or (
+                isinstance(self.recipient, EntityGroup)
+                and format_for in self.recipient.members
+            )
+        ):
             return {
                 "role": "user",
                 "content": f"From: {self.sender.id}\n{self.content}",
@@ -411,3 +3255,446 @@ class Message:
         return Message(
             sender or self.sender, recipient or self.recipient, content or self.content
         )
+
+
+def addressed_to_user(message: Message) -> bool:
+    # True for a message to an `is_user` entity, which is how a team hands in its answer.
+    recipients = (
+        message.recipient.members
+        if isinstance(message.recipient, EntityGroup)
+        else [message.recipient]
+    )
+    return any(getattr(recipient, "is_user", False) for recipient in recipients)
+
+
+class SessionResult:
+    # The outcome of one session of a batch.
+
+    def __init__(
+        self,
+        index: int,
+        problem: str,
+        mar: MAR,
+        answer: Optional[str] = None,
+        final_message: Optional[Message] = None,
+        turns: int = 0,
+        elapsed: float = 0.0,
+        error: Optional[BaseException] = None,
+        worker: Optional[int] = None,
+        stop_reason: Optional[str] = None,
+    ):
+        self.index = index
+        self.problem = problem
+        self.mar = mar
+        self.answer = answer
+        self.final_message = final_message
+        self.turns = turns
+        self.elapsed = elapsed
+        self.error = error
+        self.worker = worker
+        self.stop_reason = stop_reason
+
+    def __str__(self):
+        if self.error != None:
+            return f"<SessionResult {self.index}: {type(self.error).__name__}: {self.error}>"
+        return f"<SessionResult {self.index} after {self.turns} turns: {self.answer}>"
+
+    __repr__ = __str__
+
+
+class Team:
+    # A team definition that can be turned into any number of independent MARs
+    # (sessions). Entities are declared once with `Team.Entity`. Every session gets its
+    # own entities and message stacks but shares the models, and so the clients,
+    # connection pools and admission control. `setup(mar)` runs on every new session,
+    # e.g. to add the system prompts.
+
+    def __init__(
+        self,
+        global_default_model: Optional[Model] = None,
+        setup: Optional[Callable[[MAR], Any]] = None,
+        **mar_options,
+    ):
+        self.global_default_model = global_default_model
+        self.setup = setup
+        self.mar_options = {"event_sink": None, **mar_options}
+        self.members: list[dict] = []
+
+    def Entity(
+        self,
+        id: str,
+        introduction: str,
+        personal_prompt: str = "",
+        model: Optional[Model] = None,
+        temperature: float = 0.5,
+        options: dict = {},
+        is_user: bool = False,
+        pin_to_all_models: bool = False,
+        context_policy: Optional[ContextPolicy] = None,
+        aliases: list[str] = [],
+        cascade: Optional[Cascade] = None,
+    ) -> str:
+        if model == None and self.global_default_model == None and not is_user:
+            raise ValueError("Entity model cannot be None")
+        self.members.append(
+            {
+                "id": id,
+                "introduction": introduction,
+                "personal_prompt": personal_prompt,
+                "model": model,
+                "temperature": temperature,
+                "options": options,
+                "is_user": is_user,
+                "pin_to_all_models": pin_to_all_models,
+                "context_policy": context_policy,
+                "aliases": aliases,
+                "cascade": cascade,
+            }
+        )
+        return id
+
+    def session(self, **mar_options) -> MAR:
+        # `mar_options` override the team's for this session only.
+        mar = MAR(self.global_default_model, **{**self.mar_options, **mar_options})
+        for member in self.members:
+            mar.Entity(**member)
+        if self.setup != None:
+            self.setup(mar)
+        return mar
+
+    async def run_session(
+        self,
+        problem: str,
+        to: str,
+        sender: Union[str, EntityName, None] = None,
+        index: int = 0,
+        max_turns: Optional[int] = None,
+        stop_when: Optional[Callable[[Message], bool]] = addressed_to_user,
+        mar: Optional[MAR] = None,
+        **options,
+    ) -> SessionResult:
+        # Runs one problem in a new session, or in `mar` if it is one made by
+        # `session()`. Errors are returned in the result, not raised.
+        mar = mar if mar != None else self.session()
+        result = SessionResult(index, problem, mar)
+        start = time.perf_counter()
+        try:
+            recipient = mar.find(to)
+            if recipient == None:
+                raise ValueError(f'No entity named "{to}" in the team')
+            if sender == None:
+                # The team's user entity, if it has one, so the answer can go to it.
+                sender = get_element(
+                    [entity for entity in mar.entities if entity.is_user],
+                    0,
+                    EntityName("user"),
+                )
+            elif isinstance(sender, str):
+                sender = mar.find(sender) or EntityName(sender)
+            result.turns = await mar.run(
+                Message(sender, recipient, problem),
+                max_turns,
+                stop_when,
+                **options,
+            )
+            result.final_message = mar.final_message
+            result.answer = mar.result.answer
+            result.stop_reason = mar.result.reason
+        except Exception as e:
+            result.error = e
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    async def run_batch(
+        self,
+        problems,
+        to: str,
+        sender: Union[str, EntityName, None] = None,
+        max_sessions: Optional[int] = 8,
+        max_turns: Optional[int] = None,
+        stop_when: Optional[Callable[[Message], bool]] = addressed_to_user,
+        **options,
+    ) -> AsyncIterator[SessionResult]:
+        # Runs every problem in its own session, at most `max_sessions` at a time, and
+        # yields each SessionResult as soon as its session finishes. Sessions are only
+        # created once they get to run. Closing the iterator cancels the rest.
+        semaphore = asyncio.Semaphore(max_sessions) if max_sessions else None
+
+        async def run(index: int, problem: str) -> SessionResult:
+            if semaphore == None:
+                return await self.run_session(
+                    problem, to, sender, index, max_turns, stop_when, **options
+                )
+            async with semaphore:
+                return await self.run_session(
+                    problem, to, sender, index, max_turns, stop_when, **options
+                )
+
+        tasks = [
+            asyncio.ensure_future(run(index, problem))
+            for index, problem in enumerate(problems)
+        ]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def start_batch(self, problems, to: str, **options) -> list[SessionResult]:
+        # Runs `run_batch` to completion and returns the results in problem order.
+        async def main():
+            return [result async for result in self.run_batch(problems, to, **options)]
+
+        return sorted(asyncio.run(main()), key=lambda result: result.index)
+
+
+def _shard_worker(
+    worker: int,
+    team_factory: Callable[[Any], Team],
+    hosts: Any,
+    max_sessions: Optional[int],
+    tasks,
+    results,
+):
+    asyncio.run(
+        _run_shard(worker, team_factory, hosts, max_sessions, tasks, results)
+    )
+
+
+async def _run_shard(worker, team_factory, hosts, max_sessions, tasks, results):
+    # A worker process: builds its own team for its hosts, then runs the sessions it
+    # is sent, at most `max_sessions` at a time, until it gets None.
+    team = team_factory(hosts)
+    results.put((0, worker))  # Ready.
+    semaphore = asyncio.Semaphore(max_sessions) if max_sessions else None
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    async def run(batch, index, problem, to, options):
+        if semaphore == None:
+            result = await team.run_session(problem, to, index=index, **options)
+        else:
+            async with semaphore:
+                result = await team.run_session(problem, to, index=index, **options)
+        error = result.error
+        if error != None:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = RuntimeError(f"{type(error).__name__}: {error}")
+        # The session itself (entities, clients) stays in the worker.
+        results.put(
+            (
+                batch,
+                SessionResult(
+                    index,
+                    problem,
+                    None,
+                    result.answer,
+                    None,
+                    result.turns,
+                    result.elapsed,
+                    error,
+                    worker,
+                    result.stop_reason,
+                ),
+            )
+        )
+
+    while True:
+        task = await loop.run_in_executor(None, tasks.get)
+        if task == None:
+            break
+        future = asyncio.ensure_future(run(*task))
+        running.add(future)
+        future.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running)
+
+
+class ShardedRunner:
+    # Runs sessions of a team in a pool of worker processes, each with its own event
+    # loop. `hosts` has one entry per worker, and each worker builds its team with
+    # `team_factory(entry)`, so every worker can use its own backend hosts.
+    # `team_factory` has to be a module-level function, since it is sent to the
+    # workers by reference.
+    # Sessions go to workers by consistent hashing of `key(problem)` (the same problem
+    # always lands on the same worker, e.g. for its response cache) or to the worker
+    # with the fewest sessions in progress ("load"). With "load", a worker is only
+    # sent as many problems as it runs at once (`max_sessions`), and the next problem
+    # is assigned when a result comes back, so slow workers get fewer problems.
+
+    def __init__(
+        self,
+        team_factory: Callable[[Any], Team],
+        hosts: list,
+        assignment: Literal["hash", "load"] = "hash",
+        max_sessions: Optional[int] = 8,
+        key: Callable[[str], str] = str,
+        replicas: int = 64,
+        start_method: str = "spawn",
+    ):
+        self.team_factory = team_factory
+        self.hosts = hosts
+        self.assignment = assignment
+        self.max_sessions = max_sessions
+        self.key = key
+        self.context = multiprocessing.get_context(start_method)
+        # The hash ring: `replicas` points per worker, sorted.
+        self.ring = sorted(
+            (self._hash(f"{worker}-{replica}"), worker)
+            for worker in range(len(hosts))
+            for replica in range(replicas)
+        )
+        self.workers = []
+        self.tasks = []
+        self.results = None
+        self.in_progress = [0] * len(hosts)
+        self.assigned = [0] * len(hosts)
+        self.batches = 0
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+    def start(self):
+        # Starts the workers and waits until each of them has built its team.
+        if self.workers:
+            return
+        self.results = self.context.Queue()
+        for worker, hosts in enumerate(self.hosts):
+            tasks = self.context.Queue()
+            process = self.context.Process(
+                target=_shard_worker,
+                args=(
+                    worker,
+                    self.team_factory,
+                    hosts,
+                    self.max_sessions,
+                    tasks,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.tasks.append(tasks)
+            self.workers.append(process)
+        starting = set(range(len(self.hosts)))
+        while starting:
+            try:
+                _, worker = self.results.get(True, 0.5)
+                starting.discard(worker)
+            except queue.Empty:
+                for worker in starting:
+                    if not self.workers[worker].is_alive():
+                        exitcode = self.workers[worker].exitcode
+                        self.close()
+                        raise RuntimeError(
+                            f"Worker {worker} failed to start (exit code {exitcode})"
+                        )
+
+    def close(self):
+        # Lets the workers finish the sessions they were sent, then stops them.
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.workers:
+            process.join()
+        self.workers = []
+        self.tasks = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def worker_for(self, problem: str) -> int:
+        if self.assignment == "load":
+            # Dead workers are only picked if there are no others, so their
+            # sessions fail instead of waiting forever.
+            return min(
+                range(len(self.hosts)),
+                key=lambda worker: (
+                    bool(self.workers) and not self.workers[worker].is_alive(),
+                    self.in_progress[worker],
+                    self.assigned[worker],
+                ),
+            )
+        point = self._hash(self.key(problem))
+        index = bisect.bisect(self.ring, (point, len(self.hosts)))
+        return self.ring[index % len(self.ring)][1]
+
+    async def run_batch(
+        self, problems, to: str, **options
+    ) -> AsyncIterator[SessionResult]:
+        # Sends the problems to the workers and yields the results as they come back.
+        # `options` are the arguments of `Team.run_session` and have to be picklable
+        # (no lambdas). A worker that dies fails its unfinished sessions.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.start)
+        # Results of an earlier batch that was not read to the end are skipped.
+        self.batches += 1
+        batch = self.batches
+        pending: dict[int, tuple[str, int]] = {}
+        queued = deque(enumerate(problems))
+
+        def dispatch():
+            while queued:
+                index, problem = queued[0]
+                worker = self.worker_for(problem)
+                if (
+                    pending
+                    and self.assignment == "load"
+                    and self.max_sessions != None
+                    and self.in_progress[worker] >= self.max_sessions
+                    and self.workers[worker].is_alive()
+                ):
+                    return  # Every worker is busy.
+                queued.popleft()
+                self.in_progress[worker] += 1
+                self.assigned[worker] += 1
+                pending[index] = (problem, worker)
+                self.tasks[worker].put((batch, index, problem, to, options))
+
+        dispatch()
+        try:
+            while pending:
+                try:
+                    result_batch, result = await loop.run_in_executor(
+                        None, self.results.get, True, 0.5
+                    )
+                except queue.Empty:
+                    for index, (problem, worker) in list(pending.items()):
+                        if not self.workers[worker].is_alive():
+                            del pending[index]
+                            self.in_progress[worker] -= 1
+                            yield SessionResult(
+                                index,
+                                problem,
+                                None,
+                                error=RuntimeError(
+                                    f"Worker {worker} exited with code {self.workers[worker].exitcode}"
+                                ),
+                                worker=worker,
+                            )
+                    dispatch()
+                    continue
+                if result_batch == batch and pending.pop(result.index, None) != None:
+                    self.in_progress[result.worker] -= 1
+                    dispatch()
+                    yield result
+        finally:
+            # A batch that isn't read to the end leaves its sessions to the workers,
+            # but they no longer count as in progress here.
+            for _, worker in pending.values():
+                self.in_progress[worker] -= 1
+
+    def start_batch(self, problems, to: str, **options) -> list[SessionResult]:
+        # Runs `run_batch` to completion and returns the results in problem order.
+        async def main():
+            return [result async for result in self.run_batch(problems, to, **options)]
+
+        with self:
+            return sorted(asyncio.run(main()), key=lambda result: result.index)
@@ -0,0 +1,614 @@
+#### An HTTP server that runs team sessions as a service
+# Built on asyncio streams only, so it needs nothing besides the standard library.
+# Every session is a task on the server's event loop. Events are streamed with
+# server-sent events, or over a WebSocket on the same URL, which can also carry the
+# human's replies.
+
+
+from typing import Optional, Any
+import asyncio
+import base64
+import hashlib
+import json
+import secrets
+import struct
+import time
+import urllib.parse
+
+from . import EntityName, Message, Team, UserInput, addressed_to_user, logger
+
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+REASONS = {
+    101: "Switching Protocols",
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_int(value: Any, name: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer")
+
+
+class Request:
+    def __init__(
+        self, method: str, path: str, query: dict, headers: dict, body: bytes
+    ):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> dict:
+        try:
+            body = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "The body is not valid JSON")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "The body must be a JSON object")
+        return body
+
+
+def event_data(data: dict) -> dict:
+    # Makes the data of a MAR event JSON-serializable: entities become their ids and
+    # messages their content.
+    result = {}
+    for key, value in data.items():
+        if key == "verbose":
+            continue
+        if isinstance(value, Message):
+            value = value.content
+        elif isinstance(value, EntityName):
+            value = value.id
+        result[key] = value
+    return result
+
+
+class ServerSession:
+    # One problem being solved by a team. Keeps every event it published, so a
+    # subscriber that connects late (or reconnects) gets the whole conversation.
+
+    def __init__(self, id: str, team: str, problem: str):
+        self.id = id
+        self.team = team
+        self.problem = problem
+        self.status = "queued"
+        self.created = time.time()
+        self.events: list[dict] = []
+        self.subscribers: set[asyncio.Queue] = set()
+        # The user_input_handler of the session: the human's replies for the team's
+        # is_user entities. Each request comes right after a "user_prompt" event.
+        self.inputs = UserInput()
+        self.mar = None
+        self.result = None
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, type: str, **data):
+        event = {"id": len(self.events), "type": type, **data}
+        self.events.append(event)
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def event_sink(self, event: str, data: dict):
+        self.publish(event, **event_data(data))
+
+    def stream_handler(self, entity, recipient, text: str):
+        self.publish("delta", entity=entity.id, recipient=recipient.id, text=text)
+
+    def reply(self, text: str, entity: Optional[str] = None) -> bool:
+        if entity != None and not any(
+            request.entity.id == entity for request in self.inputs.pending
+        ):
+            raise HTTPError(409, f'"{entity}" is not waiting for a reply')
+        return self.inputs.reply(text, entity)
+
+    def subscribe(self, after: int = -1) -> asyncio.Queue:
+        # A queue of the events after `after`, then the new ones, then None once the
+        # session is over.
+        queue = asyncio.Queue()
+        for event in self.events[after + 1 :]:
+            queue.put_nowait(event)
+        if self.done:
+            queue.put_nowait(None)
+        else:
+            self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def finish(self, status: str, **data):
+        self.status = status
+        self.publish("finished", status=status, **data)
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+        self.subscribers.clear()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ["finished", "failed", "cancelled"]
+
+    def to_dict(self) -> dict:
+        result = self.result
+        return {
+            "id": self.id,
+            "team": self.team,
+            "problem": self.problem,
+            "status": self.status,
+            "created": self.created,
+            "events": len(self.events),
+            "waiting_for_input": [
+                request.entity.id for request in self.inputs.pending
+            ],
+            "answer": result.answer if result != None else None,
+            "turns": result.turns if result != None else None,
+            "stop_reason": result.stop_reason if result != None else None,
+            "error": repr(result.error)
+            if result != None and result.error != None
+            else None,
+        }
+
+
+class Server:
+    # Serves `teams` (a name for each Team template):
+    #   GET    /teams                         the teams and their entities
+    #   POST   /teams/{team}/sessions         start a session, {"problem", "to", ...}
+    #   GET    /sessions                      every session and its status
+    #   GET    /sessions/{id}                 one session, with its answer when done
+    #   DELETE /sessions/{id}                 cancel a session
+    #   GET    /sessions/{id}/events          server-sent events, or a WebSocket
+    #   POST   /sessions/{id}/input           a reply from the human, {"text"}
+    # At most `max_sessions` sessions run at once, the rest wait in order.
+
+    def __init__(
+        self,
+        teams: dict[str, Team],
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_sessions: Optional[int] = None,
+        max_turns: Optional[int] = None,
+        max_finished: int = 100,
+        max_body: int = 1 << 20,
+        heartbeat: float = 15.0,
+    ):
+        self.teams = teams
+        self.host = host
+        self.port = port
+        self.max_turns = max_turns
+        self.max_finished = max_finished
+        self.max_body = max_body
+        self.heartbeat = heartbeat
+        self.max_sessions = max_sessions
+        # Created with the first session, since before Python 3.10 a semaphore belongs
+        # to the event loop that is current when it is created.
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.sessions: dict[str, ServerSession] = {}
+        self.finished: list[str] = []
+        self.connections: set[asyncio.Task] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        # The port that was actually bound, if `port` was 0.
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server == None:
+            await self.start()
+        await self.server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+    async def close(self):
+        for session in self.sessions.values():
+            if session.task != None:
+                session.task.cancel()
+        await asyncio.gather(
+            *[s.task for s in self.sessions.values() if s.task != None],
+            return_exceptions=True,
+        )
+        if self.server != None:
+            self.server.close()
+        # Event streams end by themselves once their session is over. Give them a
+        # moment to send the last events.
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=1.0)
+        for task in list(self.connections):
+            task.cancel()
+        if self.server != None:
+            await self.server.wait_closed()
+
+    def create_session(
+        self,
+        team: str,
+        problem: str,
+        to: Optional[str] = None,
+        sender: Optional[str] = None,
+        max_turns: Optional[int] = None,
+        until_answer: bool = True,
+        stream: bool = False,
+    ) -> ServerSession:
+        # Starts solving `problem` with a new session of `team`. `to` defaults to the
+        # team's first entity that isn't a user. With `until_answer`, the session ends
+        # when the team messages a user entity. Otherwise that message is shown to the
+        # human, who answers through `/input`.
+        if team not in self.teams:
+            raise HTTPError(404, f'No team named "{team}"')
+        members = self.teams[team].members
+        if to == None:
+            to = next((m["id"] for m in members if not m["is_user"]), None)
+            if to == None:
+                raise HTTPError(400, f'Team "{team}" has no entity to send to')
+        if self.max_turns != None:
+            max_turns = min(max_turns or self.max_turns, self.max_turns)
+        if self.max_sessions and self.semaphore == None:
+            self.semaphore = asyncio.Semaphore(self.max_sessions)
+        id = secrets.token_urlsafe(8)
+        session = ServerSession(id, team, problem)
+        self.sessions[id] = session
+        session.task = asyncio.ensure_future(
+            self._run(
+                session,
+                to,
+                sender,
+                max_turns,
+                addressed_to_user if until_answer else None,
+                stream,
+            )
+        )
+        return session
+
+    async def _run(self, session: ServerSession, to, sender, max_turns, stop_when, stream):
+        try:
+            if self.semaphore == None:
+                await self._run_session(session, to, sender, max_turns, stop_when, stream)
+            else:
+                async with self.semaphore:
+                    await self._run_session(
+                        session, to, sender, max_turns, stop_when, stream
+                    )
+        except asyncio.CancelledError:
+            session.finish("cancelled")
+        except Exception as e:
+            # E.g. the team's setup failed. Errors inside the run itself are already
+            # in the result.
+            logger.exception("Session %s failed", session.id)
+            session.finish("failed", error=repr(e))
+        finally:
+            self.finished.append(session.id)
+            while len(self.finished) > self.max_finished:
+                self.sessions.pop(self.finished.pop(0), None)
+
+    async def _run_session(self, session, to, sender, max_turns, stop_when, stream):
+        team = self.teams[session.team]
+        session.status = "running"
+        session.mar = team.session(event_sink=session.event_sink)
+        session.publish("started", team=session.team, problem=session.problem, to=to)
+        options = {"user_input_handler": session.inputs}
+        if stream:
+            options["stream_handler"] = session.stream_handler
+        result = await team.run_session(
+            session.problem,
+            to,
+            sender,
+            max_turns=max_turns,
+            stop_when=stop_when,
+            mar=session.mar,
+            **options,
+        )
+        session.result = result
+        session.finish(
+            "failed" if result.error != None else "finished",
+            answer=result.answer,
+            turns=result.turns,
+            stop_reason=result.stop_reason,
+            elapsed=result.elapsed,
+            error=repr(result.error) if result.error != None else None,
+        )
+
+    def session(self, id: str) -> ServerSession:
+        if id not in self.sessions:
+            raise HTTPError(404, f'No session "{id}"')
+        return self.sessions[id]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            request = await self._read_request(reader)
+            if request != None:
+                await self._route(request, reader, writer)
+        except HTTPError as e:
+            self._respond(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception("Error while handling a request")
+            self._respond(writer, 500, {"error": repr(e)})
+        finally:
+            self.connections.discard(task)
+            # Sends whatever is still buffered, then closes.
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(413, "The request headers are too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = parse_int(headers.get("content-length") or 0, "Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > self.max_body:
+            raise HTTPError(413, "The body is too large")
+        body = await reader.readexactly(length) if length else b""
+        url = urllib.parse.urlsplit(target)
+        return Request(
+            method.upper(),
+            url.path,
+            dict(urllib.parse.parse_qsl(url.query)),
+            headers,
+            body,
+        )
+
+    def _respond(self, writer: asyncio.StreamWriter, status: int, body: Any = None):
+        data = json.dumps(body).encode() if body != None else b""
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + data
+        )
+
+    async def _route(self, request: Request, reader, writer):
+        parts = [part for part in request.path.split("/") if part]
+        method = request.method
+        if parts == ["teams"] and method == "GET":
+            return self._respond(writer, 200, self._teams())
+        if len(parts) == 3 and parts[0] == "teams" and parts[2] == "sessions":
+            if method != "POST":
+                raise HTTPError(405, "Use POST to start a session")
+            body = request.json()
+            problem = body.get("problem")
+            if not isinstance(problem, str) or not problem:
+                raise HTTPError(400, '"problem" must be a non-empty string')
+            max_turns = body.get("max_turns")
+            if max_turns != None and (type(max_turns) != int or max_turns < 1):
+                raise HTTPError(400, '"max_turns" must be a positive integer')
+            session = self.create_session(
+                urllib.parse.unquote(parts[1]),
+                problem,
+                body.get("to"),
+                body.get("sender"),
+                max_turns,
+                bool(body.get("until_answer", True)),
+                bool(body.get("stream", False)),
+            )
+            return self._respond(writer, 201, session.to_dict())
+        if parts == ["sessions"] and method == "GET":
+            return self._respond(
+                writer, 200, [s.to_dict() for s in self.sessions.values()]
+            )
+        if len(parts) >= 2 and parts[0] == "sessions":
+            session = self.session(parts[1])
+            if len(parts) == 2 and method == "GET":
+                return self._respond(writer, 200, session.to_dict())
+            if len(parts) == 2 and method == "DELETE":
+                if session.task != None:
+                    session.task.cancel()
+                    await asyncio.gather(session.task, return_exceptions=True)
+                return self._respond(writer, 200, session.to_dict())
+            if parts[2:] == ["events"] and method == "GET":
+                after = parse_int(
+                    request.headers.get("last-event-id")
+                    or request.query.get("after", -1),
+                    "Last-Event-ID" if "last-event-id" in request.headers else '"after"',
+                )
+                if request.headers.get("upgrade", "").lower() == "websocket":
+                    return await self._websocket(request, session, after, reader, writer)
+                return await self._event_stream(session, after, writer)
+            if parts[2:] == ["input"] and method == "POST":
+                body = request.json()
+                text = body.get("text")
+                if not isinstance(text, str):
+                    raise HTTPError(400, '"text" must be a string')
+                if session.done:
+                    raise HTTPError(409, "The session is over")
+                session.reply(text, body.get("entity"))
+                return self._respond(writer, 200, session.to_dict())
+        raise HTTPError(404, f"No route for {method} {request.path}")
+
+    def _teams(self) -> list[dict]:
+        return [
+            {
+                "name": name,
+                "entities": [
+                    {
+                        "id": member["id"],
+                        "introduction": member["introduction"],
+                        "is_user": member["is_user"],
+                    }
+                    for member in team.members
+                ],
+            }
+            for name, team in self.teams.items()
+        ]
+
+    async def _next_event(self, queue: asyncio.Queue):
+        # The next event, or False if there was none for `heartbeat` seconds.
+        try:
+            return await asyncio.wait_for(queue.get(), self.heartbeat)
+        except asyncio.TimeoutError:
+            return False
+
+    async def _event_stream(self, session: ServerSession, after: int, writer):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        queue = session.subscribe(after)
+        try:
+            while True:
+                event = await self._next_event(queue)
+                if event == None:
+                    break
+                if event == False:
+                    # A comment, so proxies keep the connection open and a client
+                    # that went away is noticed.
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    writer.write(
+                        f"id: {event['id']}\nevent: {event['type']}\n"
+                        f"data: {json.dumps(event)}\n\n".encode()
+                    )
+                await writer.drain()
+        finally:
+            session.unsubscribe(queue)
+
+    async def _websocket(self, request: Request, session, after: int, reader, writer):
+        # Sends every event as a JSON text frame. The client may send
+        # {"type": "input", "text": ..., "entity": ...} frames with the human's replies.
+        key = request.headers.get("sec-websocket-key")
+        if key == None:
+            raise HTTPError(400, "Missing Sec-WebSocket-Key")
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode()
+        )
+        queue = session.subscribe(after)
+
+        async def send():
+            while True:
+                event = await self._next_event(queue)
+                if event == None:
+                    writer.write(websocket_frame(8, struct.pack("!H", 1000)))
+                    break
+                if event == False:
+                    writer.write(websocket_frame(9, b""))
+                else:
+                    writer.write(websocket_frame(1, json.dumps(event).encode()))
+                await writer.drain()
+
+        async def receive():
+            while True:
+                opcode, payload = await read_websocket_frame(reader, self.max_body)
+                if opcode == 8:
+                    writer.write(websocket_frame(8, payload[:2]))
+                    break
+                if opcode == 9:
+                    writer.write(websocket_frame(10, payload))
+                elif opcode == 1:
+                    try:
+                        message = json.loads(payload)
+                    except ValueError:
+                        continue
+                    if (
+                        isinstance(message, dict)
+                        and message.get("type") == "input"
+                        and isinstance(message.get("text"), str)
+                        and not session.done
+                    ):
+                        try:
+                            session.reply(message["text"], message.get("entity"))
+                        except HTTPError:
+                            pass
+
+        tasks = [asyncio.ensure_future(send()), asyncio.ensure_future(receive())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() != None:
+                    if not isinstance(
+                        task.exception(),
+                        (ConnectionError, asyncio.IncompleteReadError),
+                    ):
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            session.unsubscribe(queue)
+
+
+def websocket_frame(opcode: int, payload: bytes) -> bytes:
+    # A single unmasked frame, as sent by a server.
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(
+    reader: asyncio.StreamReader, max_size: int
+) -> tuple[int, bytes]:
+    # Reads one message, joining fragmented frames, and unmasks it.
+    message = b""
+    message_opcode = None
+    while True:
+        first, second = await reader.readexactly(2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await reader.readexactly(8))
+        if len(message) + length > max_size:
+            raise ConnectionError("WebSocket message too large")
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask != None and length:
+            key = (mask * (length // 4 + 1))[:length]
+            payload = (
+                int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")
+            ).to_bytes(length, "big")
+        if opcode >= 8:
+            # Control frames are returned right away, even between fragments.
+            return opcode, payload
+        if message_opcode == None:
+            message_opcode = opcode
+        message += payload
+        if first & 0x80:
+            return message_opcode, message
@@ -1,11 +1,98 @@
+# Serves the example team over HTTP. Start a session and follow it with
+#
+#   python server.py --stub
+#   curl -X POST localhost:8000/teams/example/sessions -d '{"problem": "What is 6 * 7?"}'
+#   curl -N localhost:8000/sessions/<id>/events
+#
+# --stub answers with canned replies instead of calling models, for trying the server
+# without a model backend.
+
+import argparse
+
 from mar_ps import (
+    Client,
     Message,
     system,
     OllamaClient,
-    OpenAIClient,
     Model,
-    MAR,
+    Team,
 )
+from mar_ps.server import Server
+
+
+class StubClient(Client):
+    # The two experts pass the problem back and forth, and every `turns`-th reply
+    # hands the answer to the competition manager.
+    def __init__(self, turns: int = 4):
+        self.turns = turns
+        self.calls = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        self.calls += 1
+        if self.calls % self.turns == 0:
+            return f"To: Competition Manager\nFinal answer: 42 (call {self.calls})"
+        if "You are Math Expert," in messages[0]["content"]:
+            return f"To: Fact Checker\nIs this right? (call {self.calls})"
+        return f"To: Math Expert\nLooks right, go on. (call {self.calls})"
+
+
+def add_system_prompts(mar):
+    for entity in mar.entities:
+        team = "\n".join(
+            f"{e.id}: {e.introduction[0].upper() + e.introduction[1:]}."
+            for e in mar.entities
+            if e != entity
+        )
+        entity.message_stack.append(
+            Message(
+                system,
+                entity,
+                f"This is the messaging application. Your team includes: {team}. You may address messages to any of them and receive messages from any of them. You may not send messages to anyone outside of your team. Your messages are private; only the sender and receiver can see them. Thus, you will need to share information with your teammates. You are {entity.id}, {entity.introduction}. {entity.personal_prompt + ' ' if entity.personal_prompt else ''}Messages sent by you are started with To: and messages sent to you are started with From:.",
+            )
+        )
+
+
+def example_team(client: Client) -> Team:
+    team = Team(setup=add_system_prompts)
+    team.Entity(
+        "Math Expert",
+        "the top-ranked AI expert in math",
+        "You carefully evaluate all mathematical problems.",
+        Model("qwen2.5:7b", client),
+    )
+    team.Entity(
+        "Fact Checker",
+        "the fact checker for the team",
+        "You double check every claim and ensure accuracy in everything.",
+        Model("gemma2:9b", client),
+    )
+    team.Entity(
+        "Competition Manager",
+        "the competition manager, only message them with the final answer",
+        is_user=True,
+        pin_to_all_models=True,
+    )
+    return team
+
 
-# TODO
-# Eventually, I will build a server and GUI for this project for better visualization.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-sessions", type=int, default=16)
+    parser.add_argument("--max-turns", type=int, default=50)
+    parser.add_argument("--stub", action="store_true")
+    args = parser.parse_args()
+    client = StubClient() if args.stub else OllamaClient()
+    server = Server(
+        {"example": example_team(client)},
+        args.host,
+        args.port,
+        max_sessions=args.max_sessions,
+        max_turns=args.max_turns,
+    )
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,75 @@
+# Scripted clients for the tests, on top of the benchmarks' stub clients.
+
+import asyncio
+
+from common import last_sender
+
+from mar_ps import Client
+
+
+class ScriptedClient(Client):
+    # Answers with `responses` in order, then with the last one again. A response is a
+    # string, or a list of the deltas to stream it in. Counts the streams that were
+    # closed before their last delta.
+    def __init__(self, responses: list, delay: float = 0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.calls = 0
+        self.prompts = []
+        self.closed_early = 0
+
+    def next(self, messages) -> list[str]:
+        self.prompts.append(messages)
+        response = self.responses[min(self.calls, len(self.responses) - 1)]
+        self.calls += 1
+        return [response] if isinstance(response, str) else response
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        deltas = self.next(messages)
+        await asyncio.sleep(self.delay)
+        return "".join(deltas)
+
+    async def stream_chat_completion(self, messages, model_id: str, options={}):
+        deltas = self.next(messages)
+        sent = 0
+        try:
+            for delta in deltas:
+                await asyncio.sleep(self.delay)
+                yield delta
+                sent += 1
+        finally:
+            if sent < len(deltas):
+                self.closed_early += 1
+
+
+class PromptClient(Client):
+    # Replies to whoever sent the last message, with a reply that depends only on the
+    # prompt, so a conversation comes out the same however often it is restarted.
+    def __init__(self):
+        self.calls = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        self.calls += 1
+        await asyncio.sleep(0)
+        return f"To: {last_sender(messages)}\nReply to {len(messages)} messages."
+
+
+class HangingClient(Client):
+    # Never answers. Counts the requests that were started and those that were
+    # cancelled.
+    def __init__(self):
+        self.started = 0
+        self.cancelled = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        self.started += 1
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+def stacks(mar) -> list[list[dict]]:
+    # Every entity's message stack, as its model sees it.
+    return [[message.format(e) for message in e.message_stack] for e in mar.entities]
@@ -0,0 +1,127 @@
+import asyncio
+
+from stubs import ScriptedClient
+
+from mar_ps import AdmissionController, Model
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_max_in_flight():
+    async def main():
+        admission = AdmissionController(max_in_flight=1)
+        await admission.acquire("a")
+        waiting = asyncio.ensure_future(admission.acquire("a"))
+        await settle()
+        assert not waiting.done()
+        assert admission.stats()["queue_depth"] == 1
+        admission.release("a")
+        await waiting
+        assert admission.in_flight == 1
+        admission.release("a")
+        assert admission.stats()["admitted"] == 2
+
+    asyncio.run(main())
+
+
+def test_max_in_flight_per_model():
+    async def main():
+        admission = AdmissionController(max_in_flight_per_model=1)
+        await admission.acquire("a", "x")
+        blocked = asyncio.ensure_future(admission.acquire("a", "x"))
+        other = asyncio.ensure_future(admission.acquire("b", "y"))
+        await settle()
+        assert other.done()
+        assert not blocked.done()
+        admission.release("a")
+        await blocked
+
+    asyncio.run(main())
+
+
+def test_requesters_take_turns():
+    async def main():
+        admission = AdmissionController(max_in_flight=1)
+        await admission.acquire("m", "busy")
+        order = []
+
+        async def request(requester: str):
+            async with admission.slot("m", requester):
+                order.append(requester)
+
+        tasks = [asyncio.ensure_future(request("busy")) for _ in range(3)]
+        tasks.append(asyncio.ensure_future(request("quiet")))
+        await settle()
+        admission.release("m")
+        await asyncio.gather(*tasks)
+        assert order == ["busy", "quiet", "busy", "busy"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        admission = AdmissionController(max_in_flight=1)
+        await admission.acquire("m", "a")
+        waiting = asyncio.ensure_future(admission.acquire("m", "b"))
+        await settle()
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert admission.queue_depth == 0
+        assert not admission.waiting and not admission.turns
+        admission.release("m")
+        assert admission.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_rate_limit():
+    async def main():
+        admission = AdmissionController(rate=50.0, burst=2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(4):
+            await admission.acquire("m")
+            admission.release("m")
+        # Two right away from the burst, then one every 20ms.
+        assert loop.time() - start >= 0.03
+
+    asyncio.run(main())
+
+
+def test_models_wait_for_admission():
+    async def main():
+        client = ScriptedClient(["To: A\nHi."], delay=0.01)
+        client.admission = AdmissionController(max_in_flight=2)
+        model = Model("m", client, coalesce=False)
+        await asyncio.gather(
+            *[model.generate([{"role": "user", "content": str(i)}]) for i in range(6)]
+        )
+        stats = client.admission.stats()
+        assert stats["admitted"] == 6
+        assert stats["max_queue_depth"] == 4
+        assert client.admission.in_flight == 0
+
+    asyncio.run(main())
+
+
+
+def test_streams_hold_a_slot_until_closed():
+    async def main():
+        client = ScriptedClient([["To: A\n", "Hi", "."]])
+        client.admission = AdmissionController(max_in_flight=1)
+        model = Model("m", client)
+        stream = await model.generate([], stream=True)
+        assert await stream.__anext__() == "To: A\n"
+        assert client.admission.in_flight == 1
+        await stream.aclose()
+        assert client.admission.in_flight == 0
+        # Without admission control, streams work the same.
+        client.admission = None
+        stream = await model.generate([], stream=True)
+        assert [delta async for delta in stream] == ["To: A\n", "Hi", "."]
+
+    asyncio.run(main())
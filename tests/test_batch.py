@@ -0,0 +1,73 @@
+import asyncio
+
+from mar_ps import Client, Model, Team
+
+
+class DelayClient(Client):
+    # Answers "To: User\n<problem>" after the number of seconds the problem starts
+    # with, or raises if it doesn't start with one. Tracks how many requests run at
+    # once, and how many were cancelled.
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+        self.cancelled = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        problem = messages[-1]["content"].splitlines()[-1]
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            await asyncio.sleep(float(problem.split()[0]))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.running -= 1
+        return f"To: User\n{problem}"
+
+
+def make_team() -> Team:
+    team = Team(Model("m", DelayClient()))
+    team.Entity("Solver", "solves it")
+    team.Entity("User", "asks", is_user=True)
+    return team
+
+
+def test_results_come_as_sessions_finish():
+    team = make_team()
+
+    async def main():
+        return [
+            result
+            async for result in team.run_batch(["0.2", "0.05", "oops", "0.1"], "Solver")
+        ]
+
+    results = asyncio.run(main())
+    assert [result.index for result in results] == [2, 1, 3, 0]
+    assert [result.answer for result in results] == [None, "0.05", "0.1", "0.2"]
+    # A failed session doesn't stop the others.
+    assert isinstance(results[0].error, ValueError)
+    assert all(result.error == None for result in results[1:])
+
+
+def test_max_sessions_limits_concurrent_sessions():
+    team = make_team()
+    # Different problems, so their requests aren't coalesced.
+    problems = [f"0.02 #{i}" for i in range(6)]
+    results = team.start_batch(problems, "Solver", max_sessions=2)
+    assert [result.answer for result in results] == problems
+    assert team.global_default_model.client.most_running == 2
+
+
+def test_closing_the_iterator_cancels_the_rest():
+    team = make_team()
+
+    async def main():
+        batch = team.run_batch(["0.0", "10 #1", "10 #2"], "Solver")
+        first = await batch.__anext__()
+        await batch.aclose()
+        await asyncio.sleep(0)
+        return first
+
+    assert asyncio.run(main()).answer == "0.0"
+    assert team.global_default_model.client.cancelled == 2
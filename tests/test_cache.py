@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+from common import StubClient
+from stubs import ScriptedClient
+
+from mar_ps import CachingClient, ResponseCache, request_key
+
+PROMPT = [{"role": "user", "content": "Hi."}]
+
+
+def test_entries_expire_after_ttl(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.db"), ttl=0.05)
+    cache.put("a", "A")
+    assert cache.get("a") == "A"
+    time.sleep(0.1)
+    # Expired in memory and on disk.
+    assert cache.get("a") == None
+    assert cache.stats()["misses"] == 1
+    # The next write deletes the expired row.
+    cache.put("b", "B")
+    assert cache.disk_entries == 1
+    cache.close()
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(
+        max_entries=1, path=str(tmp_path / "cache.db"), max_disk_entries=10
+    )
+    for i in range(10):
+        cache.put(f"k{i}", f"v{i}")
+    assert cache.get("k0") == "v0"  # From disk, so it is the most recently used.
+    cache.put("k10", "v10")
+    # Over the limit, a tenth of it is evicted down to 9 entries.
+    assert cache.disk_entries == 9
+    assert cache.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 9
+    assert cache.get("k1") == None
+    assert cache.get("k2") == None
+    assert cache.get("k0") == "v0"
+    assert cache.get("k3") == "v3"
+    cache.close()
+
+
+def test_sampled_requests_bypass_the_cache_unless_forced():
+    async def main():
+        client = StubClient()
+        caching = CachingClient(client, ResponseCache())
+        # Without a temperature, the backend samples.
+        first = await caching.get_chat_completion(PROMPT, "m")
+        second = await caching.get_chat_completion(PROMPT, "m", {"temperature": 0.7})
+        assert first != second
+        assert client.calls == 2
+        assert caching.cache.bypassed == 2
+        for _ in range(2):
+            await caching.get_chat_completion(PROMPT, "m", {"temperature": 0})
+        assert client.calls == 3
+        caching.force = True
+        for _ in range(2):
+            await caching.get_chat_completion(PROMPT, "m", {"temperature": 0.7})
+        assert client.calls == 4
+        assert caching.cache.stats()["hits"] == 2
+
+    asyncio.run(main())
+
+
+def test_disk_tier_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path=path)
+    cache.put("a", "A")
+    cache.close()
+    cache = ResponseCache(path=path)
+    assert cache.disk_entries == 1
+    assert asyncio.run(cache.lookup("a")) == "A"
+    assert cache.stats()["disk_hits"] == 1
+    cache.close()
+
+
+def test_aborted_stream_is_not_stored():
+    async def main():
+        client = ScriptedClient([["To: A\n", "Hi", "."]])
+        caching = CachingClient(client, ResponseCache(), force=True)
+        stream = caching.stream_chat_completion(PROMPT, "m")
+        assert await stream.__anext__() == "To: A\n"
+        await stream.aclose()
+        assert client.closed_early == 1
+        assert caching.cache.get(request_key("m", PROMPT)) == None
+        # A stream read to the end is stored, and the next one comes from the cache.
+        for _ in range(2):
+            stream = caching.stream_chat_completion(PROMPT, "m")
+            assert "".join([delta async for delta in stream]) == "To: A\nHi."
+        assert client.calls == 2
+
+    asyncio.run(main())
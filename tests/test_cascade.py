@@ -0,0 +1,82 @@
+import asyncio
+
+from stubs import ScriptedClient
+
+from mar_ps import MAR, Cascade, Message, Model, addressed_to_user
+
+
+def solve(cheap: list[Model], **cascade_options):
+    # Runs a question through a Solver whose own model answers "Big answer.", and
+    # returns the MAR, the Solver and the reasons of the escalations.
+    reasons = []
+
+    def sink(event: str, data: dict):
+        if event == "escalated":
+            reasons.append(data["reason"])
+
+    mar = MAR(event_sink=sink)
+    big = Model("big", ScriptedClient(["To: User\nBig answer."]))
+    mar.Entity(
+        "Solver", "solves it", model=big, cascade=Cascade(cheap, **cascade_options)
+    )
+    mar.Entity("User", "asks", is_user=True)
+    solver, user = mar.entities
+    asyncio.run(
+        mar.run(Message(user, solver, "What is 2 + 2?"), stop_when=addressed_to_user)
+    )
+    return mar, solver, reasons
+
+
+def test_cheap_reply_that_passes_is_kept():
+    cheap = Model("cheap", ScriptedClient(["To: User\n4"]))
+    mar, solver, reasons = solve([cheap])
+    assert mar.result.answer == "4"
+    assert solver.answered_by is cheap
+    assert solver.model.client.calls == 0
+    assert solver.cascade_stats["accepted"] == {"cheap": 1}
+    assert solver.escalation_rate == 0.0
+    assert reasons == []
+
+
+def test_rejected_replies_escalate_in_order():
+    def has_digit(entity, response: str):
+        return None if any(c.isdigit() for c in response) else "no_digit"
+
+    cheap = [
+        Model("missing", ScriptedClient(["4"])),
+        Model("unknown", ScriptedClient(["To: Nobody\n4"])),
+        Model("long", ScriptedClient(["To: User\n4, since 2 + 2 = 4."])),
+        Model("words", ScriptedClient(["To: User\nfour"])),
+    ]
+    mar, solver, reasons = solve(cheap, max_chars=10, validators=[has_digit])
+    assert reasons == ["missing_recipient", "unknown_recipient", "too_long", "no_digit"]
+    assert mar.result.answer == "Big answer."
+    assert solver.answered_by is solver.model
+    assert solver.cascade_stats == {
+        "generations": 1,
+        "escalations": 1,
+        "accepted": {"big": 1},
+        "rejected": {
+            "missing_recipient": 1,
+            "unknown_recipient": 1,
+            "too_long": 1,
+            "no_digit": 1,
+        },
+    }
+    assert solver.escalation_rate == 1.0
+
+
+def test_samples_have_to_agree():
+    agreeing = Model("agreeing", ScriptedClient(["To: User\n4"]))
+    mar, solver, reasons = solve([agreeing], samples=3)
+    assert mar.result.answer == "4"
+    # Each sample is its own request.
+    assert agreeing.client.calls == 3
+
+    disagreeing = Model(
+        "disagreeing",
+        ScriptedClient(["To: User\n4", "To: User\nI can't tell what it is."]),
+    )
+    mar, solver, reasons = solve([disagreeing], samples=2)
+    assert reasons == ["disagreement"]
+    assert mar.result.answer == "Big answer."
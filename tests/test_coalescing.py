@@ -0,0 +1,49 @@
+import asyncio
+
+from stubs import HangingClient, ScriptedClient
+
+from mar_ps import Model
+
+PROMPT = [{"role": "user", "content": "Hi."}]
+
+
+def test_identical_requests_share_one_backend_call():
+    async def main():
+        client = ScriptedClient(["To: A\nHi."], delay=0.05)
+        first, second = Model("m", client), Model("m", client)
+        responses = await asyncio.gather(
+            first.generate(PROMPT), first.generate(PROMPT), second.generate(PROMPT)
+        )
+        assert responses == ["To: A\nHi."] * 3
+        assert client.calls == 1
+        assert first.coalesced + second.coalesced == 2
+        # Once it has finished, the next request goes to the backend again.
+        await first.generate(PROMPT)
+        assert client.calls == 2
+        # So do requests that differ in their options or model.
+        await asyncio.gather(
+            first.generate(PROMPT, {"temperature": 0}),
+            Model("n", client).generate(PROMPT),
+        )
+        assert client.calls == 4
+
+    asyncio.run(main())
+
+
+def test_request_is_cancelled_with_its_last_caller():
+    async def main():
+        client = HangingClient()
+        model = Model("m", client)
+        callers = [asyncio.ensure_future(model.generate(PROMPT)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert client.started == 1
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert client.cancelled == 0
+        callers[1].cancel()
+        await asyncio.sleep(0.01)
+        assert client.cancelled == 1
+        assert not Model.in_flight[client]
+        assert not Model.waiters
+
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from common import StubClient
+from stubs import ScriptedClient
+
+from mar_ps import MAR, EntityGroup, Message, Model
+
+
+def team(client=None, **options) -> MAR:
+    mar = MAR(event_sink=None, **options)
+    model = Model("m", client or StubClient())
+    mar.Entity("Math Expert", "does the math", model=model)
+    mar.Entity("Physics Expert", "does the physics", model=model)
+    mar.Entity("Writer", "writes it up", model=model, aliases=["Scribe"])
+    return mar
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("Math Expert", "Math Expert"),
+        ("math expert", "Math Expert"),
+        ("**Math Expert**:", "Math Expert"),
+        ("math_expert", "Math Expert"),
+        ("Scribe", "Writer"),
+        ("math", "Math Expert"),
+        ("physics", "Physics Expert"),
+        ("Mathh Expert", "Math Expert"),
+        ("Phyiscs Expert", "Physics Expert"),
+        ("expert", None),
+        ("Nobody", None),
+        ("", None),
+    ],
+)
+def test_find(name, expected):
+    entity = team().find(name)
+    assert (entity.id if entity != None else None) == expected
+
+
+def test_find_counts_fuzzy_matches():
+    mar = team()
+    mar.find("Math Expert")
+    assert mar.fuzzy_matches == 0
+    mar.find("math")
+    assert mar.fuzzy_matches == 1
+
+
+def test_find_leaves_out_the_asking_entity():
+    mar = team()
+    math, physics, _ = mar.entities
+    assert mar.find("expert", asking=math) == physics
+    assert mar.find("math", asking=math) == None
+    # An exact name still finds the asking entity.
+    assert mar.find("Math Expert", asking=math) == math
+
+
+def test_exact_matching():
+    mar = team(recipient_matching="exact")
+    assert mar.find("math expert").id == "Math Expert"
+    assert mar.find("Scribe").id == "Writer"
+    assert mar.find("math") == None
+    assert mar.find("Mathh Expert") == None
+
+
+def test_reindex_after_renaming():
+    mar = team()
+    mar.entities[0].id = "Algebra Expert"
+    mar.reindex()
+    assert mar.find("algebra") == mar.entities[0]
+    assert mar.find("Math Expert") == None
+    assert mar.find("Scribe") == mar.entities[2]
+
+
+def reply_from_writer(response: str) -> Message:
+    async def main():
+        mar = team(ScriptedClient([response]))
+        writer = mar.entities[2]
+        await mar.run(Message(mar.entities[0], writer, "Write it up."), max_turns=1)
+        return mar.result.last_message
+
+    return asyncio.run(main())
+
+
+def test_replies_go_to_fuzzy_matches():
+    reply = reply_from_writer("To: math\nHere it is.")
+    assert reply.recipient.id == "Math Expert"
+    assert reply.content == "Here it is."
+
+
+def test_replies_to_several_recipients():
+    reply = reply_from_writer("To: math & Physics Expert\nHere it is.")
+    assert isinstance(reply.recipient, EntityGroup)
+    assert [member.id for member in reply.recipient.members] == [
+        "Math Expert",
+        "Physics Expert",
+    ]
+    reply = reply_from_writer("To: all\nHere it is.")
+    assert [member.id for member in reply.recipient.members] == [
+        "Math Expert",
+        "Physics Expert",
+    ]
+
+
+def test_replies_to_a_broadcast_are_answered_at_once():
+    async def main():
+        mar = MAR(event_sink=None)
+        math = ScriptedClient(["To: Writer\nMath is fine."])
+        physics = ScriptedClient(["To: Writer\nPhysics is fine."])
+        writer = ScriptedClient(["To: all\nCheck this.", "To: all\nThanks, both."])
+        mar.Entity("Math Expert", "does the math", model=Model("m", math))
+        mar.Entity("Physics Expert", "does the physics", model=Model("m", physics))
+        mar.Entity("Writer", "writes it up", model=Model("m", writer))
+        turns = await mar.run(
+            Message(mar.entities[0], mar.entities[2], "Write it up."), max_turns=4
+        )
+        return mar, writer, turns
+
+    mar, writer, turns = asyncio.run(main())
+    # Both replies are delivered before the writer's one generation for them.
+    assert turns == 4
+    assert writer.calls == 2
+    assert [message["content"] for message in writer.prompts[-1][-2:]] == [
+        "From: Math Expert\nMath is fine.",
+        "From: Physics Expert\nPhysics is fine.",
+    ]
+    assert mar.result.last_message.content == "Thanks, both."
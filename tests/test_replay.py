@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from common import StubClient, build_team
+from stubs import ScriptedClient, stacks
+
+from mar_ps import Message, RecordingClient, ReplayClient
+
+
+def converse(client, turns: int = 20, **options):
+    async def main():
+        mar = build_team(client, size=3, event_sink=None)
+        await mar.run(
+            Message(mar.entities[1], mar.entities[0], "Solve it."),
+            max_turns=turns,
+            **options,
+        )
+        return mar
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("name", ["recording.jsonl", "recording.jsonl.gz"])
+def test_replay_matches_the_recording(tmp_path, name):
+    path = str(tmp_path / name)
+    recording = RecordingClient(StubClient(error_rate=0.3, seed=7), path)
+    recorded = converse(recording)
+    recording.close()
+
+    replay = ReplayClient(path)
+    replayed = converse(replay)
+    assert stacks(replayed) == stacks(recorded)
+    assert replay.missed == 0
+    assert replay.replayed == recording.recorded
+
+
+def test_streamed_replay_aborts_where_the_recording_did(tmp_path):
+    path = str(tmp_path / "recording.jsonl")
+    responses = [
+        ["To: Nobody\n", "Never ", "sent."],
+        ["To: Expert 1\n", "Done ", "once."],
+        ["To: Expert 0\n", "Done ", "twice."],
+    ]
+    recording = RecordingClient(ScriptedClient(responses), path)
+    recorded = converse(recording, turns=2, stream=True)
+    recording.close()
+
+    replayed = converse(ReplayClient(path), turns=2, stream=True)
+    assert stacks(replayed) == stacks(recorded)
+    assert replayed.entities[0].aborted_generations == 1
+
+
+def test_unrecorded_requests(tmp_path):
+    path = str(tmp_path / "recording.jsonl")
+    recording = RecordingClient(StubClient(), path)
+    converse(recording, turns=2)
+    recording.close()
+
+    with pytest.raises(LookupError):
+        converse(ReplayClient(path), turns=4)
+
+    fallback = StubClient()
+    replay = ReplayClient(path, fallback=fallback)
+    converse(replay, turns=4)
+    assert replay.missed == fallback.calls == 2
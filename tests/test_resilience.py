@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+from common import StubClient
+
+from mar_ps import (
+    AdmissionController,
+    CachingClient,
+    CircuitBreaker,
+    Client,
+    Model,
+    RecordingClient,
+    ResilientClient,
+    ResponseCache,
+)
+
+
+class FailingClient(Client):
+    # Raises ConnectionError for the first `failures` requests, then answers.
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.attempts = 0
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        self.attempts += 1
+        await asyncio.sleep(0)
+        if self.attempts <= self.failures:
+            raise ConnectionError("injected failure")
+        return "To: A\nHi."
+
+
+PROMPT = [{"role": "user", "content": "Hi."}]
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_after=60.0)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_the_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_after=60.0)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == "closed"
+
+
+def test_breaker_lets_one_trial_through_after_reset_after():
+    breaker = CircuitBreaker(failure_threshold=1, reset_after=60.0)
+    breaker.failure()
+    breaker.opened_at -= 60.0
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    assert not breaker.allow()
+    # A failed trial opens the circuit for another `reset_after`.
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    breaker.opened_at -= 60.0
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_retries_until_success():
+    client = FailingClient(failures=2)
+    resilient = ResilientClient(client, retries=2, backoff=0.0)
+    response = asyncio.run(resilient.get_chat_completion(PROMPT, "m"))
+    assert response == "To: A\nHi."
+    assert client.attempts == 3
+    assert resilient.retried == 2
+    assert resilient.breaker.state == "closed"
+
+
+def test_gives_up_without_a_fallback():
+    resilient = ResilientClient(FailingClient(failures=10), retries=1, backoff=0.0)
+    with pytest.raises(ConnectionError):
+        asyncio.run(resilient.get_chat_completion(PROMPT, "m"))
+
+
+def test_open_circuit_goes_straight_to_the_fallback():
+    async def main():
+        client = FailingClient(failures=10)
+        fallback = StubClient()
+        resilient = ResilientClient(
+            client,
+            fallback=Model("fallback", fallback),
+            retries=5,
+            backoff=0.0,
+            breaker=CircuitBreaker(failure_threshold=2, reset_after=60.0),
+        )
+        first = await resilient.get_chat_completion(PROMPT, "m")
+        # The breaker opened after two failures, so the other retries were skipped.
+        assert client.attempts == 2
+        assert "from fallback" in first
+        await resilient.get_chat_completion(PROMPT, "m")
+        assert client.attempts == 2
+        assert fallback.calls == 2
+        assert resilient.failed_over == 2
+
+    asyncio.run(main())
+
+
+def test_stream_fails_over_before_its_first_delta():
+    async def main():
+        resilient = ResilientClient(
+            FailingClient(failures=10),
+            fallback=Model("fallback", StubClient()),
+            retries=1,
+            backoff=0.0,
+        )
+        deltas = [
+            delta async for delta in resilient.stream_chat_completion(PROMPT, "m")
+        ]
+        assert "from fallback" in "".join(deltas)
+        assert resilient.failed_over == 1
+
+    asyncio.run(main())
+
+
+def test_wrappers_share_the_wrapped_clients_admission(tmp_path):
+    client = StubClient()
+    admission = AdmissionController(max_in_flight=1)
+    wrappers = [
+        CachingClient(client, ResponseCache()),
+        RecordingClient(client, str(tmp_path / "recording.jsonl")),
+        ResilientClient(client),
+    ]
+    wrappers[0].admission = admission
+    for wrapper in wrappers:
+        assert wrapper.admission is admission
+    assert client.admission is admission
+    wrappers[1].close()
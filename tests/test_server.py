@@ -0,0 +1,240 @@
+import asyncio
+import base64
+import json
+import os
+import struct
+
+from stubs import ScriptedClient
+
+from mar_ps import Model, Team
+from mar_ps.server import Server, read_websocket_frame
+
+
+def make_team(responses: list, delay: float = 0.0, setup=None) -> Team:
+    team = Team(setup=setup)
+    team.Entity("Solver", "solves it", model=Model("m", ScriptedClient(responses, delay)))
+    team.Entity("User", "asks", is_user=True)
+    return team
+
+
+def serve(teams: dict, test):
+    # Runs `test(server)` against a server on a free port.
+    async def main():
+        server = Server(teams, port=0, heartbeat=0.5)
+        await server.start()
+        try:
+            await asyncio.wait_for(test(server), 10)
+        finally:
+            await server.close()
+
+    asyncio.run(main())
+
+
+async def send(server: Server, method: str, path: str, body=None, headers={}):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    data = json.dumps(body).encode() if body != None else b""
+    head = f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(data)}\r\n"
+    for name, value in headers.items():
+        head += f"{name}: {value}\r\n"
+    writer.write(head.encode() + b"\r\n" + data)
+    return reader, writer
+
+
+async def request(server: Server, method: str, path: str, body=None, headers={}):
+    reader, writer = await send(server, method, path, body, headers)
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(data) if data else None
+
+
+async def start_session(server: Server, team: str = "solo", **body) -> str:
+    status, session = await request(
+        server, "POST", f"/teams/{team}/sessions", {"problem": "What is 2 + 2?", **body}
+    )
+    assert status == 201
+    return session["id"]
+
+
+async def events(reader: asyncio.StreamReader):
+    # The events of a server-sent event stream, as they arrive.
+    await reader.readuntil(b"\r\n\r\n")
+    while True:
+        try:
+            block = await reader.readuntil(b"\n\n")
+        except asyncio.IncompleteReadError:
+            return
+        for line in block.decode().splitlines():
+            if line.startswith("data: "):
+                yield json.loads(line[6:])
+
+
+def test_teams():
+    async def test(server):
+        status, teams = await request(server, "GET", "/teams")
+        assert status == 200
+        assert teams[0]["name"] == "solo"
+        assert [e["id"] for e in teams[0]["entities"]] == ["Solver", "User"]
+
+    serve({"solo": make_team(["To: User\n4"])}, test)
+
+
+def test_server_sent_events():
+    async def test(server):
+        id = await start_session(server)
+        reader, writer = await send(server, "GET", f"/sessions/{id}/events")
+        received = [event async for event in events(reader)]
+        writer.close()
+        assert received[0]["type"] == "started"
+        assert received[-1]["type"] == "finished"
+        assert received[-1]["status"] == "finished"
+        assert received[-1]["answer"] == "4"
+        assert [event["id"] for event in received] == list(range(len(received)))
+        status, session = await request(server, "GET", f"/sessions/{id}")
+        assert session["status"] == "finished"
+        assert session["events"] == len(received)
+
+        # A client that reconnects gets the events it missed.
+        reader, writer = await send(
+            server, "GET", f"/sessions/{id}/events", headers={"Last-Event-ID": "1"}
+        )
+        again = [event async for event in events(reader)]
+        writer.close()
+        assert again == received[2:]
+
+    serve({"solo": make_team(["To: User\n4"])}, test)
+
+
+def test_bad_requests():
+    async def test(server):
+        id = await start_session(server)
+        status, _ = await request(server, "GET", f"/sessions/{id}/events?after=abc")
+        assert status == 400
+        status, _ = await request(
+            server, "GET", f"/sessions/{id}/events", headers={"Last-Event-ID": "x"}
+        )
+        assert status == 400
+        status, _ = await request(server, "GET", "/sessions/nope")
+        assert status == 404
+        status, _ = await request(server, "POST", "/teams/nope/sessions", {"problem": "?"})
+        assert status == 404
+        status, _ = await request(server, "POST", "/teams/solo/sessions", {"problem": ""})
+        assert status == 400
+        status, _ = await request(server, "GET", "/teams/solo/sessions")
+        assert status == 405
+
+    serve({"solo": make_team(["To: User\n4"])}, test)
+
+
+def test_input():
+    async def test(server):
+        id = await start_session(server, until_answer=False, max_turns=3)
+        reader, writer = await send(server, "GET", f"/sessions/{id}/events")
+        received = []
+        async for event in events(reader):
+            received.append(event)
+            if event["type"] == "user_prompt":
+                status, session = await request(
+                    server, "POST", f"/sessions/{id}/input", {"text": "It's 4."}
+                )
+                assert status == 200
+        writer.close()
+        assert received[-1]["status"] == "finished"
+        assert received[-1]["answer"] == "Thanks."
+        client = server.teams["solo"].members[0]["model"].client
+        assert client.prompts[-1][-1]["content"] == "From: User\nIt's 4."
+        status, _ = await request(server, "POST", f"/sessions/{id}/input", {"text": "?"})
+        assert status == 409
+
+    serve({"solo": make_team(["To: User\nWhat is it?", "To: User\nThanks."])}, test)
+
+
+def masked_frame(opcode: int, payload: bytes) -> bytes:
+    # A client's frames must be masked.
+    mask = os.urandom(4)
+    masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return struct.pack("!BB", 0x80 | opcode, 0x80 | len(payload)) + mask + masked
+
+
+def test_websocket():
+    async def test(server):
+        id = await start_session(server, until_answer=False, max_turns=3)
+        key = base64.b64encode(os.urandom(16)).decode()
+        reader, writer = await send(
+            server,
+            "GET",
+            f"/sessions/{id}/events",
+            headers={
+                "Upgrade": "websocket",
+                "Connection": "Upgrade",
+                "Sec-WebSocket-Key": key,
+                "Sec-WebSocket-Version": "13",
+            },
+        )
+        head = await reader.readuntil(b"\r\n\r\n")
+        assert head.startswith(b"HTTP/1.1 101")
+        received = []
+        while True:
+            opcode, payload = await read_websocket_frame(reader, 1 << 20)
+            if opcode == 8:
+                break
+            if opcode != 1:
+                continue
+            event = json.loads(payload)
+            received.append(event)
+            if event["type"] == "user_prompt":
+                writer.write(
+                    masked_frame(1, json.dumps({"type": "input", "text": "4"}).encode())
+                )
+        writer.close()
+        assert received[0]["type"] == "started"
+        assert received[-1]["type"] == "finished"
+        assert received[-1]["answer"] == "Thanks."
+
+    serve({"solo": make_team(["To: User\nWhat is it?", "To: User\nThanks."])}, test)
+
+
+def test_cancel():
+    async def test(server):
+        id = await start_session(server)
+        await asyncio.sleep(0.05)
+        status, session = await request(server, "DELETE", f"/sessions/{id}")
+        assert status == 200
+        assert session["status"] == "cancelled"
+
+    serve({"solo": make_team(["To: User\n4"], delay=60)}, test)
+
+
+def test_failed_setup():
+    def setup(mar):
+        raise RuntimeError("no prompts")
+
+    async def test(server):
+        id = await start_session(server)
+        reader, writer = await send(server, "GET", f"/sessions/{id}/events")
+        received = [event async for event in events(reader)]
+        writer.close()
+        assert received[-1]["status"] == "failed"
+        assert "no prompts" in received[-1]["error"]
+
+    serve({"solo": make_team(["To: User\n4"], setup=setup)}, test)
+
+
+def test_max_sessions():
+    # The server is created outside the event loop.
+    server = Server({"solo": make_team(["To: User\n4"], delay=0.2)}, port=0, max_sessions=1)
+
+    async def main():
+        await server.start()
+        try:
+            first = await start_session(server)
+            second = await start_session(server)
+            await asyncio.sleep(0.1)
+            assert server.sessions[first].status == "running"
+            assert server.sessions[second].status == "queued"
+            await asyncio.gather(server.sessions[first].task, server.sessions[second].task)
+            assert server.sessions[second].status == "finished"
+        finally:
+            await server.close()
+
+    asyncio.run(asyncio.wait_for(main(), 10))
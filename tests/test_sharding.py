@@ -0,0 +1,63 @@
+import asyncio
+import collections
+import os
+
+from mar_ps import Client, Model, ShardedRunner, Team
+
+PROBLEMS = [f"Problem {i}" for i in range(12)]
+
+
+class HostClient(Client):
+    # Answers with the problem it was sent. On the "slow" host every answer takes
+    # 0.2 s, and on the "dead" host the first request exits the worker process.
+    def __init__(self, host: str):
+        self.host = host
+
+    async def get_chat_completion(self, messages, model_id: str, options={}) -> str:
+        if self.host == "dead":
+            os._exit(3)
+        await asyncio.sleep(0.2 if self.host == "slow" else 0.0)
+        problem = messages[-1]["content"].splitlines()[-1]
+        return f"To: User\nSolved {problem}."
+
+
+def make_team(host: str) -> Team:
+    # Module-level, so the workers can import it.
+    team = Team()
+    team.Entity("Solver", "solves it", model=Model("m", HostClient(host)))
+    team.Entity("User", "asks", is_user=True)
+    return team
+
+
+def test_hash_assignment_is_stable():
+    runner = ShardedRunner(make_team, ["fast", "fast"], max_sessions=2)
+    results = runner.start_batch(PROBLEMS, "Solver")
+    assert [result.answer for result in results] == [f"Solved {p}." for p in PROBLEMS]
+    # Every problem ran on the worker its hash points to, in any runner and process.
+    again = ShardedRunner(make_team, ["fast", "fast"])
+    for result in results:
+        assert result.worker == runner.worker_for(result.problem)
+        assert result.worker == again.worker_for(result.problem)
+    assert {result.worker for result in results} == {0, 1}
+
+
+def test_load_assignment_favours_the_faster_worker():
+    runner = ShardedRunner(make_team, ["slow", "fast"], assignment="load", max_sessions=1)
+    results = runner.start_batch(PROBLEMS, "Solver")
+    assert all(result.error == None for result in results)
+    counts = collections.Counter(result.worker for result in results)
+    assert counts[1] > counts[0] >= 1
+    assert runner.in_progress == [0, 0]
+
+
+def test_dead_worker_fails_its_sessions():
+    runner = ShardedRunner(make_team, ["dead", "fast"], max_sessions=2)
+    results = runner.start_batch(PROBLEMS, "Solver")
+    for result in results:
+        if result.worker == 0:
+            assert isinstance(result.error, RuntimeError)
+            assert "exited with code 3" in str(result.error)
+        else:
+            assert result.error == None
+            assert result.answer == f"Solved {result.problem}."
+    assert {result.worker for result in results} == {0, 1}
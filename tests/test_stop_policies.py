@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+from common import build_team
+from stubs import HangingClient
+
+from mar_ps import AdmissionController, Deadline, Message, Model
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_deadline_cancels_running_generations(stream):
+    client = HangingClient()
+    client.admission = AdmissionController(max_in_flight=1)
+
+    async def main():
+        mar = build_team(client, event_sink=None, stop_policies=[Deadline(0.1)])
+        start = time.perf_counter()
+        turns = await mar.run(
+            Message(mar.entities[1], mar.entities[0], "Solve it."),
+            max_turns=10,
+            stream=stream,
+        )
+        assert time.perf_counter() - start < 1.0
+        assert turns == 0
+        assert mar.result.reason == "deadline"
+        # The backend request itself was cancelled, and gave back its slot.
+        assert client.started == 1
+        assert client.cancelled == 1
+        assert client.admission.in_flight == 0
+        assert not Model.in_flight.get(client)
+        assert not Model.waiters
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+
+def test_deadline_applies_to_the_first_turn_of_send():
+    client = HangingClient()
+
+    async def main():
+        mar = build_team(client, event_sink=None, stop_policies=[Deadline(0.1)])
+        start = time.perf_counter()
+        content = await mar.entities[0].send(
+            "Solve it.", mar.entities[1], max_turns=10
+        )
+        assert time.perf_counter() - start < 1.0
+        assert content == None
+        assert mar.result.reason == "deadline"
+        assert mar.result.turns == 0
+        assert client.cancelled == 1
+        assert not Model.waiters
+
+    asyncio.run(asyncio.wait_for(main(), 5))
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+from common import build_team
+from stubs import PromptClient, stacks
+
+from mar_ps import ConversationStore, Message
+
+
+def start(path: str, turns: int):
+    # Runs a new conversation, saved to `path`, for `turns` turns.
+    async def main():
+        store = ConversationStore(path)
+        mar = build_team(PromptClient(), size=3, event_sink=None, store=store)
+        await mar.run(
+            Message(mar.entities[1], mar.entities[0], "Solve it."), max_turns=turns
+        )
+        store.close()
+        return mar
+
+    return asyncio.run(main())
+
+
+def resume(path: str, turns: int):
+    # Continues the conversation saved to `path` in a new MAR.
+    async def main():
+        store = ConversationStore(path)
+        mar = build_team(
+            PromptClient(), size=3, system_prompts=False, event_sink=None, store=store
+        )
+        await mar.resume(max_turns=turns)
+        # Loads the stacks that weren't used yet, before the store is closed.
+        for entity in mar.entities:
+            entity.message_stack
+        store.close()
+        return mar
+
+    return asyncio.run(main())
+
+
+def test_resume_matches_an_uninterrupted_run(tmp_path):
+    uninterrupted = start(str(tmp_path / "a.log"), 12)
+    path = str(tmp_path / "b.log")
+    start(path, 5)
+    resume(path, 4)
+    resumed = resume(path, 3)
+    assert stacks(resumed) == stacks(uninterrupted)
+
+
+def test_resume_loads_the_saved_stacks(tmp_path):
+    path = str(tmp_path / "conversation.log")
+    original = start(path, 5)
+    loaded = resume(path, 0)
+    assert stacks(loaded) == stacks(original)
+
+
+def test_torn_record_is_dropped(tmp_path):
+    uninterrupted = start(str(tmp_path / "a.log"), 8)
+    path = str(tmp_path / "b.log")
+    start(path, 5)
+    size = os.path.getsize(path)
+    with open(path, "ab") as log:
+        log.write(b'{"k":"m","id":99,"s":"Expert 0","c":"half a rec')
+    resumed = resume(path, 3)
+    assert stacks(resumed) == stacks(uninterrupted)
+    with open(path, "rb") as log:
+        assert b"half a rec" not in log.read()
+    assert os.path.getsize(path) > size
+
+
+def test_missing_index_entries_are_rebuilt(tmp_path):
+    uninterrupted = start(str(tmp_path / "a.log"), 8)
+    path = str(tmp_path / "b.log")
+    start(path, 5)
+    # The process died after writing the last records to the log, but before their
+    # index entries were complete.
+    entry = ConversationStore.INDEX.size
+    index_size = os.path.getsize(path + ".idx")
+    with open(path + ".idx", "r+b") as index:
+        index.truncate(index_size - 3 * entry - entry // 2)
+    resumed = resume(path, 3)
+    assert stacks(resumed) == stacks(uninterrupted)
+    assert os.path.getsize(path + ".idx") % entry == 0
+
+
+def test_index_entries_past_the_end_of_the_log_are_dropped(tmp_path):
+    uninterrupted = start(str(tmp_path / "a.log"), 8)
+    path = str(tmp_path / "b.log")
+    start(path, 5)
+    log_size = os.path.getsize(path)
+    with open(path + ".idx", "ab") as index:
+        index.write(ConversationStore.INDEX.pack(log_size, 100, 5, ord("m"), 99))
+    resumed = resume(path, 3)
+    assert stacks(resumed) == stacks(uninterrupted)
+
+
+def test_load_an_earlier_turn(tmp_path):
+    early = start(str(tmp_path / "a.log"), 3)
+    path = str(tmp_path / "b.log")
+    start(path, 8)
+    store = ConversationStore(path)
+    for entity in early.entities:
+        loaded = store.load(entity.id, turn=3)
+        assert [message.content for message in loaded] == [
+            message.content for message in entity.message_stack
+        ]
+    store.close()
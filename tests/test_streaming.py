@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from common import build_team
+from stubs import ScriptedClient, stacks
+
+from mar_ps import Message, ResponseStream
+
+
+def run_turn(client, stream: bool, **options):
+    # One turn of "Expert 0", answering "Expert 1".
+    async def main():
+        mar = build_team(client, event_sink=None)
+        await mar.run(
+            Message(mar.entities[1], mar.entities[0], "Solve it."),
+            max_turns=1,
+            stream=stream,
+            **options,
+        )
+        return mar
+
+    return asyncio.run(main())
+
+
+def test_header_split_across_deltas():
+    response = ResponseStream()
+    body = ""
+    for delta in ["T", "o: Exp", "ert 1\n", "\nBo", "dy"]:
+        body += response.feed(delta)
+        assert response.missing_header == ("To: " not in response.text)
+    assert response.recipient_name == "Expert 1"
+    assert body == "Body"
+
+
+def test_header_after_other_text():
+    response = ResponseStream()
+    body = response.feed("Let me think.\nTo: Expert 1\nBody")
+    assert response.recipient_name == "Expert 1"
+    assert body == "Body"
+
+
+def test_unknown_recipient_aborts_the_stream():
+    client = ScriptedClient(
+        [["To: Nobody\n", "This ", "is ", "wasted."], ["To: Expert 1\n", "Done."]]
+    )
+    mar = run_turn(client, stream=True)
+    expert = mar.entities[0]
+    assert expert.aborted_generations == 1
+    assert client.closed_early == 1
+    assert mar.result.last_message.content == "Done."
+    assert mar.result.last_message.recipient == mar.entities[1]
+    assert any('recipient not found: "Nobody"' in m.content for m in expert.message_stack)
+
+
+def test_header_after_other_text_is_not_aborted():
+    client = ScriptedClient([["Let me think.\n", "To: Expert 1\n", "Done."]])
+    mar = run_turn(client, stream=True)
+    assert mar.entities[0].aborted_generations == 0
+    assert client.closed_early == 0
+    assert client.calls == 1
+    assert mar.result.last_message.content == "Done."
+
+
+def test_missing_header_is_corrected_after_the_stream_ends():
+    client = ScriptedClient([["No header ", "at all."], "To: Expert 1\nDone."])
+    mar = run_turn(client, stream=True)
+    expert = mar.entities[0]
+    assert expert.aborted_generations == 0
+    assert client.closed_early == 0
+    assert client.calls == 2
+    assert any("no recipient name found" in m.content for m in expert.message_stack)
+    assert mar.result.last_message.content == "Done."
+
+
+@pytest.mark.parametrize(
+    "responses",
+    [
+        [["To: Expert 1\n", "Done."]],
+        [["Let me think.\n", "To: Expert 1\n", "Done."]],
+        [["To: Nobody\n", "Hi."], ["To: Expert 1\n", "Done."]],
+        [["No header."], ["To: Nobody\n", "Hi."], ["To: Expert 1\n", "Done."]],
+    ],
+)
+def test_streamed_matches_non_streamed(responses):
+    plain = run_turn(ScriptedClient(responses), stream=False)
+    streamed = run_turn(ScriptedClient(responses), stream=True)
+    assert stacks(plain) == stacks(streamed)
+
+
+def test_stream_handler_gets_the_body_of_valid_replies_only():
+    pieces = []
+    client = ScriptedClient(
+        [["To: Nobody\n", "Wasted."], ["To: Expert 1\n", "\n", "Hel", "lo"]]
+    )
+    mar = run_turn(
+        client,
+        stream=True,
+        stream_handler=lambda entity, recipient, text: pieces.append(
+            (entity.id, recipient.id, text)
+        ),
+    )
+    assert "".join(text for _, _, text in pieces) == "Hello"
+    assert {(entity, recipient) for entity, recipient, _ in pieces} == {
+        ("Expert 0", "Expert 1")
+    }
+    assert mar.result.last_message.content == "Hello"
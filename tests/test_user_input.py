@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from stubs import ScriptedClient
+
+from mar_ps import MAR, Message, Model, UserInput
+
+
+def team() -> MAR:
+    # Created outside the event loop, like a MAR set up at import time.
+    mar = MAR(event_sink=None)
+    mar.Entity("Solver", "solves it", model=Model("m", ScriptedClient(["To: User\nHi."])))
+    mar.Entity("User", "asks", is_user=True)
+    return mar
+
+
+def test_sync_handler_runs_in_its_own_thread():
+    mar = team()
+    threads = []
+
+    def handler() -> str:
+        threads.append(threading.current_thread())
+        return "Thanks."
+
+    async def main():
+        solver, user = mar.entities
+        await mar.run(
+            Message(solver, user, "Here is the answer."),
+            max_turns=2,
+            user_input_handler=handler,
+        )
+
+    asyncio.run(main())
+    assert threads and threads[0] != threading.main_thread()
+    assert mar.result.last_message.content == "Hi."
+    assert mar.entities[0].message_stack[-2].content == "Thanks."
+
+
+def test_user_input_waits_for_a_reply():
+    mar = team()
+    inputs = UserInput()
+
+    async def main():
+        solver, user = mar.entities
+        run = asyncio.ensure_future(
+            mar.run(
+                Message(solver, user, "Here is the answer."),
+                max_turns=2,
+                user_input_handler=inputs,
+            )
+        )
+        while not inputs.pending:
+            await asyncio.sleep(0.01)
+        assert inputs.pending[0].entity == user
+        assert inputs.reply("Thanks.", entity="User")
+        await run
+        assert not inputs.reply("Nobody asked.", entity="User")
+        assert not inputs.queued
+
+    asyncio.run(main())
+    assert mar.entities[0].message_stack[-2].content == "Thanks."